@@ -0,0 +1,163 @@
+"""
+Stability AI API（v1 image-to-image / image-to-image/masking）のスタブサーバー
+ベンチマーク用。遅延・エラー率・レート制限（429）を指定でき、入力画像と同じサイズの画像を返す。
+
+    python benchmark/mock_stability.py --port 8771 --latency 8 --jitter 2 --error-rate 0.02
+"""
+import io
+import re
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+ENDPOINT_PATTERN = re.compile(r'^/v1/generation/[\w.-]+/image-to-image(/masking)?$')
+
+
+class MockState:
+    """スタブの設定と、応答用画像のキャッシュ（サイズごと）"""
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.counts = {}
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def delay(self):
+        with self.lock:
+            return max(0.0, self.random.gauss(self.args.latency, self.args.jitter))
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def response_body(self, size):
+        """入力画像と同じサイズのPNGを含むレスポンス（サイズごとに1回だけ生成）"""
+        with self.lock:
+            body = self.responses.get(size)
+        if body is None:
+            image = Image.effect_noise(size, 64).convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            body = json.dumps({'artifacts': [{
+                'base64': base64.b64encode(buffer.getvalue()).decode(),
+                'seed': 0,
+                'finishReason': 'SUCCESS'
+            }]}).encode()
+            with self.lock:
+                self.responses[size] = body
+        return body
+
+
+def read_init_image_size(body, content_type):
+    """multipart/form-dataからinit_imageを取り出してサイズを返す"""
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if not match:
+        return None
+    boundary = b'--' + match.group(1).encode()
+    for part in body.split(boundary):
+        headers, _, content = part.partition(b'\r\n\r\n')
+        if b'name="init_image"' in headers:
+            return Image.open(io.BytesIO(content.rstrip(b'\r\n-'))).size
+    return None
+
+
+def make_handler(state):
+    args = state.args
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, status, payload, headers=None):
+            body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            # 受け付けたリクエストの集計（ベンチマークの結果に含める）
+            if self.path == '/stats':
+                with state.lock:
+                    self.send_json(200, dict(state.counts))
+            else:
+                self.send_json(404, {'message': 'not found'})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not ENDPOINT_PATTERN.match(self.path):
+                state.count('404')
+                self.send_json(404, {'message': 'not found'})
+                return
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                state.count('401')
+                self.send_json(401, {'message': 'missing authorization'})
+                return
+
+            try:
+                size = read_init_image_size(body, self.headers.get('Content-Type'))
+            except Exception:
+                size = None
+            if size is None:
+                state.count('400')
+                self.send_json(400, {'message': 'init_image is required'})
+                return
+
+            time.sleep(state.delay())
+
+            roll = state.roll()
+            if roll < args.rate_limit_rate:
+                state.count('429')
+                self.send_json(429, {'message': 'rate limited'}, {'Retry-After': str(args.retry_after)})
+            elif roll < args.rate_limit_rate + args.error_rate:
+                state.count('500')
+                self.send_json(500, {'message': 'internal error'})
+            else:
+                state.count('200')
+                self.send_json(200, state.response_body(size))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Stability AI APIのスタブサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8771)
+    parser.add_argument('--latency', type=float, default=8.0, help='応答までの平均時間（秒）')
+    parser.add_argument('--jitter', type=float, default=2.0, help='応答時間の標準偏差（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='500を返す割合')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='429を返す割合')
+    parser.add_argument('--retry-after', type=int, default=1, help='429のRetry-After（秒）')
+    parser.add_argument('--seed', type=int, default=0, help='遅延・エラーの乱数シード')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(MockState(args)))
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    print(f'mock stability api listening on http://{args.host}:{args.port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+"""
+オフラインのベンチマーク
+Stability AI APIのスタブ（mock_stability.py）とgunicorn（gunicorn_config.py）でserver.pyを起動し、
+3つの生成エンドポイントに実際のサイズの画像を並行して送って、
+スループット・レイテンシ（p50/p95/p99）・ワーカーごとのメモリ使用量（RSS）を出力する。
+
+    python benchmark/run.py --concurrency 16 --requests 64
+    python benchmark/run.py --worker-class gevent --latency 8 --error-rate 0.02 --json result.json
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from PIL import Image, ImageDraw, ImageFilter
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# サーバーの実行に必要なファイル（一時ディレクトリにコピーし、生成物やinstance/を作業ツリーに書き込まない）
+APP_FILES = ('server.py', 'image_pool.py', 'gunicorn_config.py', 'data', 'public')
+
+ENDPOINTS = ('transform-room-style', 'transform-room-area', 'customize-room')
+
+# エンドポイントごとのフォーム項目（入力の種類は実際の利用に合わせて順に使う）
+ENDPOINT_FIELDS = {
+    'transform-room-style': [{'style': style} for style in ('simple', 'scandinavian', 'natural', 'japanese_modern')],
+    'transform-room-area': [{'prompt': prompt} for prompt in ('木製のテーブル', '青いソファ', '観葉植物', '白いカーテン')],
+    'customize-room': [{'prompt': prompt} for prompt in ('壁を白くして', '床をフローリングに', 'ソファを青に', '明るい照明にして')],
+}
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def make_photo(size, rng):
+    """スマートフォンの写真に近い圧縮率になるJPEG（グラデーション＋図形＋ノイズ）"""
+    width, height = size
+    img = Image.linear_gradient('L').resize(size).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randrange(width // 20, width // 3), rng.randrange(height // 20, height // 3)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + w, y + h), fill=color)
+    img = img.filter(ImageFilter.GaussianBlur(2))
+    noise = Image.effect_noise(size, 24).convert('RGB')
+    img = Image.blend(img, noise, 0.15)
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def make_mask(size, rng):
+    """領域変更用のマスク（白が変更する領域）"""
+    width, height = size
+    mask = Image.new('L', size, 0)
+    draw = ImageDraw.Draw(mask)
+    x, y = rng.randrange(width // 2), rng.randrange(height // 2)
+    draw.ellipse((x, y, x + width // 3, y + height // 3), fill=255)
+    buffer = io.BytesIO()
+    mask.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def build_inputs(sizes, seed):
+    """入力画像（とマスク）をサイズごとに作成する（同じシードなら同じ画像になる）"""
+    rng = random.Random(seed)
+    return [(size, make_photo(size, rng), make_mask(size, rng)) for size in sizes]
+
+
+def percentile(values, p):
+    """最近接順位法によるパーセンタイル"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def read_rss(pid):
+    """プロセスのRSS（バイト）。終了していればNone"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    return None
+
+
+def process_tree():
+    """{親PID: [子PID, ...]}"""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                stat = f.read()
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    return children
+
+
+def descendants(tree, pid):
+    result = []
+    for child in tree.get(pid, []):
+        result.append(child)
+        result.extend(descendants(tree, child))
+    return result
+
+
+class RssSampler(threading.Thread):
+    """
+    gunicornのワーカーごとのRSSを定期的に記録する
+    ワーカー本体と、ワーカーが起動した子プロセス（画像処理のプロセスプールなど）の合計を分けて集計する
+    """
+
+    def __init__(self, master_pid, interval):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peaks = {}
+
+    def sample(self):
+        tree = process_tree()
+        for worker_pid in tree.get(self.master_pid, []):
+            rss = read_rss(worker_pid)
+            if rss is None:
+                continue
+            helpers = sum(read_rss(pid) or 0 for pid in descendants(tree, worker_pid))
+            peak = self.peaks.setdefault(worker_pid, {'rss': 0, 'helpers': 0, 'last': 0})
+            peak['rss'] = max(peak['rss'], rss)
+            peak['helpers'] = max(peak['helpers'], helpers)
+            peak['last'] = rss
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def ensure_port_free(port):
+    """ポートが使用中なら中断する（前回のプロセスが残っていると、そちらを計測してしまうため）"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        if sock.connect_ex(('127.0.0.1', port)) == 0:
+            sys.exit(f'ポート{port}は使用中です')
+
+
+def wait_until_ready(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{url} のプロセスが終了しました（終了コード {process.returncode}）')
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} が起動しませんでした')
+
+
+def start_mock(args, log_file):
+    command = [
+        sys.executable, os.path.join(BENCHMARK_DIR, 'mock_stability.py'),
+        '--port', str(args.mock_port),
+        '--latency', str(args.latency),
+        '--jitter', str(args.jitter),
+        '--error-rate', str(args.error_rate),
+        '--rate-limit-rate', str(args.rate_limit_rate),
+        '--seed', str(args.seed),
+    ]
+    ensure_port_free(args.mock_port)
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+    wait_until_ready(f'http://127.0.0.1:{args.mock_port}/stats', process, 30)
+    return process
+
+
+def copy_app(app_dir):
+    """サーバーのファイルを一時ディレクトリにコピーする（生成物・キャッシュは除く）"""
+    ignore = shutil.ignore_patterns('generated-images', '__pycache__')
+    for name in APP_FILES:
+        source = os.path.join(ROOT_DIR, name)
+        target = os.path.join(app_dir, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, target, ignore=ignore)
+        else:
+            shutil.copy2(source, target)
+
+
+def start_server(args, app_dir, log_file):
+    env = dict(os.environ)
+    env.update({
+        'STABILITY_API_HOST': f'http://127.0.0.1:{args.mock_port}',
+        'STABILITY_API_KEY': 'benchmark',
+        'GUNICORN_WORKER_CLASS': args.worker_class,
+        'METRICS_FLUSH_INTERVAL': '1',
+    })
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    command = [
+        sys.executable, '-m', 'gunicorn', '-c', os.path.join(app_dir, 'gunicorn_config.py'),
+        '--bind', f'127.0.0.1:{args.port}', 'server:app',
+    ]
+    ensure_port_free(args.port)
+    process = subprocess.Popen(command, cwd=app_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    wait_until_ready(f'http://127.0.0.1:{args.port}/api/room-styles', process, 120)
+    return process
+
+
+def stop_process(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def run_endpoint(args, endpoint, inputs):
+    """1つのエンドポイントに、指定の並列数でリクエストを送る"""
+    url = f'http://127.0.0.1:{args.port}/api/{endpoint}'
+    local = threading.local()
+    fields = ENDPOINT_FIELDS[endpoint]
+
+    def send(index):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        size, image_bytes, mask_bytes = inputs[index % len(inputs)]
+        data = dict(fields[index % len(fields)], cache='1' if args.cache else '0', seed=str(args.seed + index))
+        files = {'image': ('room.jpg', image_bytes, 'image/jpeg')}
+        if endpoint == 'transform-room-area':
+            files['mask'] = ('mask.png', mask_bytes, 'image/png')
+        start = time.perf_counter()
+        try:
+            response = session.post(url, data=data, files=files, timeout=args.timeout)
+            status = response.status_code
+        except requests.RequestException:
+            status = 'error'
+        return {'size': size, 'status': status, 'seconds': time.perf_counter() - start}
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        # ウォームアップ（集計に含めない）
+        list(executor.map(send, range(args.warmup)))
+        start = time.perf_counter()
+        results = list(executor.map(send, range(args.warmup, args.warmup + args.requests)))
+        elapsed = time.perf_counter() - start
+
+    return summarize(results, elapsed)
+
+
+def summarize(results, elapsed):
+    latencies = [result['seconds'] for result in results if result['status'] == 200]
+    statuses = {}
+    for result in results:
+        statuses[str(result['status'])] = statuses.get(str(result['status']), 0) + 1
+    return {
+        'requests': len(results),
+        'ok': len(latencies),
+        'statuses': statuses,
+        'elapsedSeconds': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 3) if elapsed else None,
+        'latency': {
+            name: round(value, 3) if value is not None else None
+            for name, value in (('p50', percentile(latencies, 50)),
+                                ('p95', percentile(latencies, 95)),
+                                ('p99', percentile(latencies, 99)),
+                                ('max', max(latencies) if latencies else None))
+        },
+    }
+
+
+STAGE_PATTERN = re.compile(r'^rooms_stage_seconds_(sum|count)\{(.*)\} (\S+)$')
+
+
+def scrape_stage_timings(args):
+    """/metricsから段階ごとの平均所要時間（エンドポイント別）を取得する"""
+    # 各ワーカーのスナップショットが書き出されるのを待つ
+    time.sleep(1.5)
+    text = requests.get(f'http://127.0.0.1:{args.port}/metrics', timeout=10).text
+    totals = {}
+    for line in text.splitlines():
+        match = STAGE_PATTERN.match(line)
+        if not match:
+            continue
+        field, labels, value = match.groups()
+        labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels))
+        key = (labels.get('endpoint', ''), labels.get('stage', ''))
+        totals.setdefault(key, {})[field] = float(value)
+    stages = {}
+    for (endpoint, stage), value in sorted(totals.items()):
+        if value.get('count'):
+            stages.setdefault(endpoint, {})[stage] = round(value['sum'] / value['count'], 4)
+    return stages
+
+
+def print_report(report):
+    config = report['config']
+    print()
+    print(f"worker_class={config['worker_class']} workers={config['workers'] or 'default'} "
+          f"concurrency={config['concurrency']} requests={config['requests']} "
+          f"latency={config['latency']}±{config['jitter']}s error_rate={config['error_rate']} "
+          f"sizes={','.join(config['sizes'])}")
+    print()
+    print(f"{'endpoint':<24}{'ok/total':>10}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  statuses")
+    for endpoint, result in report['endpoints'].items():
+        latency = result['latency']
+        cells = ''.join(f"{latency[name] if latency[name] is not None else '-':>9}" for name in ('p50', 'p95', 'p99', 'max'))
+        print(f"{endpoint:<24}{result['ok']:>5}/{result['requests']:<4}{result['throughput']:>9}{cells}  "
+              f"{json.dumps(result['statuses'])}")
+    print()
+    print(f"{'worker pid':<12}{'peak RSS':>12}{'last RSS':>12}{'helpers':>12}")
+    for pid, peak in sorted(report['workers'].items()):
+        print(f"{pid:<12}{peak['rss'] / 1024 ** 2:>10.1f}MB{peak['last'] / 1024 ** 2:>10.1f}MB"
+              f"{peak['helpers'] / 1024 ** 2:>10.1f}MB")
+    if report['stages']:
+        print()
+        print('stage mean seconds:')
+        for endpoint, stages in report['stages'].items():
+            print(f"  {endpoint}: " + ', '.join(f'{stage}={value}' for stage, value in stages.items()))
+    print()
+    print(f"mock stability api responses: {json.dumps(report['upstream'])}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='server.pyのオフラインベンチマーク')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='計測するエンドポイント（カンマ区切り）')
+    parser.add_argument('--concurrency', type=int, default=8, help='同時に送るリクエスト数')
+    parser.add_argument('--requests', type=int, default=32, help='エンドポイントごとのリクエスト数')
+    parser.add_argument('--warmup', type=int, default=2, help='集計しないウォームアップのリクエスト数')
+    parser.add_argument('--sizes', default='4032x3024,3024x4032,1920x1080',
+                        help='入力画像のサイズ（カンマ区切り）')
+    parser.add_argument('--cache', action='store_true', help='生成結果のキャッシュを有効にする（既定は無効）')
+    parser.add_argument('--timeout', type=float, default=180, help='1リクエストのタイムアウト（秒）')
+    parser.add_argument('--worker-class', default='sync', choices=('sync', 'gevent'))
+    parser.add_argument('--workers', type=int, default=None, help='gunicornのワーカー数（既定はgunicorn_config.py）')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='server.pyに渡す環境変数（複数指定可）')
+    parser.add_argument('--port', type=int, default=8772)
+    parser.add_argument('--mock-port', type=int, default=8771)
+    parser.add_argument('--latency', type=float, default=8.0, help='スタブの平均応答時間（秒）')
+    parser.add_argument('--jitter', type=float, default=2.0, help='スタブの応答時間の標準偏差（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='スタブが500を返す割合')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='スタブが429を返す割合')
+    parser.add_argument('--seed', type=int, default=0, help='入力画像・スタブの乱数シード')
+    parser.add_argument('--rss-interval', type=float, default=0.5, help='RSSの記録間隔（秒）')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    parser.add_argument('--log-dir', help='スタブ・サーバーのログの保存先（既定は一時ディレクトリ）')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(',') if endpoint.strip()]
+    unknown = [endpoint for endpoint in endpoints if endpoint not in ENDPOINTS]
+    if unknown:
+        sys.exit(f'不明なエンドポイント: {", ".join(unknown)}')
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+
+    print('入力画像を作成中...', flush=True)
+    inputs = build_inputs(sizes, args.seed)
+
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix='rooms-benchmark-')
+    os.makedirs(log_dir, exist_ok=True)
+    mock_log = open(os.path.join(log_dir, 'mock_stability.log'), 'wb')
+    server_log = open(os.path.join(log_dir, 'server.log'), 'wb')
+    print(f'ログ: {log_dir}', flush=True)
+
+    # 生成物・instance/はコピー先に書き込まれ、終了時に削除される
+    app_dir = tempfile.mkdtemp(prefix='rooms-benchmark-app-')
+    copy_app(app_dir)
+
+    mock = server = sampler = None
+    try:
+        mock = start_mock(args, mock_log)
+        server = start_server(args, app_dir, server_log)
+        sampler = RssSampler(server.pid, args.rss_interval)
+        sampler.start()
+
+        results = {}
+        for endpoint in endpoints:
+            print(f'{endpoint} を計測中...', flush=True)
+            results[endpoint] = run_endpoint(args, endpoint, inputs)
+
+        sampler.stop()
+        report = {
+            'config': {
+                'worker_class': args.worker_class,
+                'workers': args.workers,
+                'concurrency': args.concurrency,
+                'requests': args.requests,
+                'latency': args.latency,
+                'jitter': args.jitter,
+                'error_rate': args.error_rate,
+                'rate_limit_rate': args.rate_limit_rate,
+                'sizes': [f'{width}x{height}' for width, height in sizes],
+                'cache': args.cache,
+                'env': args.env,
+                'seed': args.seed,
+            },
+            'endpoints': results,
+            'workers': {str(pid): peak for pid, peak in sampler.peaks.items()},
+            'stages': scrape_stage_timings(args),
+            'upstream': requests.get(f'http://127.0.0.1:{args.mock_port}/stats', timeout=10).json(),
+        }
+    finally:
+        if sampler is not None and sampler.is_alive():
+            sampler.stop()
+        for process in (server, mock):
+            if process is not None:
+                stop_process(process)
+        mock_log.close()
+        server_log.close()
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,17 @@
+import os
 import multiprocessing
 
-# ワーカープロセスの数
-workers = multiprocessing.cpu_count() * 2 + 1
+# ワーカークラスの指定（GUNICORN_WORKER_CLASS=geventで非同期モード）
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
 
-# ワーカークラスの指定
-worker_class = 'sync'
+if worker_class == 'gevent':
+    # 生成の待ち時間はグリーンレットで並行して待つため、プロセス数はCPU数に合わせる
+    workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+    # 1プロセスで同時に受け付ける接続数
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+else:
+    # ワーカープロセスの数
+    workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
 
 # タイムアウト設定
 timeout = 120
@@ -16,6 +23,13 @@ bind = "0.0.0.0:$PORT"
 accesslog = '-'
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
 
+# 起動時に前回のメトリクス（/metrics）のスナップショットを削除する
+def on_starting(server):
+    metrics_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'metrics')
+    if os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            os.remove(os.path.join(metrics_dir, name))
+
 # エラーログの設定
 errorlog = '-'
 loglevel = 'info' 
\ No newline at end of file
@@ -0,0 +1,295 @@
+# 画像変換処理（デコード・リサイズ・余白追加・マスク処理・合成・エンコード）
+# server.pyからプロセスプールのワーカーで実行する。ワーカーはこのモジュールだけを読み込むため、
+# Flaskアプリの初期化やバックグラウンドスレッドなどの副作用を持ち込まない。
+# 画像のバイト列は共有メモリで受け渡し、パイプでのpickle転送を避ける。
+import io
+import time
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import numpy as np
+from PIL import Image
+
+# ワーカープロセス内ではTrue（結果のバイト列を共有メモリで返す）
+in_worker = False
+
+
+class SharedBlob:
+    """共有メモリ上のバイト列への参照（名前とサイズだけをpickleする）"""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __reduce__(self):
+        return (SharedBlob, (self.name, self.size))
+
+
+def init_worker():
+    """プロセスプールのワーカーの初期化"""
+    global in_worker
+    in_worker = True
+
+
+def share(data):
+    """バイト列を共有メモリにコピーして参照を返す（解放はreleaseで行う）"""
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        shm.buf[:len(data)] = data
+    finally:
+        shm.close()
+    return SharedBlob(shm.name, len(data))
+
+
+def release(blob):
+    """共有メモリを解放する"""
+    try:
+        shm = shared_memory.SharedMemory(name=blob.name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def load(blob):
+    """引数を読み出す（プロセス内で実行する場合はバイト列がそのまま渡される）"""
+    if not isinstance(blob, SharedBlob):
+        return blob
+    shm = shared_memory.SharedMemory(name=blob.name)
+    try:
+        return bytes(shm.buf[:blob.size])
+    finally:
+        shm.close()
+
+
+def dump(data):
+    """結果を返す（ワーカー内では共有メモリに置き、呼び出し側がcollectで受け取る）"""
+    return share(data) if in_worker else data
+
+
+def collect(result):
+    """ワーカーの結果に含まれる共有メモリをバイト列に置き換えて解放する"""
+    if isinstance(result, SharedBlob):
+        try:
+            return load(result)
+        finally:
+            release(result)
+    if isinstance(result, dict):
+        return {key: collect(value) for key, value in result.items()}
+    return result
+
+
+@contextmanager
+def timed_stage(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def scale_box(box, from_size, to_size):
+    """from_sizeの画像上の範囲を、to_sizeに拡大縮小した画像上の範囲に変換する"""
+    scale_x = to_size[0] / from_size[0]
+    scale_y = to_size[1] / from_size[1]
+    return (box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y)
+
+
+def decode_and_resize(image_bytes, target_size, reducing_gap, timings, box=None):
+    """
+    画像をデコードして目的のサイズに縮小する（boxを指定した場合はその範囲だけを切り出す）
+    大きなJPEGはdraftモードでDCT縮小しながらデコードし、LANCZOSの前にreduce()で粗く縮小する
+    """
+    with timed_stage(timings, 'decode'):
+        img = Image.open(io.BytesIO(image_bytes))
+        full_size = img.size
+        if img.format == 'JPEG':
+            if box is None:
+                img.draft('RGB', target_size)
+            else:
+                # 切り出す範囲が目的のサイズ以上になる縮小率でデコードする
+                img.draft('RGB', (max(1, full_size[0] * target_size[0] // (box[2] - box[0])),
+                                  max(1, full_size[1] * target_size[1] // (box[3] - box[1]))))
+        img = img.convert('RGB')
+
+    with timed_stage(timings, 'resize'):
+        if box is not None:
+            img = img.resize(target_size, Image.LANCZOS, box=scale_box(box, full_size, img.size),
+                             reducing_gap=reducing_gap)
+        elif img.size != target_size:
+            img = img.resize(target_size, Image.LANCZOS, reducing_gap=reducing_gap)
+    return img
+
+
+def encode(img, timings, stage='encode', **save_options):
+    """画像をメモリ上でエンコードしてバイト列を返す（既定はPNG）"""
+    with timed_stage(timings, stage):
+        buffer = io.BytesIO()
+        img.save(buffer, **(save_options or {'format': 'PNG'}))
+    return buffer.getvalue()
+
+
+def encode_preview(img, preview_size, quality, reducing_gap, timings):
+    """一覧表示用の低解像度プレビュー（WebP）"""
+    with timed_stage(timings, 'preview'):
+        preview = img.convert('RGB')
+        preview.thumbnail((preview_size, preview_size), Image.LANCZOS, reducing_gap=reducing_gap)
+        buffer = io.BytesIO()
+        preview.save(buffer, format='WEBP', quality=quality)
+    return buffer.getvalue()
+
+
+def prepare_image(image_blob, target_size, reducing_gap):
+    """アップロード画像を縮小してPNGにエンコードする（スタイル変更・カスタマイズ用）"""
+    timings = {}
+    img = decode_and_resize(load(image_blob), target_size, reducing_gap, timings)
+    png = encode(img, timings)
+    return {'image': dump(png), 'size': img.size, 'timings': timings}
+
+
+def box_sum(values, radius, axis):
+    """axis方向の幅2*radius+1の窓の合計（累積和の差で計算するため、計算量は半径によらない）"""
+    if radius <= 0:
+        return values
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (radius + 1, radius)
+    cumulative = np.cumsum(np.pad(values, pad), axis=axis)
+    upper = [slice(None)] * values.ndim
+    lower = [slice(None)] * values.ndim
+    upper[axis] = slice(2 * radius + 1, None)
+    lower[axis] = slice(0, -(2 * radius + 1))
+    return cumulative[tuple(upper)] - cumulative[tuple(lower)]
+
+
+def analyze_mask(mask_blob, image_size, threshold, dilate_px, feather_px):
+    """
+    マスクの二値化・膨張・境界のぼかし（フェザー）と、塗られた割合・範囲の計算をNumPyでまとめて行う
+    dilate_px・feather_pxは元画像のピクセル数（マスク画像の解像度に換算して適用する）。
+    maskはAPIに渡す膨張後の二値マスク、alphaは合成用のフェザー付きマスクで、
+    いずれもマスク画像の解像度（size）のグレースケールの生バイト列。bboxは元画像の座標
+    """
+    timings = {}
+    with timed_stage(timings, 'mask'):
+        mask_img = Image.open(io.BytesIO(load(mask_blob)))
+        size = mask_img.size
+        if mask_img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in mask_img.info:
+            # 透明な部分は塗られていないものとして扱う
+            mask_img = mask_img.convert('RGBA')
+            values = (np.asarray(mask_img.convert('L'), dtype=np.uint16)
+                      * np.asarray(mask_img.getchannel('A'), dtype=np.uint16) // 255)
+        else:
+            values = np.asarray(mask_img.convert('L'))
+
+        painted = values >= threshold
+        coverage = float(painted.mean())
+        if coverage == 0:
+            return {'coverage': 0.0, 'bbox': None, 'size': size, 'timings': timings}
+
+        scale = size[0] / image_size[0]
+        dilate = max(0, round(dilate_px * scale))
+        feather = max(0, round(feather_px * scale))
+
+        # 正方形の構造要素による膨張（窓内に塗られた画素があれば塗る）
+        dilated = painted.astype(np.int32)
+        dilated = box_sum(box_sum(dilated, dilate, 0), dilate, 1) > 0
+
+        # 膨張後のマスクを平均化して境界をぼかす
+        alpha = box_sum(box_sum(dilated.astype(np.int32), feather, 0), feather, 1)
+        alpha = (alpha * (255 / (2 * feather + 1) ** 2) + 0.5).astype(np.uint8)
+
+        rows = np.flatnonzero(alpha.any(axis=1))
+        cols = np.flatnonzero(alpha.any(axis=0))
+        left, top, right, bottom = scale_box((cols[0], rows[0], cols[-1] + 1, rows[-1] + 1), size, image_size)
+        bbox = (int(left), int(top), min(image_size[0], -int(-right)), min(image_size[1], -int(-bottom)))
+
+    return {
+        'coverage': coverage,
+        'bbox': bbox,
+        'size': size,
+        'mask': dump((dilated.astype(np.uint8) * 255).tobytes()),
+        'alpha': dump(alpha.tobytes()),
+        'timings': timings
+    }
+
+
+def prepare_masked_image(image_blob, mask_blob, mask_size, crop_box, bucket, content_size, offset, reducing_gap):
+    """
+    画像とマスク（analyze_maskのmask）のcrop_boxの範囲を縮小し、
+    許可サイズに合わせて余白を追加してPNGにエンコードする（領域変更用）
+    """
+    timings = {}
+    image_bytes = load(image_blob)
+    source_size = Image.open(io.BytesIO(image_bytes)).size
+    img = decode_and_resize(image_bytes, content_size, reducing_gap, timings, box=crop_box)
+
+    with timed_stage(timings, 'mask'):
+        # マスクの同じ範囲を切り出し、縮小後の画像と同じサイズに揃える
+        mask_img = Image.frombytes('L', mask_size, load(mask_blob))
+        mask_img = mask_img.resize(img.size, Image.LANCZOS, box=scale_box(crop_box, source_size, mask_size),
+                                   reducing_gap=reducing_gap)
+
+    # 許可サイズに合わせて余白を追加（アスペクト比の差分のみ）
+    with timed_stage(timings, 'pad'):
+        api_img = Image.new("RGB", bucket, (255, 255, 255))  # 白背景
+        api_mask = Image.new("L", bucket, 0)  # 黒（マスクなし）
+
+        # 縮小した画像を中央に配置
+        api_img.paste(img, offset)
+        api_mask.paste(mask_img, offset)
+
+    return {
+        'image': dump(encode(api_img, timings)),
+        'mask': dump(encode(api_mask, timings)),
+        'timings': timings
+    }
+
+
+def render_preview(result_blob, preview_size, quality, reducing_gap):
+    """生成結果・アップロード画像のプレビューを作る（JPEGはdraftモードで縮小しながらデコードする）"""
+    timings = {}
+    img = Image.open(io.BytesIO(load(result_blob)))
+    img.draft('RGB', (preview_size, preview_size))
+    preview = encode_preview(img, preview_size, quality, reducing_gap, timings)
+    return {'preview': dump(preview), 'timings': timings}
+
+
+def restore_result(result_blob, bucket, box, crop_box, source_blob, alpha_blob, alpha_size,
+                   preview_size, quality, reducing_gap):
+    """
+    生成結果から余白を除いた領域（box）を切り出して元の範囲（crop_box）のサイズに戻し、
+    元の解像度の画像にフェザー付きマスク（analyze_maskのalpha）で合成して、
+    PNGとプレビューにエンコードする（領域変更用）。マスクの外側の画素は元の画像のまま
+    """
+    timings = {}
+    with timed_stage(timings, 'postprocess'):
+        generated_img = Image.open(io.BytesIO(load(result_blob)))
+        if generated_img.size != bucket:
+            generated_img = generated_img.resize(bucket, Image.LANCZOS)
+        size = (crop_box[2] - crop_box[0], crop_box[3] - crop_box[1])
+        generated_img = generated_img.crop(box).resize(size, Image.LANCZOS).convert('RGB')
+
+    with timed_stage(timings, 'composite'):
+        final_img = Image.open(io.BytesIO(load(source_blob))).convert('RGB')
+        alpha = Image.frombytes('L', alpha_size, load(alpha_blob))
+        alpha = alpha.resize(size, Image.BILINEAR, box=scale_box(crop_box, final_img.size, alpha_size))
+        final_img.paste(generated_img, crop_box[:2], alpha)
+
+    png = encode(final_img, timings, stage='encode_result')
+    preview = encode_preview(final_img, preview_size, quality, reducing_gap, timings)
+    return {'image': dump(png), 'preview': dump(preview), 'timings': timings}
+
+
+def encode_variants(result_blob, encoders):
+    """
+    生成結果をWebP/JPEG/AVIFなどの派生フォーマットにエンコードする
+    encodersは [(フォーマット名, Pillowの保存オプション), ...]。失敗したフォーマットはerrorsに入る
+    """
+    timings = {}
+    img = Image.open(io.BytesIO(load(result_blob))).convert('RGB')
+    variants = {}
+    errors = {}
+    for variant, save_options in encoders:
+        try:
+            variants[variant] = dump(encode(img, timings, stage=variant, **save_options))
+        except Exception as error:
+            errors[variant] = str(error)
+    return {'variants': variants, 'errors': errors, 'timings': timings}
@@ -30,7 +30,11 @@ document.addEventListener('DOMContentLoaded', function() {
     const clearCanvasButton = document.getElementById('clear-canvas');
     let ctx;
     let isDrawing = false;
-    let maskData = null;
+
+    // マスク専用のオフスクリーンキャンバス（黒地に塗った部分だけを白で描き、写真は含めない）
+    const maskCanvas = document.createElement('canvas');
+    let maskCtx;
+    let maskPainted = false;
 
     // 状態管理
     const state = {
@@ -40,9 +44,22 @@ document.addEventListener('DOMContentLoaded', function() {
         selectedStyle: null,
         currentStep: 1,
         uploadHistory: [],
+        historyCursor: null,
         maxHistoryItems: 12
     };
     
+    // ブラウザごとのID（サーバー側の履歴を区別する）
+    function getClientId() {
+        let clientId = localStorage.getItem('clientId');
+        if (!clientId) {
+            clientId = Array.from(crypto.getRandomValues(new Uint8Array(16)),
+                byte => byte.toString(16).padStart(2, '0')).join('');
+            localStorage.setItem('clientId', clientId);
+        }
+        return clientId;
+    }
+    const clientId = getClientId();
+    
     // ローディング表示の切り替え
     function showLoading(show) {
         if (loadingOverlay) {
@@ -50,6 +67,115 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // ジョブの完了を待つ上限（ミリ秒）。APIの再試行を含めてもこれを超える場合は諦める
+    const JOB_WAIT_TIMEOUT_MS = 10 * 60 * 1000;
+    
+    // 生成ジョブの完了を待つ（ジョブの状態をポーリング）
+    function waitForJob(statusUrl) {
+        const deadline = Date.now() + JOB_WAIT_TIMEOUT_MS;
+        return new Promise((resolve, reject) => {
+            function poll() {
+                if (Date.now() > deadline) {
+                    reject(new Error('画像生成がタイムアウトしました。しばらくしてから再度お試しください'));
+                    return;
+                }
+                fetch(statusUrl)
+                    .then(response => response.json())
+                    .then(job => {
+                        if (job.status === 'succeeded') {
+                            resolve(job.result);
+                        } else if (job.status === 'failed' || job.error) {
+                            reject(new Error(job.error || 'APIリクエストに失敗しました'));
+                        } else {
+                            setTimeout(poll, 1000);
+                        }
+                    })
+                    .catch(reject);
+            }
+            poll();
+        });
+    }
+    
+    // データURLをBlobに変換（Base64を経由せずバイナリのまま送信するため）
+    function dataUrlToBlob(dataUrl) {
+        return fetch(dataUrl).then(response => response.blob());
+    }
+    
+    // 生成に使う画像サイズ（SDXLの許可サイズ）を取得（1回だけ）
+    let generationSizesPromise = null;
+    function loadGenerationSizes() {
+        if (!generationSizesPromise) {
+            generationSizesPromise = fetch('/api/generation-sizes')
+                .then(response => response.ok ? response.json() : { sizes: [] })
+                .then(data => data.sizes || [])
+                .catch(() => []);
+        }
+        return generationSizesPromise;
+    }
+    
+    // 写真をアスペクト比が最も近い生成サイズのPNGに縮小する（サーバー側の縮小を省略させるため）
+    // 縮小できない場合は元のデータURLのまま返す
+    function resizeToGenerationSize(dataUrl) {
+        return loadGenerationSizes().then(sizes => new Promise(resolve => {
+            if (!sizes.length) {
+                resolve(dataUrl);
+                return;
+            }
+            const img = new Image();
+            img.onload = function() {
+                const ratio = img.naturalWidth / img.naturalHeight;
+                const size = sizes.reduce((best, candidate) =>
+                    Math.abs(candidate.width / candidate.height - ratio) < Math.abs(best.width / best.height - ratio)
+                        ? candidate : best);
+                const resizeCanvas = document.createElement('canvas');
+                resizeCanvas.width = size.width;
+                resizeCanvas.height = size.height;
+                const resizeCtx = resizeCanvas.getContext('2d');
+                resizeCtx.imageSmoothingEnabled = true;
+                resizeCtx.imageSmoothingQuality = 'high';
+                resizeCtx.drawImage(img, 0, 0, size.width, size.height);
+                resizeCanvas.toBlob(blob => resolve(blob || dataUrl), 'image/png');
+            };
+            img.onerror = () => resolve(dataUrl);
+            img.src = dataUrl;
+        }));
+    }
+    
+    // 生成APIを呼び出す（画像はmultipart/form-dataで送信し、ジョブの完了まで待つ）
+    // imagesの値はデータURLまたはBlob
+    function requestGeneration(url, fields, images) {
+        const imageNames = Object.keys(images);
+        return Promise.all(imageNames.map(name => images[name] instanceof Blob ? images[name] : dataUrlToBlob(images[name])))
+        .then(blobs => {
+            const formData = new FormData();
+            Object.keys(fields).forEach(key => formData.append(key, fields[key]));
+            blobs.forEach((blob, i) => formData.append(imageNames[i], blob, imageNames[i]));
+            
+            return fetch(url, {
+                method: 'POST',
+                headers: {
+                    'Prefer': 'respond-async',
+                    'X-Client-Id': clientId
+                },
+                body: formData
+            });
+        })
+        .then(response => {
+            if (!response.ok) {
+                return response.json().then(data => {
+                    throw new Error(data.error || 'APIリクエストに失敗しました');
+                });
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data.jobId) {
+                return waitForJob(data.statusUrl);
+            }
+            return data;
+        });
+    }
+    
     // ページ読み込み時に状態を復元する関数
     function restoreState() {
         console.log('Restoring state...');
@@ -78,13 +204,6 @@ document.addEventListener('DOMContentLoaded', function() {
                     updateImagePreview(state.selectedImageData);
                 }
 
-                // アップロード履歴の復元
-                const savedHistory = localStorage.getItem('uploadHistory');
-                if (savedHistory) {
-                    state.uploadHistory = JSON.parse(savedHistory);
-                updateUploadHistory();
-                }
-
                 // 現在のステップを復元
                 setTimeout(() => {
                     goToStep(state.currentStep);
@@ -197,41 +316,52 @@ document.addEventListener('DOMContentLoaded', function() {
                 return;
             }
             
-            const reader = new FileReader();
-            reader.onload = function(event) {
-                const imageData = event.target.result;
-                state.selectedImageData = imageData;
-                state.originalImageData = imageData;
+            showLoading(true);
+            
+            // 写真をサーバーに保存し、以降はURLだけを保持する（Base64の画像はローカルストレージに保存しない）
+            const formData = new FormData();
+            formData.append('image', file, file.name);
+            fetch('/api/uploads', {
+                method: 'POST',
+                headers: {
+                    'X-Client-Id': clientId
+                },
+                body: formData
+            })
+            .then(response => response.json().then(data => {
+                if (!response.ok) {
+                    throw new Error(data.error || '画像のアップロードに失敗しました');
+                }
+                return data;
+            }))
+            .then(data => {
+                showLoading(false);
+                state.selectedImageData = data.imageUrl;
+                state.originalImageData = data.imageUrl;
                 
                 // プレビュー表示
                 if (previewContainer) {
-                    previewContainer.innerHTML = `<img src="${imageData}" alt="プレビュー">`;
+                    previewContainer.innerHTML = `<img src="${data.imageUrl}" alt="プレビュー">`;
                     nextToModeButton.disabled = false;
                 }
                 
                 // 履歴に追加
-                const historyItem = {
+                addHistoryItem({
+                    id: data.historyId,
+                    kind: 'upload',
                     name: file.name,
-                    data: imageData,
-                    date: new Date().toISOString()
-                };
-                
-                state.uploadHistory.unshift(historyItem);
-                if (state.uploadHistory.length > state.maxHistoryItems) {
-                    state.uploadHistory.pop();
-                }
+                    imageUrl: data.imageUrl,
+                    previewUrl: data.previewUrl
+                });
                 
                 // 状態を保存
                 saveState();
-                
-                // 履歴を保存
-                localStorage.setItem('uploadHistory', JSON.stringify(state.uploadHistory));
-                
-                // 履歴表示を更新
-                updateUploadHistory();
-            };
-            
-            reader.readAsDataURL(file);
+            })
+            .catch(error => {
+                showLoading(false);
+                alert('エラーが発生しました: ' + error.message);
+                console.error('Upload Error:', error);
+            });
         });
     }
     
@@ -304,24 +434,12 @@ document.addEventListener('DOMContentLoaded', function() {
             showLoading(true);
             
             // Stability AI APIを呼び出す
-            fetch('/api/transform-room-style', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    imageData: state.selectedImageData,
-                    style: state.selectedStyle
-                })
-            })
-            .then(response => {
-                if (!response.ok) {
-                    return response.json().then(data => {
-                        throw new Error(data.error || 'APIリクエストに失敗しました');
-                    });
-                }
-                return response.json();
-            })
+            resizeToGenerationSize(state.selectedImageData)
+            .then(image => requestGeneration('/api/transform-room-style', {
+                style: state.selectedStyle
+            }, {
+                image: image
+            }))
             .then(data => {
                 showLoading(false);
                 
@@ -334,6 +452,9 @@ document.addEventListener('DOMContentLoaded', function() {
                     resultImage.src = data.imageUrl;
                 }
                 
+                // 生成結果を履歴に追加（一覧には低解像度のプレビューを表示）
+                addResultToHistory(data);
+                
                 // 結果表示ステップに移動
                 goToStep(4);
             })
@@ -348,7 +469,7 @@ document.addEventListener('DOMContentLoaded', function() {
     // 領域変更適用ボタン
     if (applyAreaButton) {
         applyAreaButton.addEventListener('click', function() {
-            if (!maskData) {
+            if (!maskPainted) {
                 alert('変更する領域を指定してください');
                 return;
             }
@@ -360,26 +481,14 @@ document.addEventListener('DOMContentLoaded', function() {
             
             showLoading(true);
             
-            // Stability AI APIを呼び出す
-            fetch('/api/transform-room-area', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    imageData: state.selectedImageData,
-                    maskData: maskData,
-                    prompt: areaPrompt.value.trim()
-                })
-            })
-            .then(response => {
-                if (!response.ok) {
-                    return response.json().then(data => {
-                        throw new Error(data.error || 'APIリクエストに失敗しました');
-                    });
-                }
-                return response.json();
-            })
+            // Stability AI APIを呼び出す（マスクは塗った部分だけの白黒PNG）
+            encodeMaskPng()
+            .then(maskBlob => requestGeneration('/api/transform-room-area', {
+                prompt: areaPrompt.value.trim()
+            }, {
+                image: state.selectedImageData,
+                mask: maskBlob
+            }))
             .then(data => {
                 showLoading(false);
                 
@@ -392,6 +501,9 @@ document.addEventListener('DOMContentLoaded', function() {
                     resultImage.src = data.imageUrl;
                 }
                 
+                // 生成結果を履歴に追加（一覧には低解像度のプレビューを表示）
+                addResultToHistory(data);
+                
                 // 結果表示ステップに移動
                 goToStep(4);
             })
@@ -411,8 +523,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 return;
             }
             
+            // ダウンロードは常に元のPNGを取得する
             const link = document.createElement('a');
-            link.href = resultImage.src;
+            link.href = resultImage.src + (resultImage.src.includes('?') ? '&' : '?') + 'format=png';
             link.download = 'transformed-room-' + new Date().getTime() + '.png';
             document.body.appendChild(link);
             link.click();
@@ -477,9 +590,13 @@ document.addEventListener('DOMContentLoaded', function() {
             // 画像を描画
             ctx = canvas.getContext('2d');
             ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
-            
-            // マスクレイヤーをクリア
             ctx.globalCompositeOperation = 'source-over';
+            
+            // マスクレイヤーを表示用のキャンバスと同じサイズで用意してクリア
+            maskCanvas.width = canvas.width;
+            maskCanvas.height = canvas.height;
+            maskCtx = maskCanvas.getContext('2d');
+            clearMask();
         };
         img.src = state.selectedImageData;
         
@@ -518,8 +635,12 @@ document.addEventListener('DOMContentLoaded', function() {
         ctx.arc(x, y, brushSizeInput.value / 2, 0, Math.PI * 2);
         ctx.fill();
         
-        // マスクデータを更新
-        updateMaskData();
+        // マスクレイヤーにも同じ位置に描く
+        maskCtx.fillStyle = 'white';
+        maskCtx.beginPath();
+        maskCtx.arc(x, y, brushSizeInput.value / 2, 0, Math.PI * 2);
+        maskCtx.fill();
+        maskPainted = true;
         
         // 領域が指定されたらボタンを有効化
         applyAreaButton.disabled = false;
@@ -557,9 +678,84 @@ document.addEventListener('DOMContentLoaded', function() {
         canvas.dispatchEvent(mouseEvent);
     }
     
-    // マスクデータの更新
-    function updateMaskData() {
-        maskData = canvas.toDataURL('image/png');
+    // マスクレイヤーのクリア（黒で塗りつぶす）
+    function clearMask() {
+        maskCtx.fillStyle = 'black';
+        maskCtx.fillRect(0, 0, maskCanvas.width, maskCanvas.height);
+        maskPainted = false;
+    }
+    
+    // PNGのチャンク（長さ・種類・データ・CRC32）
+    const PNG_SIGNATURE = new Uint8Array([137, 80, 78, 71, 13, 10, 26, 10]);
+    const CRC_TABLE = (() => {
+        const table = new Uint32Array(256);
+        for (let n = 0; n < 256; n++) {
+            let c = n;
+            for (let k = 0; k < 8; k++) {
+                c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+            }
+            table[n] = c >>> 0;
+        }
+        return table;
+    })();
+    
+    function crc32(bytes) {
+        let c = 0xffffffff;
+        for (let i = 0; i < bytes.length; i++) {
+            c = CRC_TABLE[(c ^ bytes[i]) & 0xff] ^ (c >>> 8);
+        }
+        return (c ^ 0xffffffff) >>> 0;
+    }
+    
+    function pngChunk(type, data) {
+        const chunk = new Uint8Array(12 + data.length);
+        const view = new DataView(chunk.buffer);
+        view.setUint32(0, data.length);
+        for (let i = 0; i < 4; i++) {
+            chunk[4 + i] = type.charCodeAt(i);
+        }
+        chunk.set(data, 8);
+        view.setUint32(8 + data.length, crc32(chunk.subarray(4, 8 + data.length)));
+        return chunk;
+    }
+    
+    // マスクレイヤーを1ビットのグレースケールPNGにエンコードする（数KB程度）
+    // CompressionStreamに対応していないブラウザではキャンバスのPNGをそのまま使う
+    function encodeMaskPng() {
+        if (typeof CompressionStream === 'undefined') {
+            return new Promise(resolve => maskCanvas.toBlob(resolve, 'image/png'));
+        }
+        
+        const width = maskCanvas.width;
+        const height = maskCanvas.height;
+        const pixels = maskCtx.getImageData(0, 0, width, height).data;
+        
+        // 各行の先頭はフィルタの種類（0: なし）、続いて1画素1ビット（白=1）
+        const rowBytes = Math.ceil(width / 8) + 1;
+        const scanlines = new Uint8Array(rowBytes * height);
+        for (let y = 0; y < height; y++) {
+            for (let x = 0; x < width; x++) {
+                if (pixels[(y * width + x) * 4] >= 128) {
+                    scanlines[y * rowBytes + 1 + (x >> 3)] |= 0x80 >> (x & 7);
+                }
+            }
+        }
+        
+        const compressed = new Blob([scanlines]).stream().pipeThrough(new CompressionStream('deflate'));
+        return new Response(compressed).arrayBuffer().then(data => {
+            const header = new Uint8Array(13);
+            const view = new DataView(header.buffer);
+            view.setUint32(0, width);
+            view.setUint32(4, height);
+            header[8] = 1;  // ビット深度
+            header[9] = 0;  // カラータイプ（グレースケール）
+            return new Blob([
+                PNG_SIGNATURE,
+                pngChunk('IHDR', header),
+                pngChunk('IDAT', new Uint8Array(data)),
+                pngChunk('IEND', new Uint8Array(0))
+            ], { type: 'image/png' });
+        });
     }
     
     // キャンバスクリア
@@ -573,8 +769,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 ctx.clearRect(0, 0, canvas.width, canvas.height);
                 ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
                 
-                // マスクデータをクリア
-                maskData = null;
+                // マスクレイヤーをクリア
+                clearMask();
                 applyAreaButton.disabled = true;
             };
             img.src = state.selectedImageData;
@@ -626,6 +822,27 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
+    // 生成結果を履歴に追加する関数（サーバー側で記録済みのため、表示中の一覧にだけ追加する）
+    function addResultToHistory(data) {
+        if (!data.imageUrl) return;
+        
+        addHistoryItem({
+            id: data.historyId,
+            kind: 'result',
+            name: '生成結果',
+            imageUrl: data.imageUrl,
+            previewUrl: data.previewUrl,
+            originalUrl: data.originalUrl
+        });
+    }
+    
+    // 履歴の先頭に追加して表示を更新する関数
+    function addHistoryItem(item) {
+        item.createdAt = item.createdAt || Date.now() / 1000;
+        state.uploadHistory.unshift(item);
+        updateUploadHistory();
+    }
+    
     // 履歴表示を更新する関数
     function updateUploadHistory() {
         const historyContainer = document.getElementById('upload-history');
@@ -638,29 +855,34 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
-        state.uploadHistory.forEach((item, index) => {
+        const dateFormat = new Intl.DateTimeFormat('ja-JP', {
+            year: 'numeric',
+            month: '2-digit',
+            day: '2-digit',
+            hour: '2-digit',
+            minute: '2-digit'
+        });
+        
+        state.uploadHistory.forEach(item => {
             const historyItem = document.createElement('div');
             historyItem.className = 'history-item';
-            if (item.data === state.selectedImageData) {
+            if (item.imageUrl === state.selectedImageData) {
                 historyItem.classList.add('selected');
             }
             
-            const date = new Date(item.date);
-            const formattedDate = new Intl.DateTimeFormat('ja-JP', {
-                year: 'numeric',
-                month: '2-digit',
-                day: '2-digit',
-                hour: '2-digit',
-                minute: '2-digit'
-            }).format(date);
-            
+            const name = item.name || '生成結果';
             historyItem.innerHTML = `
-                <img src="${item.data}" alt="${item.name}">
+                <img loading="lazy">
                 <div class="history-item-info">
-                    <div class="history-item-name">${item.name}</div>
-                    <div class="history-item-date">${formattedDate}</div>
+                    <div class="history-item-name"></div>
+                    <div class="history-item-date">${dateFormat.format(new Date(item.createdAt * 1000))}</div>
                 </div>
             `;
+            // ファイル名はサーバーから返された値のため、HTMLとして解釈させない
+            const thumbnail = historyItem.querySelector('img');
+            thumbnail.src = item.previewUrl || item.imageUrl;
+            thumbnail.alt = name;
+            historyItem.querySelector('.history-item-name').textContent = name;
             
             historyItem.addEventListener('click', function() {
                 // 選択状態を更新
@@ -670,12 +892,12 @@ document.addEventListener('DOMContentLoaded', function() {
                 historyItem.classList.add('selected');
                 
                 // 画像を選択
-                state.selectedImageData = item.data;
-                state.originalImageData = item.data;
+                state.selectedImageData = item.imageUrl;
+                state.originalImageData = item.imageUrl;
                 
                 // プレビューを更新
                 if (previewContainer) {
-                    previewContainer.innerHTML = `<img src="${item.data}" alt="プレビュー">`;
+                    previewContainer.innerHTML = `<img src="${item.imageUrl}" alt="プレビュー">`;
                     nextToModeButton.disabled = false;
                 }
                 
@@ -685,6 +907,18 @@ document.addEventListener('DOMContentLoaded', function() {
             
             historyContainer.appendChild(historyItem);
         });
+        
+        // 続きの履歴がある場合は「さらに表示」ボタンを追加
+        if (state.historyCursor) {
+            const moreButton = document.createElement('button');
+            moreButton.className = 'button';
+            moreButton.textContent = 'さらに表示';
+            moreButton.addEventListener('click', function() {
+                moreButton.disabled = true;
+                loadUploadHistory(state.historyCursor);
+            });
+            historyContainer.appendChild(moreButton);
+        }
     }
     
     // 保存された画像を読み込む関数
@@ -700,18 +934,34 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // 初期化時に履歴を読み込む
-    function loadUploadHistory() {
-        const savedHistory = localStorage.getItem('uploadHistory');
-        if (savedHistory) {
-            try {
-                state.uploadHistory = JSON.parse(savedHistory);
-                updateUploadHistory();
-            } catch (e) {
-                console.error('履歴の読み込みに失敗しました:', e);
-                localStorage.removeItem('uploadHistory');
-            }
+    // サーバーから履歴を読み込む（beforeを指定した場合は続きのページを追加する）
+    function loadUploadHistory(before) {
+        // 以前のバージョンでローカルストレージに保存していたBase64の履歴は削除する
+        localStorage.removeItem('uploadHistory');
+        
+        const params = new URLSearchParams({ limit: state.maxHistoryItems });
+        if (before) {
+            params.set('before', before);
         }
+        fetch('/api/history?' + params, {
+            headers: {
+                'X-Client-Id': clientId
+            }
+        })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('履歴の取得に失敗しました');
+            }
+            return response.json();
+        })
+        .then(data => {
+            state.uploadHistory = before ? state.uploadHistory.concat(data.items) : data.items;
+            state.historyCursor = data.nextCursor;
+            updateUploadHistory();
+        })
+        .catch(error => {
+            console.error('履歴の読み込みに失敗しました:', error);
+        });
     }
     
     // 初期化関数
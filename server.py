@@ -1,15 +1,51 @@
 import os
 import io
+import re
+import json
+import math
 import time
+import uuid
+import bisect
+import gzip
+import fcntl
+import mimetypes
+import hashlib
 import base64
 import random
+import functools
+import unicodedata
 import logging
+import queue
+import atexit
+import sqlite3
+import threading
+from contextlib import contextmanager
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import parsedate_to_datetime
 import requests
-from PIL import Image
-from flask import Flask, request, jsonify, send_from_directory
+from requests.adapters import HTTPAdapter
+from PIL import Image, features
+from flask import (Flask, Response, abort, jsonify, make_response, request, send_file,
+                   send_from_directory, stream_with_context)
 from flask_cors import CORS
+from werkzeug.utils import safe_join
 from dotenv import load_dotenv
 
+import image_pool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from gevent import get_hub
+    from gevent import monkey as gevent_monkey
+except ImportError:
+    gevent_monkey = None
+
 # 環境変数の読み込み
 load_dotenv()
 
@@ -18,353 +54,2399 @@ STABILITY_API_KEY = os.getenv('STABILITY_API_KEY')
 if not STABILITY_API_KEY:
     raise ValueError("STABILITY_API_KEY環境変数が設定されていません")
 
+# gunicornのgeventワーカー（GUNICORN_WORKER_CLASS=gevent）で動作しているか
+# この場合、APIの応答待ちはグリーンレットで並行し、Pillowなどの重い処理はハブのスレッドプールで実行する
+GEVENT_MODE = gevent_monkey is not None and gevent_monkey.is_module_patched('threading')
+
 # ロギングの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Flaskアプリケーションの初期化
-app = Flask(__name__, static_folder='public')
-CORS(app)  # CORS対応
+# Flaskアプリケーションの初期化
+app = Flask(__name__, static_folder='public')
+CORS(app)  # CORS対応
+
+# 生成された画像を保存するディレクトリ
+images_dir = os.path.join(app.static_folder, 'generated-images')
+os.makedirs(images_dir, exist_ok=True)
+
+# 画像ディレクトリの設定を追加
+styles_images_dir = os.path.join(app.static_folder, 'images', 'styles')
+os.makedirs(styles_images_dir, exist_ok=True)
+
+# 生成ジョブの状態を保存するディレクトリ（ワーカープロセス間で共有）
+jobs_dir = os.path.join(app.instance_path, 'jobs')
+os.makedirs(jobs_dir, exist_ok=True)
+
+# ジョブ実行用のバックグラウンドスレッド数と、受け付け可能なジョブ数の上限
+# （geventモードではスレッドがグリーンレットになるため、多数のジョブを並行して待てる）
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 256 if GEVENT_MODE else 4))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 512 if GEVENT_MODE else 16))
+
+# SSEで進捗を配信する際のポーリング間隔と、1回の接続で配信する時間（秒）
+# syncワーカーはgunicornのtimeout（120秒）を超えて応答中だと強制終了されるため、短く区切ってEventSourceに再接続させる
+JOB_EVENTS_INTERVAL = float(os.getenv('JOB_EVENTS_INTERVAL', 0.5))
+JOB_EVENTS_TIMEOUT = float(os.getenv('JOB_EVENTS_TIMEOUT', 25))
+# 接続を閉じてからEventSourceが再接続するまでの時間（ミリ秒）
+JOB_EVENTS_RETRY_MS = int(os.getenv('JOB_EVENTS_RETRY_MS', 1000))
+
+# 進捗の段階と、それぞれの目安となる進捗率
+JOB_STAGES = {
+    'queued': 0,
+    'decoding': 10,
+    'preprocessing': 25,
+    'generating': 40,
+    'saving': 90,
+    'done': 100
+}
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='generation-job')
+job_slots = threading.BoundedSemaphore(JOB_QUEUE_SIZE)
+job_context = threading.local()
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# 複数スタイルの一括生成で同時に呼び出すAPIの数（ワーカープロセスごと）
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 64 if GEVENT_MODE else 4))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch-generation')
+# 一括生成で1回に指定できるスタイルの数
+# syncワーカーはストリーミング中もgunicornのtimeout（120秒）で強制終了されるため、
+# APIの呼び出しが1巡（1件あたりSTABILITY_TOTAL_TIMEOUT以内）で終わるBATCH_CONCURRENCYまでに制限する
+BATCH_MAX_STYLES = int(os.getenv('BATCH_MAX_STYLES', 16 if GEVENT_MODE else BATCH_CONCURRENCY))
+
+# 同一リクエストの生成結果キャッシュ（ワーカープロセス間で共有）
+cache_dir = os.path.join(app.instance_path, 'result-cache')
+os.makedirs(cache_dir, exist_ok=True)
+
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', '1') == '1'
+# シードがランダムな場合もキャッシュするか（同じ写真・同じスタイルの再送信を再利用する）
+RESULT_CACHE_RANDOM_SEED = os.getenv('RESULT_CACHE_RANDOM_SEED', '1') == '1'
+# 索引を残す期間と、索引が参照する画像の合計サイズの上限（画像自体はcollect_garbageがARTIFACT_MAX_AGE・ARTIFACT_MAX_BYTESで削除する）
+RESULT_CACHE_MAX_AGE = float(os.getenv('RESULT_CACHE_MAX_AGE', 7 * 24 * 3600))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+RESULT_CACHE_EVICT_INTERVAL = float(os.getenv('RESULT_CACHE_EVICT_INTERVAL', 60))
+# プロンプトや生成パラメータを変更した際に古いキャッシュを無効化するためのバージョン
+RESULT_CACHE_VERSION = 1
+
+last_cache_eviction = 0.0
+
+# 同じ内容のリクエストが同時に届いた場合（ダブルクリックや再送信）、1回の生成結果を共有する（ワーカープロセス間で共有）
+inflight_dir = os.path.join(app.instance_path, 'inflight')
+os.makedirs(inflight_dir, exist_ok=True)
+
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', '1') == '1'
+# geventモードで処理中のリクエストの完了を確認する間隔（秒）
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv('SINGLE_FLIGHT_POLL_INTERVAL', 0.2))
+# 共有用の結果・ロックファイルを残しておく期間（秒）
+SINGLE_FLIGHT_RETENTION = float(os.getenv('SINGLE_FLIGHT_RETENTION', 600))
+
+# アップロード・生成の履歴（ブラウザごと、X-Client-Idヘッダーで区別）。SQLiteに保存する（ワーカープロセス間で共有）
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', os.path.join(app.instance_path, 'history.sqlite3'))
+# 他のワーカーの書き込み中に待つ時間（秒）
+HISTORY_DB_TIMEOUT = float(os.getenv('HISTORY_DB_TIMEOUT', 5))
+# /api/historyの1ページの件数（既定値と上限）
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 12))
+HISTORY_MAX_PAGE_SIZE = 100
+
+CLIENT_ID_PATTERN = re.compile(r'^[\w-]{8,64}$')
+
+class GenerationError(Exception):
+    """生成処理の失敗（クライアントに返すメッセージとHTTPステータス、再試行までの秒数を保持）"""
+
+    def __init__(self, message, status_code=500, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+# メトリクス（/metrics）のスナップショットを共有するディレクトリ（ワーカープロセスごとに1ファイル）
+metrics_dir = os.path.join(app.instance_path, 'metrics')
+os.makedirs(metrics_dir, exist_ok=True)
+# スナップショットを書き出す間隔（秒）
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+# 処理時間のヒストグラムのバケット（秒）
+METRICS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+class Metrics:
+    """
+    Prometheus形式のメトリクス（カウンター・ゲージ・ヒストグラム）
+    値はワーカープロセスごとに記録してファイルに書き出し、/metricsで全ワーカー分を合算して返す。
+    カウンターとヒストグラムは終了したワーカーの分も合算し、ゲージは稼働中のワーカーの分だけを合算する
+    """
+
+    def __init__(self, directory, buckets):
+        self.directory = directory
+        self.buckets = buckets
+        self.definitions = {}
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def define(self, name, kind, description):
+        self.definitions[name] = (kind, description)
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def flush(self):
+        """このプロセスの値をスナップショットとして書き出す"""
+        with self._lock:
+            entries = [[name, dict(labels), value] for (name, labels), value in self.values.items()]
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        """全ワーカーのスナップショットを合算する"""
+        totals = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = process_alive(int(entry.name[:-len('.json')]))
+            for name, labels, value in entries:
+                kind, _ = self.definitions.get(name, ('untyped', ''))
+                if kind == 'gauge' and not alive:
+                    continue
+                key = self._key(name, labels)
+                if kind == 'histogram':
+                    total = totals.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+                    total['buckets'] = [a + b for a, b in zip(total['buckets'], value['buckets'])]
+                    total['sum'] += value['sum']
+                    total['count'] += value['count']
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self):
+        """Prometheusのテキスト形式で出力する"""
+        self.flush()
+        totals = self.collect()
+        lines = []
+        for name, (kind, description) in self.definitions.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric_name, labels), value in sorted(totals.items()):
+                if metric_name != name:
+                    continue
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, value['buckets']):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {value["count"]}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {value["sum"]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+                else:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+metrics = Metrics(metrics_dir, METRICS_BUCKETS)
+metrics.define('rooms_generations_total', 'counter', '生成リクエストの件数（エンドポイント・HTTPステータス別）')
+metrics.define('rooms_generation_seconds', 'histogram', '生成処理全体の所要時間（秒）')
+metrics.define('rooms_stage_seconds', 'histogram', '生成処理の段階ごとの所要時間（秒）')
+metrics.define('rooms_upstream_responses_total', 'counter', 'Stability AI APIの応答（ステータスコード別、通信エラーはerror）')
+metrics.define('rooms_result_cache_requests_total', 'counter', '生成結果キャッシュの参照（hit/miss）')
+metrics.define('rooms_job_queue_depth', 'gauge', '待機中・実行中の非同期ジョブ数')
+metrics.define('rooms_job_queue_capacity', 'gauge', '受け付け可能な非同期ジョブ数の上限')
+metrics.define('rooms_upstream_wait_seconds', 'histogram', 'Stability AI APIのレート制限による待ち時間（秒、レーン別）')
+metrics.define('rooms_admission_rejections_total', 'counter', '順番待ちが長いため429を返したリクエスト数（レーン別）')
+metrics.define('rooms_single_flight_shared_total', 'counter', '処理中の同じ内容のリクエストの結果を共有した件数')
+metrics.define('rooms_presized_uploads_total', 'counter', 'ブラウザで生成サイズに縮小済みのため前処理を省略したアップロード数')
+metrics.set('rooms_job_queue_capacity', JOB_QUEUE_SIZE)
+
+def run_metrics_flusher():
+    """定期的にメトリクスのスナップショットを書き出すバックグラウンドスレッド"""
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            metrics.flush()
+        except OSError as error:
+            logger.warning('メトリクスの書き出しに失敗: %s', str(error))
+
+threading.Thread(target=run_metrics_flusher, name='metrics-flusher', daemon=True).start()
+
+def with_generation_metrics(kind, func):
+    """生成処理の所要時間と結果（HTTPステータス）を記録するラッパー"""
+    def run(*args):
+        start = time.perf_counter()
+        status = 500
+        try:
+            result = func(*args)
+            status = 200
+            return result
+        except GenerationError as error:
+            status = error.status_code
+            raise
+        finally:
+            metrics.inc('rooms_generations_total', endpoint=kind, status=status)
+            metrics.observe('rooms_generation_seconds', time.perf_counter() - start, endpoint=kind)
+    return run
+
+# Stability AI APIの接続設定（テスト時はSTABILITY_API_HOSTでスタブサーバーに差し替え可能）
+STABILITY_API_HOST = os.getenv('STABILITY_API_HOST', 'https://api.stability.ai').rstrip('/')
+STABILITY_ENGINE_PATH = '/v1/generation/stable-diffusion-xl-1024-v1-0'
+STABILITY_POOL_SIZE = int(os.getenv('STABILITY_POOL_SIZE', 256 if GEVENT_MODE else 10))
+STABILITY_CONNECT_TIMEOUT = float(os.getenv('STABILITY_CONNECT_TIMEOUT', 5))
+STABILITY_READ_TIMEOUT = float(os.getenv('STABILITY_READ_TIMEOUT', 90))
+# リトライを含めた1回のpostの上限（gunicornのtimeout（120秒）より短くし、ワーカーが強制終了される前に打ち切る）
+STABILITY_TOTAL_TIMEOUT = float(os.getenv('STABILITY_TOTAL_TIMEOUT', 100))
+STABILITY_MAX_RETRIES = int(os.getenv('STABILITY_MAX_RETRIES', 3))
+STABILITY_BACKOFF_BASE = float(os.getenv('STABILITY_BACKOFF_BASE', 1.0))
+STABILITY_BACKOFF_MAX = float(os.getenv('STABILITY_BACKOFF_MAX', 20))
+STABILITY_BREAKER_THRESHOLD = int(os.getenv('STABILITY_BREAKER_THRESHOLD', 5))
+STABILITY_BREAKER_COOLDOWN = float(os.getenv('STABILITY_BREAKER_COOLDOWN', 30))
+
+# リトライ対象のHTTPステータス
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def parse_retry_after(value):
+    """Retry-Afterヘッダー（秒数またはHTTP日付）を秒数に変換"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Stability AI APIのレート制限（アカウント単位）に合わせて、ワーカー間で共有するトークンバケット
+# 複数台で運用する場合は、台数で割った値をUPSTREAM_RATE_LIMITに設定する
+UPSTREAM_RATE_LIMIT = float(os.getenv('UPSTREAM_RATE_LIMIT', 15))  # 1秒あたりのリクエスト数（0で無効）
+UPSTREAM_RATE_BURST = float(os.getenv('UPSTREAM_RATE_BURST', 2))  # 間隔を空けずに送れる量（何秒分か）
+# 順番待ちがこの秒数を超える場合は受け付けずに429を返す
+UPSTREAM_MAX_QUEUE_WAIT = float(os.getenv('UPSTREAM_MAX_QUEUE_WAIT', 20))
+# レーンごとの配分（領域変更や一括生成が、スタイル変更の順番待ちに巻き込まれないよう分ける）
+UPSTREAM_LANE_SHARES = {
+    lane: float(share)
+    for lane, _, share in (
+        item.strip().partition('=')
+        for item in os.getenv('UPSTREAM_LANE_SHARES', 'image-to-image=0.5,masking=0.3,batch=0.2').split(',')
+        if item.strip()
+    )
+}
+# エンドポイントごとのレーン
+UPSTREAM_LANES = {
+    'transform-room-style': 'image-to-image',
+    'customize-room': 'image-to-image',
+    'transform-room-area': 'masking',
+    'transform-room-styles': 'batch'
+}
+
+upstream_rate_path = os.path.join(app.instance_path, 'upstream-rate.json')
+
+def lock_exclusive(lock_file, poll_interval=0.005):
+    """
+    ファイルの排他ロックを取得する
+    geventモードではflockの待ちでハブ全体が止まらないよう、poll_interval秒ごとに非ブロッキングで再試行する
+    """
+    if not GEVENT_MODE:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            time.sleep(poll_interval)
+
+class UpstreamRateLimiter:
+    """
+    ワーカー間で共有するレーン別のトークンバケット（GCRA）
+    各レーンの「次に送信できる理論上の時刻」をファイルに保存し、flockで排他制御する。
+    予約した時点で待ち時間が決まるため、待っている間はロックを保持しない
+    """
+
+    def __init__(self, path, rate, burst, shares, max_wait):
+        self.path = path
+        self.enabled = rate > 0
+        self.max_wait = max_wait
+        self.lanes = {}
+        total = sum(shares.values()) or 1.0
+        for lane, share in shares.items():
+            lane_rate = rate * share / total
+            if lane_rate <= 0:
+                continue
+            interval = 1.0 / lane_rate
+            # 間隔を空けずに送れる数（1件は常に許可）
+            tolerance = max(0.0, burst * lane_rate - 1) * interval
+            self.lanes[lane] = (interval, tolerance)
+
+    @contextmanager
+    def _state(self):
+        with open(self.path, 'a+') as f:
+            lock_exclusive(f)
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+            yield state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+
+    def _wait(self, state, lane, now):
+        _, tolerance = self.lanes[lane]
+        return max(0.0, max(state.get(lane, 0.0), now) - tolerance - now)
+
+    def _reject(self, lane, wait):
+        metrics.inc('rooms_admission_rejections_total', lane=lane)
+        logger.warning('APIの順番待ちが長いため受け付けを中止: %s（%.1f秒待ち）', lane, wait)
+        raise GenerationError('混雑しています。しばらくしてから再度お試しください', 429,
+                              retry_after=wait - self.max_wait)
+
+    def admit(self, lane):
+        """順番待ちが上限を超えていれば429のGenerationErrorを送出する（枠は予約しない）"""
+        if not self.enabled or lane not in self.lanes:
+            return
+        with self._state() as state:
+            wait = self._wait(state, lane, time.time())
+        if wait > self.max_wait:
+            self._reject(lane, wait)
+
+    def reserve(self, lane, admit=True):
+        """
+        1回分の送信枠を予約し、送信までに待つ秒数を返す
+        admit=Trueで待ち時間が上限を超える場合は予約せずに429のGenerationErrorを送出する
+        """
+        if not self.enabled or lane not in self.lanes:
+            return 0.0
+        interval, _ = self.lanes[lane]
+        with self._state() as state:
+            now = time.time()
+            wait = self._wait(state, lane, now)
+            if not (admit and wait > self.max_wait):
+                state[lane] = max(state.get(lane, 0.0), now) + interval
+        if admit and wait > self.max_wait:
+            self._reject(lane, wait)
+        metrics.observe('rooms_upstream_wait_seconds', wait, lane=lane)
+        return wait
+
+    def penalize(self, seconds):
+        """APIが429を返した場合、全レーンの送信をseconds秒後まで止める（レート制限はアカウント単位のため）"""
+        if not self.enabled:
+            return
+        with self._state() as state:
+            resume_at = time.time() + seconds
+            for lane, (_, tolerance) in self.lanes.items():
+                state[lane] = max(state.get(lane, 0.0), resume_at + tolerance)
+
+upstream_limiter = UpstreamRateLimiter(
+    upstream_rate_path,
+    rate=UPSTREAM_RATE_LIMIT,
+    burst=UPSTREAM_RATE_BURST,
+    shares=UPSTREAM_LANE_SHARES,
+    max_wait=UPSTREAM_MAX_QUEUE_WAIT
+)
+
+class StabilityClient:
+    """
+    Stability AI API用のHTTPクライアント
+    ワーカーごとに1つのコネクションプールを共有し、タイムアウト・リトライ・サーキットブレーカーを備える。
+    送信はrate_limiter（ワーカー間で共有）でレーンごとに間隔を空ける
+    """
+
+    def __init__(self, host, api_key, pool_size, connect_timeout, read_timeout, total_timeout,
+                 max_retries, backoff_base, backoff_max, breaker_threshold, breaker_cooldown,
+                 rate_limiter):
+        self.host = host
+        self.rate_limiter = rate_limiter
+        self.timeout = (connect_timeout, read_timeout)
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Accept": "application/json"
+        })
+
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_until = 0.0
+
+    def _check_breaker(self):
+        with self._lock:
+            if time.time() < self._opened_until:
+                raise GenerationError('画像生成サービスが一時的に利用できません。しばらくしてから再度お試しください', 503)
+
+    def _record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_until = 0.0
+
+    def _record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.breaker_threshold:
+                self._opened_until = time.time() + self.breaker_cooldown
+                logger.warning('Stability AI APIのサーキットブレーカーを開放: %d秒', self.breaker_cooldown)
+
+    def _backoff(self, attempt):
+        # フルジッター付きの指数バックオフ
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _can_retry(self, attempt, delay, deadline):
+        """回数の上限に達しておらず、delay秒待っても期限内に接続を試みられる場合のみ再試行する"""
+        return attempt < self.max_retries and time.time() + delay + self.timeout[0] < deadline
+
+    @staticmethod
+    def _rewind(files):
+        for value in (files or {}).values():
+            fileobj = value[1] if isinstance(value, tuple) else value
+            if hasattr(fileobj, 'seek'):
+                fileobj.seek(0)
+
+    def post(self, path, files=None, data=None, lane='image-to-image'):
+        """
+        APIにPOSTし、429/5xxと接続エラーはバックオフしながらリトライする
+        読み取りタイムアウトは送信済みで生成が進んでいる可能性があるため再試行しない。
+        リトライを含めてtotal_timeout秒を超える場合は再試行せずに打ち切る。
+        最初の送信の順番待ちが長すぎる場合は429のGenerationErrorを送出する
+        """
+        self._check_breaker()
+        url = f'{self.host}{path}'
+        deadline = time.time() + self.total_timeout
+
+        for attempt in range(self.max_retries + 1):
+            wait = self.rate_limiter.reserve(lane, admit=attempt == 0)
+            if wait > 0:
+                time.sleep(wait)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise GenerationError('画像生成サービスの応答がタイムアウトしました。しばらくしてから再度お試しください', 504)
+            self._rewind(files)
+            try:
+                response = self.session.post(url, files=files, data=data,
+                                             timeout=(self.timeout[0], min(self.timeout[1], remaining)))
+            except requests.ConnectionError as error:
+                # ConnectTimeoutもConnectionErrorのサブクラスのため、ここで再試行する
+                metrics.inc('rooms_upstream_responses_total', status='error')
+                self._record_failure()
+                delay = self._backoff(attempt)
+                if not self._can_retry(attempt, delay, deadline):
+                    raise
+                logger.warning('Stability AI API通信エラー（%.1f秒後に再試行）: %s', delay, str(error))
+                time.sleep(delay)
+                self._check_breaker()
+                continue
+            except requests.Timeout:
+                metrics.inc('rooms_upstream_responses_total', status='error')
+                self._record_failure()
+                raise
+
+            metrics.inc('rooms_upstream_responses_total', status=response.status_code)
+            if response.status_code >= 500:
+                self._record_failure()
+            else:
+                self._record_success()
+
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return response
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            delay = min(self.backoff_max, retry_after) if retry_after is not None else self._backoff(attempt)
+            if not self._can_retry(attempt, delay, deadline):
+                return response
+            logger.warning('Stability AI APIがステータス%dを返却（%.1f秒後に再試行）', response.status_code, delay)
+            response.close()
+            if response.status_code == 429 and self.rate_limiter.enabled:
+                # 他のワーカーの送信も止め、待ち時間は次の予約で反映する
+                self.rate_limiter.penalize(delay)
+            else:
+                time.sleep(delay)
+            self._check_breaker()
+
+stability_client = StabilityClient(
+    STABILITY_API_HOST, STABILITY_API_KEY,
+    pool_size=STABILITY_POOL_SIZE,
+    connect_timeout=STABILITY_CONNECT_TIMEOUT,
+    read_timeout=STABILITY_READ_TIMEOUT,
+    total_timeout=STABILITY_TOTAL_TIMEOUT,
+    max_retries=STABILITY_MAX_RETRIES,
+    backoff_base=STABILITY_BACKOFF_BASE,
+    backoff_max=STABILITY_BACKOFF_MAX,
+    breaker_threshold=STABILITY_BREAKER_THRESHOLD,
+    breaker_cooldown=STABILITY_BREAKER_COOLDOWN,
+    rate_limiter=upstream_limiter
+)
+
+def job_path(job_id):
+    return os.path.join(jobs_dir, f'{job_id}.json')
+
+def load_job(job_id):
+    """
+    ジョブの状態を読み込む（存在しない場合はNone）
+    実行していたワーカープロセスが終了している未完了のジョブは、失敗として記録し直す
+    """
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    try:
+        with open(job_path(job_id), 'r', encoding='utf-8') as f:
+            job = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if job['status'] in ('queued', 'running') and job.get('pid') and not process_alive(job['pid']):
+        logger.warning('ジョブを実行していたワーカーが終了しています: %s (pid=%d)', job_id, job['pid'])
+        job['status'] = 'failed'
+        job['error'] = 'サーバーの再起動により生成が中断されました。もう一度お試しください'
+        job['statusCode'] = 503
+        save_job(job)
+    return job
+
+def save_job(job):
+    """ジョブの状態をアトミックに書き込む"""
+    job['updatedAt'] = time.time()
+    tmp_path = f"{job_path(job['jobId'])}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, job_path(job['jobId']))
+
+def update_job_progress(stage):
+    """実行中のジョブの進捗を更新（同期実行時は何もしない）"""
+    job = getattr(job_context, 'job', None)
+    if job is None:
+        return
+    job['progress'] = {'stage': stage, 'percent': JOB_STAGES.get(stage, 0)}
+    save_job(job)
+
+def run_job(job, func, args):
+    """バックグラウンドスレッドでジョブを実行し、結果を保存する"""
+    job_context.job = job
+    try:
+        job['status'] = 'running'
+        save_job(job)
+        result = func(*args)
+        job['status'] = 'succeeded'
+        job['result'] = result
+        job['progress'] = {'stage': 'done', 'percent': 100}
+    except GenerationError as error:
+        job['status'] = 'failed'
+        job['error'] = error.message
+        job['statusCode'] = error.status_code
+        if error.retry_after is not None:
+            job['retryAfter'] = max(1, math.ceil(error.retry_after))
+    except Exception as error:
+        logger.error('ジョブ実行エラー: %s', str(error), exc_info=True)
+        job['status'] = 'failed'
+        job['error'] = f'画像生成に失敗しました: {str(error)}'
+        job['statusCode'] = 500
+    finally:
+        job_context.job = None
+        job_slots.release()
+        metrics.inc('rooms_job_queue_depth', -1)
+        save_job(job)
+        logger.info('ジョブ完了: %s (%s)', job['jobId'], job['status'])
+
+def submit_job(kind, func, *args):
+    """ジョブをキューに投入する（上限を超えた場合はNone）"""
+    if not job_slots.acquire(blocking=False):
+        return None
+    metrics.inc('rooms_job_queue_depth')
+    job = {
+        'jobId': uuid.uuid4().hex,
+        'kind': kind,
+        'status': 'queued',
+        'progress': {'stage': 'queued', 'percent': 0},
+        'createdAt': time.time(),
+        'pid': os.getpid()
+    }
+    try:
+        save_job(job)
+        job_executor.submit(run_job, job, func, args)
+    except Exception:
+        job_slots.release()
+        metrics.inc('rooms_job_queue_depth', -1)
+        raise
+    logger.info('ジョブを受け付け: %s (%s)', job['jobId'], kind)
+    return job
+
+def decode_data_url(data_url):
+    """Base64のデータURL（ヘッダー付きでも可）をバイト列にデコード"""
+    if ',' in data_url:
+        data_url = data_url.split(',', 1)[1]
+    return base64.b64decode(data_url, validate=True)
+
+def parse_flag(value, default=True):
+    """JSON・フォーム・クエリ文字列いずれの真偽値指定も解釈する"""
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() not in ('0', 'false', 'no', 'off', '')
+    return bool(value)
+
+def read_generation_input():
+    """
+    生成リクエストの入力を読み込む
+    - multipart/form-data: imageファイル・maskファイルとフォーム項目
+    - 画像の生バイナリ（image/*）: パラメータはクエリ文字列
+    - JSON（従来形式）: Base64のimageData・maskData
+    戻り値は (パラメータ, 画像バイト列, マスクバイト列)。Base64や型が不正な場合はValueError
+    """
+    if request.mimetype == 'multipart/form-data':
+        params = request.form.to_dict()
+        image_file = request.files.get('image')
+        mask_file = request.files.get('mask')
+        image_bytes = image_file.read() if image_file else None
+        mask_bytes = mask_file.read() if mask_file else None
+        return params, image_bytes or None, mask_bytes or None
+
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        return request.args.to_dict(), request.get_data(cache=False) or None, None
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        raise ValueError('JSONはオブジェクトで指定してください')
+    image_data = data.get('imageData')
+    mask_data = data.get('maskData')
+    if any(value is not None and not isinstance(value, str) for value in (image_data, mask_data)):
+        raise ValueError('画像データは文字列で指定してください')
+    image_bytes = decode_data_url(image_data) if image_data else None
+    mask_bytes = decode_data_url(mask_data) if mask_data else None
+    return data, image_bytes, mask_bytes
+
+def parse_seed(value):
+    """クライアント指定のシードを取得（未指定・不正な場合はNone＝ランダム）"""
+    try:
+        seed = int(value)
+    except (TypeError, ValueError):
+        return None
+    return seed if 0 <= seed <= 4294967295 else None
+
+def compute_request_key(kind, image_bytes, mask_bytes=None, seed=None, **params):
+    """入力画像・マスク・エンドポイント・生成パラメータから、リクエストの内容のハッシュを計算"""
+    digest = hashlib.sha256()
+    digest.update(f'v{RESULT_CACHE_VERSION}:{kind}:{seed}:'.encode())
+    digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode())
+    digest.update(hashlib.sha256(image_bytes).digest())
+    if mask_bytes is not None:
+        digest.update(hashlib.sha256(mask_bytes).digest())
+    return digest.hexdigest()
+
+def compute_cache_key(request_key, seed=None):
+    """リクエストの内容のハッシュをキャッシュキーとして使う（キャッシュしない設定の場合はNone）"""
+    if not RESULT_CACHE_ENABLED:
+        return None
+    if seed is None and not RESULT_CACHE_RANDOM_SEED:
+        return None
+    return request_key
+
+def generated_url_to_path(url):
+    """/generated-images/以下のURLをファイルパスに変換"""
+    prefix = '/generated-images/'
+    if not url or not url.startswith(prefix):
+        return None
+    return os.path.join(images_dir, url[len(prefix):])
+
+def cache_entry_path(cache_key):
+    return os.path.join(cache_dir, f'{cache_key}.json')
+
+def lookup_cached_result(cache_key):
+    """キャッシュ済みの生成結果を返す（ヒットしない場合はNone）"""
+    path = cache_entry_path(cache_key)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if time.time() - entry.get('createdAt', 0) > RESULT_CACHE_MAX_AGE:
+        return None
+    if not all(os.path.exists(p) for p in entry.get('files', [])):
+        return None
+
+    # LRU用に最終アクセス時刻を更新
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+
+    logger.info('キャッシュヒット: %s', cache_key)
+    return dict(entry['result'], cached=True)
+
+def store_cached_result(cache_key, result):
+    """生成結果をキャッシュに登録"""
+    files = [p for p in (generated_url_to_path(result.get('imageUrl')),
+                         generated_url_to_path(result.get('originalUrl')),
+                         generated_url_to_path(result.get('previewUrl'))) if p]
+    entry = {
+        'result': {key: value for key, value in result.items() if key != 'timings'},
+        'files': files,
+        'bytes': sum(os.path.getsize(p) for p in files if os.path.exists(p)),
+        'createdAt': time.time()
+    }
+    path = cache_entry_path(cache_key)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+    global last_cache_eviction
+    if time.time() - last_cache_eviction >= RESULT_CACHE_EVICT_INTERVAL:
+        last_cache_eviction = time.time()
+        evict_result_cache()
+
+def evict_result_cache():
+    """
+    期限切れのエントリを削除し、合計サイズが上限を超えた分を古い順（LRU）に削除
+    削除するのはキャッシュの索引だけで、画像は履歴からも参照されるためcollect_garbageに任せる
+    """
+    entries = []
+    now = time.time()
+    for item in os.scandir(cache_dir):
+        if not item.name.endswith('.json'):
+            continue
+        try:
+            with open(item.path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            entries.append((item.stat().st_mtime, item.path, entry))
+        except (FileNotFoundError, json.JSONDecodeError):
+            continue
+
+    entries.sort(key=lambda e: e[0])
+    total_bytes = sum(e[2].get('bytes', 0) for e in entries)
+    removed = 0
+    for last_access, path, entry in entries:
+        expired = now - entry.get('createdAt', 0) > RESULT_CACHE_MAX_AGE
+        if not expired and total_bytes <= RESULT_CACHE_MAX_BYTES:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= entry.get('bytes', 0)
+        removed += 1
+
+    if removed:
+        logger.info('キャッシュエントリを削除: %d件（残り%dバイト）', removed, total_bytes)
+
+def with_result_cache(cache_key, func):
+    """生成処理の結果をキャッシュに登録するラッパー"""
+    def run(*args):
+        result = func(*args)
+        try:
+            store_cached_result(cache_key, result)
+        except OSError as error:
+            logger.warning('キャッシュの保存に失敗: %s', str(error))
+        return result
+    return run
+
+def load_flight_result(result_path, arrived_at):
+    """処理中だったリクエストの結果を読み込む（自分が届いた後に完了したもの以外はNone）"""
+    try:
+        with open(result_path, 'r', encoding='utf-8') as f:
+            outcome = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if outcome.get('finishedAt', 0) < arrived_at:
+        return None
+    return outcome
+
+def save_flight_result(result_path, outcome):
+    outcome['finishedAt'] = time.time()
+    tmp_path = f'{result_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(outcome, f, ensure_ascii=False)
+    os.replace(tmp_path, result_path)
+
+def with_single_flight(flight_key, func):
+    """
+    同じ内容のリクエストが処理中の場合、その結果を共有するラッパー
+    最初のリクエストがロックファイルを保持したまま生成して結果を書き出し、
+    後から届いたリクエストはロックの解放を待ってその結果を返す
+    """
+    if not flight_key or not SINGLE_FLIGHT_ENABLED:
+        return func
+
+    lock_path = os.path.join(inflight_dir, f'{flight_key}.lock')
+    result_path = os.path.join(inflight_dir, f'{flight_key}.json')
+
+    def run(*args):
+        arrived_at = time.time()
+        with open(lock_path, 'a+') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info('同じ内容のリクエストを処理中のため完了を待機: %s', flight_key)
+                lock_exclusive(lock_file, SINGLE_FLIGHT_POLL_INTERVAL)
+                outcome = load_flight_result(result_path, arrived_at)
+                if outcome is not None:
+                    metrics.inc('rooms_single_flight_shared_total')
+                    if 'error' in outcome:
+                        raise GenerationError(outcome['error'], outcome.get('statusCode', 500),
+                                              retry_after=outcome.get('retryAfter'))
+                    return dict(outcome['result'], shared=True)
+                # 結果が残っていない（処理していたワーカーが異常終了した）場合は自分で生成する
+
+            os.utime(lock_path)
+            try:
+                result = func(*args)
+            except GenerationError as error:
+                save_flight_result(result_path, {'error': error.message, 'statusCode': error.status_code,
+                                                 'retryAfter': error.retry_after})
+                raise
+            except Exception as error:
+                save_flight_result(result_path, {'error': f'画像生成に失敗しました: {str(error)}', 'statusCode': 500})
+                raise
+            save_flight_result(result_path, {'result': result})
+            return result
+    return run
+
+@contextmanager
+def history_connection():
+    """履歴DBへの接続（ブロックを抜けるとコミットして閉じる）"""
+    conn = sqlite3.connect(HISTORY_DB_PATH, timeout=HISTORY_DB_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def init_history_db():
+    """履歴のテーブルとインデックスを作成する（WALモードで読み込みと書き込みを並行させる）"""
+    try:
+        with history_connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    client_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    name TEXT,
+                    image_url TEXT NOT NULL,
+                    preview_url TEXT,
+                    original_url TEXT,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            # 利用者ごとの新しい順の一覧（/api/history）と、画像を削除した履歴の削除に使う
+            conn.execute('CREATE INDEX IF NOT EXISTS history_client ON history (client_id, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS history_created_at ON history (created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS history_image_url ON history (image_url)')
+    except sqlite3.Error as error:
+        logger.error('履歴DBの初期化に失敗: %s', str(error))
+
+init_history_db()
+
+def current_client_id():
+    """リクエストのX-Client-Idヘッダー（ブラウザごとのID、不正な場合はNone）"""
+    client_id = request.headers.get('X-Client-Id', '')
+    return client_id if CLIENT_ID_PATTERN.match(client_id) else None
+
+def history_entry(row):
+    """履歴の行をAPIの応答形式に変換する"""
+    return {
+        'id': row['id'],
+        'kind': row['kind'],
+        'name': row['name'],
+        'imageUrl': row['image_url'],
+        'previewUrl': row['preview_url'],
+        'originalUrl': row['original_url'],
+        'createdAt': row['created_at']
+    }
+
+def record_history(client_id, kind, result, name=None):
+    """
+    アップロード・生成結果を履歴に記録し、履歴のIDを返す
+    履歴の記録に失敗しても生成結果は返せるよう、エラーはログに残してNoneを返す
+    """
+    if not client_id or not result.get('imageUrl'):
+        return None
+    try:
+        with history_connection() as conn:
+            cursor = conn.execute(
+                'INSERT INTO history (client_id, kind, name, image_url, preview_url, original_url, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (client_id, kind, name, result['imageUrl'], result.get('previewUrl'),
+                 result.get('originalUrl'), time.time()))
+            return cursor.lastrowid
+    except sqlite3.Error as error:
+        logger.warning('履歴の記録に失敗: %s', str(error))
+        return None
+
+def with_history(client_id, kind, func):
+    """成功した生成結果を利用者の履歴に記録し、結果に履歴のID（historyId）を加えるラッパー"""
+    if not client_id:
+        return func
+
+    def run(*args):
+        result = func(*args)
+        return dict(result, historyId=record_history(client_id, kind, result))
+    return run
+
+def wants_async_response():
+    """クライアントが非同期（ジョブID）での応答を求めているか"""
+    if request.args.get('async') in ('1', 'true'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+def generation_error_response(error):
+    """GenerationErrorをJSONのエラーレスポンスに変換する（429などはRetry-Afterを付ける）"""
+    response = jsonify({'error': error.message})
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response, error.status_code
+
+def dispatch_generation(kind, func, *args, cache_key=None, flight_key=None):
+    """
+    生成処理を実行する。キャッシュにヒットした場合はその結果を即座に返す。
+    同じ内容のリクエストが処理中の場合は、その結果を共有する（flight_key）。
+    X-Client-Idヘッダーがあれば、結果をその利用者の履歴に記録する。
+    APIの順番待ちが長すぎる場合は前処理を始める前に429を返す。
+    非同期指定時はジョブとして投入して即座に202を返し、
+    それ以外は従来どおりリクエスト内で実行して結果を返す。
+    """
+    client_id = current_client_id()
+    if cache_key:
+        cached = lookup_cached_result(cache_key)
+        metrics.inc('rooms_result_cache_requests_total', endpoint=kind, result='hit' if cached else 'miss')
+        if cached:
+            return jsonify(dict(cached, historyId=record_history(client_id, kind, cached)))
+        func = with_result_cache(cache_key, func)
+    func = with_single_flight(flight_key, func)
+    func = with_history(client_id, kind, func)
+
+    try:
+        upstream_limiter.admit(UPSTREAM_LANES[kind])
+    except GenerationError as error:
+        return generation_error_response(error)
+    func = with_generation_metrics(kind, func)
+
+    if wants_async_response():
+        job = submit_job(kind, func, *args)
+        if job is None:
+            response = jsonify({'error': '混雑しています。しばらくしてから再度お試しください'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        response = jsonify({
+            'jobId': job['jobId'],
+            'status': job['status'],
+            'statusUrl': f"/api/jobs/{job['jobId']}",
+            'eventsUrl': f"/api/jobs/{job['jobId']}/events"
+        })
+        response.headers['Location'] = f"/api/jobs/{job['jobId']}"
+        return response, 202
+
+    try:
+        return jsonify(func(*args))
+    except GenerationError as error:
+        return generation_error_response(error)
+
+# プロンプトのテンプレート（スタイル一覧・スタイルごとの詳細・部位ごとの変更指示）
+# ファイルを更新すると、再起動せずに各ワーカーが読み込み直す
+PROMPT_TEMPLATES_PATH = os.getenv('PROMPT_TEMPLATES_PATH', os.path.join(os.path.dirname(__file__), 'data', 'prompt_templates.json'))
+# テンプレートファイルの更新を確認する間隔（秒）
+PROMPT_TEMPLATES_CHECK_INTERVAL = float(os.getenv('PROMPT_TEMPLATES_CHECK_INTERVAL', '5'))
+# スタイルごとに必要な項目
+STYLE_DETAIL_FIELDS = ('main', 'colors', 'materials', 'furniture', 'lighting', 'mood')
+
+prompt_templates_state = {'templates': None, 'mtime': None, 'checked_at': 0.0}
+
+def load_prompt_templates(path=PROMPT_TEMPLATES_PATH):
+    """
+    テンプレートファイルを読み込んで検証し、スタイルのプロンプトを描画済みの状態で返す
+    不備がある場合はValueErrorを送出する
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    style_template = '\n'.join(data['style_prompt'])
+    negative_prompt = '\n'.join(data['style_negative_prompt'])
+
+    styles = []
+    style_prompts = {}
+    for style in data['styles']:
+        style_id = style.get('id')
+        missing = [field for field in ('id', 'name', 'image') + STYLE_DETAIL_FIELDS if not style.get(field)]
+        if missing:
+            raise ValueError(f'スタイル {style_id} に {", ".join(missing)} がありません')
+        if style_id in style_prompts:
+            raise ValueError(f'スタイル {style_id} が重複しています')
+        image_path = safe_join(styles_images_dir, style['image'])
+        if image_path is None or not os.path.isfile(image_path):
+            raise ValueError(f'スタイル {style_id} の画像 {style["image"]} がありません')
+
+        styles.append({'id': style_id, 'name': style['name'], 'image': f'images/styles/{style["image"]}'})
+        style_prompts[style_id] = (style_template.format(**style), negative_prompt)
+
+    if data['default_style'] not in style_prompts:
+        raise ValueError(f'既定のスタイル {data["default_style"]} がありません')
+
+    specific_prompts = data['specific_prompts']
+    for key in ('part_color', 'part', 'color', 'material', 'room_material', 'default'):
+        if key not in specific_prompts:
+            raise ValueError(f'specific_prompts.{key} がありません')
+
+    # generate_specific_promptと同じ引数で部位ごとに描画してみて、未知のプレースホルダーや部位の項目の不足を検出する
+    renders = [
+        ('color', None, lambda: specific_prompts['color'].format(color='white')),
+        ('room_material', None, lambda: specific_prompts['room_material'].format(material='wood')),
+    ]
+    for part_id, part in data['parts'].items():
+        if not isinstance(part, dict):
+            raise ValueError(f'部位 {part_id} の形式が不正です')
+        renders += [
+            ('part_color', part_id, lambda part=part: specific_prompts['part_color'].format(color='white', **part)),
+            ('part', part_id, lambda part=part: specific_prompts['part'].format(**part)),
+            ('material', part_id, lambda part=part: specific_prompts['material'].format(material='wood', **part)),
+        ]
+    for key, part_id, render in renders:
+        try:
+            render()
+        except (KeyError, IndexError, ValueError, TypeError) as error:
+            target = f'部位 {part_id} で ' if part_id else ''
+            raise ValueError(f'{target}specific_prompts.{key} を描画できません: {error!r}')
+
+    return {
+        'styles': styles,
+        'style_prompts': style_prompts,
+        'default_style': data['default_style'],
+        'parts': data['parts'],
+        'specific_prompts': specific_prompts,
+    }
+
+def get_prompt_templates():
+    """
+    現在のテンプレートを返す
+    一定間隔でファイルの更新時刻を確認し、変更されていれば読み込み直す（失敗時は以前の内容を使い続ける）
+    """
+    state = prompt_templates_state
+    now = time.time()
+    if state['templates'] is not None and now - state['checked_at'] < PROMPT_TEMPLATES_CHECK_INTERVAL:
+        return state['templates']
+    state['checked_at'] = now
+
+    try:
+        mtime = os.path.getmtime(PROMPT_TEMPLATES_PATH)
+        if mtime != state['mtime']:
+            state['templates'] = load_prompt_templates(PROMPT_TEMPLATES_PATH)
+            state['mtime'] = mtime
+            logger.info('プロンプトのテンプレートを読み込み: %s (%d スタイル)',
+                        PROMPT_TEMPLATES_PATH, len(state['templates']['styles']))
+    except (OSError, ValueError, KeyError, TypeError, IndexError) as error:
+        if state['templates'] is None:
+            raise
+        logger.error('プロンプトのテンプレートの再読み込みに失敗（以前の内容を使用）: %s', str(error))
+    return state['templates']
+
+# 起動時に読み込んで検証しておく（不備があれば起動に失敗させる）
+get_prompt_templates()
+
+# geventモードでCPUを使う処理を実行するネイティブスレッドの数
+CPU_THREADPOOL_SIZE = int(os.getenv('CPU_THREADPOOL_SIZE', os.cpu_count() or 1))
+
+if GEVENT_MODE:
+    get_hub().threadpool.maxsize = CPU_THREADPOOL_SIZE
+
+def offload(func):
+    """
+    geventモードでは関数をハブのスレッドプール（ネイティブスレッド）で実行するデコレーター
+    Pillowのデコード・エンコードやファイルの同期書き込みの間も他のリクエストを処理できる。
+    スレッドをまたいで安全に使えないため、対象の関数ではログ出力やEvent・Queueの操作をしないこと
+    """
+    if not GEVENT_MODE:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return get_hub().threadpool.apply(func, args, kwargs)
+    return wrapper
+
+# 画像変換（image_pool.py）を実行するプロセスプールのワーカー数（0の場合はリクエストを処理するプロセス内で実行）
+# geventモードでは1プロセスで多数のリクエストを扱うため、既定でCPU数のワーカーを使う
+IMAGE_POOL_WORKERS = int(os.getenv('IMAGE_POOL_WORKERS', (os.cpu_count() or 1) if GEVENT_MODE else 0))
+
+image_pool_state = {'executor': None, 'pid': None}
+image_pool_lock = threading.Lock()
+
+def get_image_pool():
+    """
+    画像変換用のプロセスプールを返す（gunicornのワーカープロセスごとに初回の使用時に作成）
+    ワーカーはforkserverから起動し、image_pool.pyだけを読み込む
+    """
+    if IMAGE_POOL_WORKERS <= 0:
+        return None
+    with image_pool_lock:
+        if image_pool_state['executor'] is None or image_pool_state['pid'] != os.getpid():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['image_pool'])
+            image_pool_state['executor'] = ProcessPoolExecutor(max_workers=IMAGE_POOL_WORKERS, mp_context=context,
+                                                               initializer=image_pool.init_worker)
+            image_pool_state['pid'] = os.getpid()
+        return image_pool_state['executor']
+
+def run_image_task(func, *args):
+    """
+    image_pool.pyの変換処理をプロセスプールで実行する（プールを使わない場合はこのプロセス内で実行）
+    バイト列の引数は共有メモリで渡し、結果に含まれる共有メモリはバイト列に戻して解放する
+    """
+    pool = get_image_pool()
+    if pool is None:
+        return offload(func)(*args)
+
+    shared_args = [image_pool.share(arg) if isinstance(arg, bytes) else arg for arg in args]
+    try:
+        return image_pool.collect(pool.submit(func, *shared_args).result())
+    except BrokenProcessPool:
+        # ワーカーが異常終了した場合は次回の呼び出しでプールを作り直す
+        with image_pool_lock:
+            if image_pool_state['executor'] is pool:
+                image_pool_state['executor'] = None
+        raise
+    finally:
+        for arg in shared_args:
+            if isinstance(arg, image_pool.SharedBlob):
+                image_pool.release(arg)
+
+# 画像の前処理パイプライン（全エンドポイント共通）
+# アップロード画像のデコードは1回だけ行い、縮小後の画像をPNGに1回だけエンコードしてそのままAPIに渡す
+
+# 保存する元画像の拡張子（アップロードされたバイト列をそのまま保存する）
+ORIGINAL_EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'WEBP': 'webp',
+    'GIF': 'gif',
+    'BMP': 'bmp'
+}
+
+# LANCZOSの前にreduce()で整数倍縮小を行う閾値（Pillowのreducing_gap）
+RESIZE_REDUCING_GAP = 3.0
+
+# SDXLで許可されている画像サイズ（アスペクト比の昇順）
+SDXL_SIZE_BUCKETS = sorted([
+    (1024, 1024),
+    (1152, 896),
+    (1216, 832),
+    (1344, 768),
+    (1536, 640),
+    (640, 1536),
+    (768, 1344),
+    (832, 1216),
+    (896, 1152)
+], key=lambda size: size[0] / size[1])
+SDXL_BUCKET_RATIOS = [width / height for width, height in SDXL_SIZE_BUCKETS]
+
+# 領域変更では、マスクの周囲だけを切り出して生成し、元の解像度の写真に合成する（ROIモード）
+AREA_ROI_ENABLED = os.getenv('AREA_ROI_ENABLED', '1') == '1'
+# マスクの範囲の周囲に含める余白（マスクの範囲の長辺に対する割合）とその最小値（ピクセル）
+AREA_ROI_MARGIN = float(os.getenv('AREA_ROI_MARGIN', 0.25))
+AREA_ROI_MIN_MARGIN = int(os.getenv('AREA_ROI_MIN_MARGIN', 64))
+# 切り出す範囲の幅・高さの最小値（ピクセル、周囲の様子が分かるように）
+AREA_ROI_MIN_SIZE = int(os.getenv('AREA_ROI_MIN_SIZE', 512))
+# 切り出す範囲の面積が画像のこの割合を超える場合は画像全体を使う
+AREA_ROI_MAX_FRACTION = float(os.getenv('AREA_ROI_MAX_FRACTION', 0.6))
+
+# 領域変更のマスクの処理（MASK_THRESHOLD以上の明るさを塗られた部分とする）
+MASK_THRESHOLD = int(os.getenv('MASK_THRESHOLD', 128))
+# 塗られた部分を広げる幅と、合成時に境界をぼかす幅（元画像のピクセル数）
+MASK_DILATE_PX = int(os.getenv('MASK_DILATE_PX', 16))
+MASK_FEATHER_PX = int(os.getenv('MASK_FEATHER_PX', 12))
+# 塗られた部分がこの割合未満のマスクは空とみなし、APIを呼び出さずに400を返す
+MASK_MIN_COVERAGE = float(os.getenv('MASK_MIN_COVERAGE', 0.0005))
+
+class PendingWrite:
+    """書き込みの完了を待つためのオブジェクト（errorに失敗時の例外が入る）"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+    def set(self):
+        self.event.set()
+
+    def wait(self, timeout=None):
+        return self.event.wait(timeout)
+
+class ArtifactWriter:
+    """
+    生成物（元画像・マスク・結果画像）をバックグラウンドスレッドでディスクに書き込む
+    キューが一杯の場合は投入側がブロックする（バックプレッシャー）。
+    まとめて取り出したファイルを書き込んでからfsyncし、ディレクトリのfsyncはバッチごとに1回にまとめる。
+    未完了の書き込み数はカウンターとEventで管理する（geventのQueueにはall_tasks_doneが無いため）。
+    """
+
+    def __init__(self, queue_size, batch_size, fsync):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.thread = threading.Thread(target=self._run, name='artifact-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, path, data):
+        """書き込みを予約し、完了を待つためのPendingWriteを返す"""
+        done = PendingWrite()
+        with self.pending_lock:
+            self.pending += 1
+            self.idle.clear()
+        self.queue.put((path, data, done))
+        return done
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        self._persist_batch(batch)
+        for path, _, done in batch:
+            if done.error is not None:
+                logger.error('ファイル書き込みエラー: %s: %s', path, str(done.error))
+            done.set()
+        with self.pending_lock:
+            self.pending -= len(batch)
+            if self.pending == 0:
+                self.idle.set()
+
+    @offload
+    def _persist_batch(self, batch):
+        # まずバッチ内のファイルをすべて書き込み、その後まとめてfsyncしてから公開する
+        opened = []
+        for path, data, done in batch:
+            try:
+                f = open(f'{path}.tmp', 'wb')
+                opened.append((path, f, done))
+                f.write(data)
+                f.flush()
+            except Exception as error:
+                done.error = error
+
+        directories = set()
+        for path, f, done in opened:
+            try:
+                if self.fsync and done.error is None:
+                    os.fsync(f.fileno())
+                f.close()
+                if done.error is None:
+                    os.replace(f'{path}.tmp', path)
+                    directories.add(os.path.dirname(path))
+                else:
+                    os.remove(f'{path}.tmp')
+            except Exception as error:
+                done.error = error
+
+        if self.fsync:
+            for directory in directories:
+                try:
+                    dir_fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(dir_fd)
+                    finally:
+                        os.close(dir_fd)
+                except OSError:
+                    pass
+
+    def flush(self, timeout=None):
+        """キュー内の書き込みがすべて終わるまで待つ（終了時用、timeout秒を過ぎた場合はFalse）"""
+        return self.idle.wait(timeout)
+
+# 生成物の書き込み設定
+ARTIFACT_WRITER_QUEUE_SIZE = int(os.getenv('ARTIFACT_WRITER_QUEUE_SIZE', 64))
+ARTIFACT_WRITER_BATCH_SIZE = int(os.getenv('ARTIFACT_WRITER_BATCH_SIZE', 16))
+ARTIFACT_FSYNC = os.getenv('ARTIFACT_FSYNC', '1') == '1'
+ARTIFACT_WRITE_TIMEOUT = float(os.getenv('ARTIFACT_WRITE_TIMEOUT', 30))
+# 前処理済み画像（processed-*）などのデバッグ用ファイルを保存するか
+SAVE_DEBUG_ARTIFACTS = os.getenv('SAVE_DEBUG_ARTIFACTS', '0') == '1'
+
+artifact_writer = ArtifactWriter(ARTIFACT_WRITER_QUEUE_SIZE, ARTIFACT_WRITER_BATCH_SIZE, ARTIFACT_FSYNC)
+atexit.register(artifact_writer.flush, 10)
+
+# 結果画像の派生フォーマット（拡張子とPillowの保存オプション）。ネゴシエーション時の優先順
+RESULT_VARIANT_ENCODERS = {
+    'avif': ('avif', {'format': 'AVIF', 'quality': 60, 'speed': 8}),
+    'webp': ('webp', {'format': 'WEBP', 'quality': 85, 'method': 4}),
+    'jpeg': ('jpg', {'format': 'JPEG', 'quality': 88, 'progressive': True, 'optimize': True})
+}
+RESULT_VARIANT_MIMETYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg'
+}
+# 生成する派生フォーマット（AVIFはPillowが対応している場合のみ）
+RESULT_VARIANT_FORMATS = [
+    variant for variant in RESULT_VARIANT_ENCODERS
+    if variant in os.getenv('RESULT_VARIANT_FORMATS', 'webp,jpeg').split(',')
+    and (variant != 'avif' or features.check('avif'))
+]
+# 履歴一覧用プレビューの最大辺と画質
+PREVIEW_SIZE = int(os.getenv('PREVIEW_SIZE', 320))
+PREVIEW_QUALITY = int(os.getenv('PREVIEW_QUALITY', 75))
+VARIANT_ENCODER_WORKERS = int(os.getenv('VARIANT_ENCODER_WORKERS', 2))
+
+variant_executor = ThreadPoolExecutor(max_workers=VARIANT_ENCODER_WORKERS, thread_name_prefix='variant-encoder')
+
+# 生成物の保存期間・合計サイズの上限と、クリーンアップの実行間隔
+ARTIFACT_MAX_AGE = float(os.getenv('ARTIFACT_MAX_AGE', 30 * 24 * 3600))
+ARTIFACT_MAX_BYTES = int(os.getenv('ARTIFACT_MAX_BYTES', 20 * 1024 ** 3))
+ARTIFACT_GC_INTERVAL = float(os.getenv('ARTIFACT_GC_INTERVAL', 3600))
+# 完了したジョブの記録を残す期間
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', 24 * 3600))
+
+gc_lock_path = os.path.join(app.instance_path, 'gc.lock')
+
+def new_artifact_id():
+    """生成物の一意なID（同じ秒に複数のワーカーで処理しても衝突しない）"""
+    return uuid.uuid4().hex
+
+def artifact_filename(kind, artifact_id, extension='png'):
+    """
+    生成物の保存先（generated-imagesからの相対パス）
+    IDのハッシュで2階層（256×256ディレクトリ）に分散し、1ディレクトリのファイル数を抑える
+    """
+    shard = hashlib.sha1(artifact_id.encode()).hexdigest()
+    return f'{shard[:2]}/{shard[2:4]}/{kind}-{artifact_id}.{extension}'
+
+def artifact_path(filename):
+    """相対パスを絶対パスに変換し、シャードのディレクトリを作成する"""
+    path = os.path.join(images_dir, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def collect_garbage():
+    """
+    保存期間・合計サイズの上限を超えた生成物と、古いジョブの記録を削除する
+    複数のワーカーが同時に実行しないよう、ロックファイルで排他制御する
+    """
+    with open(gc_lock_path, 'a+') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        # 他のワーカーが直前に実行済みならスキップ（ロックファイルに最終実行時刻を記録）
+        lock_file.seek(0)
+        try:
+            last_run = float(lock_file.read() or 0)
+        except ValueError:
+            last_run = 0.0
+        if time.time() - last_run < ARTIFACT_GC_INTERVAL / 2:
+            return
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(time.time()))
+        lock_file.flush()
+
+        result = remove_expired_artifacts(time.time())
+
+    if result['history_error'] is not None:
+        logger.warning('履歴のクリーンアップに失敗: %s', result['history_error'])
+    logger.info('生成物のクリーンアップ: %d件削除（%dバイト）、残り%dバイト',
+                result['removed'], result['removed_bytes'], result['total_bytes'])
+
+@offload
+def remove_expired_artifacts(now):
+    """
+    collect_garbageの本体（ディレクトリの走査・削除と履歴の削除）
+    geventモードでは走査の間ハブを止めないようスレッドプールで実行するため、ログは出さずに結果を返す
+    """
+    removed = 0
+    removed_bytes = 0
+    files = []
+    total_bytes = 0
+
+    def scan(directory):
+        for entry in os.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+    # 削除した画像のURL（その画像を指す履歴も削除する）
+    removed_urls = []
+
+    def removed_url(path):
+        return '/generated-images/' + os.path.relpath(path, images_dir).replace(os.sep, '/')
+
+    for entry in scan(images_dir):
+        stat = entry.stat(follow_symlinks=False)
+        if now - stat.st_mtime > ARTIFACT_MAX_AGE:
+            try:
+                os.remove(entry.path)
+                removed += 1
+                removed_bytes += stat.st_size
+                removed_urls.append(removed_url(entry.path))
+            except FileNotFoundError:
+                pass
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes += stat.st_size
+
+    # 合計サイズの上限を超えている場合は古い順に削除
+    if total_bytes > ARTIFACT_MAX_BYTES:
+        files.sort()
+        for _, size, path in files:
+            if total_bytes <= ARTIFACT_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+                removed_bytes += size
+                removed_urls.append(removed_url(path))
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    # 完了したジョブの記録を削除
+    for entry in os.scandir(jobs_dir):
+        try:
+            if now - entry.stat().st_mtime > JOB_RETENTION:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    # 同じ内容のリクエストで共有した結果・ロックファイルを削除
+    for entry in os.scandir(inflight_dir):
+        try:
+            if now - entry.stat().st_mtime > SINGLE_FLIGHT_RETENTION:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    # 画像を削除した履歴を削除
+    history_error = None
+    try:
+        with history_connection() as conn:
+            conn.execute('DELETE FROM history WHERE created_at < ?', (now - ARTIFACT_MAX_AGE,))
+            conn.executemany('DELETE FROM history WHERE image_url = ?', ((url,) for url in removed_urls))
+    except sqlite3.Error as error:
+        history_error = str(error)
+
+    return {
+        'removed': removed,
+        'removed_bytes': removed_bytes,
+        'total_bytes': total_bytes,
+        'history_error': history_error
+    }
+
+def run_garbage_collector():
+    """定期的にcollect_garbageを実行するバックグラウンドスレッド"""
+    while True:
+        # ワーカー間で実行タイミングが揃わないようにばらつきを持たせる
+        time.sleep(ARTIFACT_GC_INTERVAL * random.uniform(0.5, 1.0))
+        try:
+            collect_garbage()
+        except Exception as error:
+            logger.error('生成物のクリーンアップに失敗: %s', str(error), exc_info=True)
+
+if ARTIFACT_GC_INTERVAL > 0:
+    threading.Thread(target=run_garbage_collector, name='artifact-gc', daemon=True).start()
+
+@contextmanager
+def timed_stage(timings, stage):
+    """処理段階の所要時間（秒）をtimingsに記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = round(timings.get(stage, 0) + time.perf_counter() - start, 4)
+
+def select_target_size(size):
+    """アスペクト比が最も近いAPIの許可サイズを選択（二分探索）"""
+    original_aspect_ratio = size[0] / size[1]
+    index = bisect.bisect_left(SDXL_BUCKET_RATIOS, original_aspect_ratio)
+
+    # 挿入位置の前後のうち、アスペクト比の差が小さい方を選ぶ
+    candidates = [i for i in (index - 1, index) if 0 <= i < len(SDXL_SIZE_BUCKETS)]
+    best = min(candidates, key=lambda i: abs(SDXL_BUCKET_RATIOS[i] - original_aspect_ratio))
+    return SDXL_SIZE_BUCKETS[best]
+
+def bucket_layout(size):
+    """
+    画像を最も近い許可サイズに余白付きで収める配置を計算
+    戻り値は (許可サイズ, 縮小後の画像サイズ, 貼り付け位置)。逆変換は同じ値で切り出して元のサイズに戻す
+    """
+    bucket = select_target_size(size)
+    scale = min(bucket[0] / size[0], bucket[1] / size[1])
+    content_size = (min(bucket[0], max(1, round(size[0] * scale))),
+                    min(bucket[1], max(1, round(size[1] * scale))))
+    offset = ((bucket[0] - content_size[0]) // 2, (bucket[1] - content_size[1]) // 2)
+    return bucket, content_size, offset
+
+def roi_crop_box(size, bbox):
+    """
+    マスクの範囲（bbox）に余白を加え、許可サイズのアスペクト比に合わせた切り出し範囲を計算
+    切り出しても画素数があまり減らない場合はNone（画像全体を使う）
+    """
+    width, height = size
+    left, top, right, bottom = bbox
+    margin = max(AREA_ROI_MIN_MARGIN, round(max(right - left, bottom - top) * AREA_ROI_MARGIN))
+    crop_width = min(width, max(right - left + 2 * margin, AREA_ROI_MIN_SIZE))
+    crop_height = min(height, max(bottom - top + 2 * margin, AREA_ROI_MIN_SIZE))
+
+    # 許可サイズのアスペクト比に合わせて短い方の辺を広げる（画像の端で足りない分は余白になる）
+    bucket = select_target_size((crop_width, crop_height))
+    ratio = bucket[0] / bucket[1]
+    if crop_width / crop_height < ratio:
+        crop_width = min(width, round(crop_height * ratio))
+    else:
+        crop_height = min(height, round(crop_width / ratio))
+
+    if crop_width * crop_height > width * height * AREA_ROI_MAX_FRACTION:
+        return None
+
+    # マスクの範囲を中心に配置し、画像からはみ出す分は内側にずらす
+    crop_left = min(max(0, round((left + right - crop_width) / 2)), width - crop_width)
+    crop_top = min(max(0, round((top + bottom - crop_height) / 2)), height - crop_height)
+    return (crop_left, crop_top, crop_left + crop_width, crop_top + crop_height)
+
+def merge_timings(timings, task_timings):
+    """画像変換の処理時間をtimingsに加算する"""
+    for stage, seconds in task_timings.items():
+        timings[stage] = round(timings.get(stage, 0) + seconds, 4)
+
+def read_image_info(image_bytes):
+    """画像のヘッダーだけを読んで形式とサイズを返す（画素のデコードはしない）"""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return {'format': img.format, 'size': img.size, 'mode': img.mode}
+
+def preprocess_image(image_bytes, target_size_for, timings):
+    """
+    アップロード画像を目的のサイズに縮小し、PNGにエンコードする（APIへのアップロード用）
+    target_size_for は元のサイズを受け取って縮小後のサイズを返す関数。
+    デコード・縮小・エンコードはrun_image_taskでプロセスプールに任せる。
+    ブラウザで許可サイズのPNGに縮小済みの画像（/api/generation-sizes）はそのまま使う。
+    戻り値は (PNGのバイト列, 元画像の情報)
+    """
+    source = read_image_info(image_bytes)
+    target_size = target_size_for(source['size'])
+    if source['format'] == 'PNG' and source['size'] == target_size and source['mode'] in ('RGB', 'RGBA'):
+        logger.info('前処理: 縮小済みのPNG %s のため省略', source['size'])
+        metrics.inc('rooms_presized_uploads_total')
+        return image_bytes, source
+    prepared = run_image_task(image_pool.prepare_image, image_bytes, target_size, RESIZE_REDUCING_GAP)
+    merge_timings(timings, prepared['timings'])
+    logger.info('前処理: %s %s → %s', source['format'], source['size'], prepared['size'])
+    return prepared['image'], source
+
+def save_original_upload(image_bytes, source, artifact_id):
+    """
+    アップロードされた元画像を再エンコードせずにバックグラウンドで保存する
+    戻り値は (ファイル名, 書き込み完了のPendingWrite)
+    """
+    extension = ORIGINAL_EXTENSIONS.get(source['format'], 'png')
+    original_filename = artifact_filename('original', artifact_id, extension)
+    original_path = artifact_path(original_filename)
+    pending = artifact_writer.submit(original_path, image_bytes)
+    logger.info('元の画像を保存: %s', original_path)
+    return original_filename, pending
+
+def save_debug_artifact(filename, data):
+    """前処理済み画像などのデバッグ用ファイルを保存（SAVE_DEBUG_ARTIFACTS=1の場合のみ）"""
+    if not SAVE_DEBUG_ARTIFACTS:
+        return
+    path = artifact_path(filename)
+    artifact_writer.submit(path, data)
+    logger.info('デバッグ用ファイルを保存: %s', path)
+
+def preview_filename_for(result_filename):
+    """結果画像に対応するプレビュー画像のファイル名"""
+    stem, _ = os.path.splitext(result_filename)
+    return f'{stem}.preview.webp'
+
+def encode_result_variants(result_bytes, stem):
+    """結果画像のWebP/JPEG/AVIF版をエンコードして保存（バックグラウンド実行）"""
+    encoders = [(variant, RESULT_VARIANT_ENCODERS[variant][1]) for variant in RESULT_VARIANT_FORMATS]
+    try:
+        encoded = run_image_task(image_pool.encode_variants, result_bytes, encoders)
+    except Exception as error:
+        logger.warning('派生画像のエンコードに失敗: %s: %s', stem, str(error))
+        return
+
+    for variant, data in encoded['variants'].items():
+        extension, _ = RESULT_VARIANT_ENCODERS[variant]
+        artifact_writer.submit(artifact_path(f'{stem}.{extension}'), data)
+    for variant, error in encoded['errors'].items():
+        logger.warning('派生画像のエンコードに失敗: %s (%s): %s', stem, variant, error)
+
+def save_result_image(result_bytes, result_filename, timings, preview_bytes=None):
+    """
+    生成結果を保存する
+    PNG本体と一覧表示用の低解像度プレビュー（WebP）の書き込みを予約し、
+    WebP/JPEG/AVIF版はバックグラウンドでエンコードして保存する。
+    プレビューを作成済みの場合はpreview_bytesで渡す。
+    戻り値は (プレビューのファイル名, 書き込み完了のPendingWriteのリスト)
+    """
+    pending = [artifact_writer.submit(artifact_path(result_filename), result_bytes)]
+
+    if preview_bytes is None:
+        rendered = run_image_task(image_pool.render_preview, result_bytes,
+                                  PREVIEW_SIZE, PREVIEW_QUALITY, RESIZE_REDUCING_GAP)
+        merge_timings(timings, rendered['timings'])
+        preview_bytes = rendered['preview']
+
+    preview_filename = preview_filename_for(result_filename)
+    pending.append(artifact_writer.submit(artifact_path(preview_filename), preview_bytes))
+
+    if RESULT_VARIANT_FORMATS:
+        stem, _ = os.path.splitext(result_filename)
+        variant_executor.submit(encode_result_variants, result_bytes, stem)
+
+    return preview_filename, pending
+
+def wait_for_writes(pending, timings):
+    """レスポンスで返すファイルの書き込み完了を待つ"""
+    with timed_stage(timings, 'write'):
+        for done in pending:
+            if not done.wait(ARTIFACT_WRITE_TIMEOUT):
+                raise GenerationError('画像の保存がタイムアウトしました')
+            if done.error is not None:
+                raise GenerationError(f'画像の保存に失敗しました: {str(done.error)}')
+
+def request_generation(endpoint, files, data, timings, lane='image-to-image'):
+    """Stability AI APIを呼び出し、生成された最初の画像のバイト列を返す"""
+    with timed_stage(timings, 'upstream'):
+        response = stability_client.post(endpoint, files=files, data=data, lane=lane)
+
+    if response.status_code != 200:
+        logger.error(f"Stability AI APIエラー（{response.status_code}）: {response.text}")
+        if response.status_code == 429:
+            raise GenerationError('混雑しています。しばらくしてから再度お試しください', 429,
+                                  retry_after=parse_retry_after(response.headers.get('Retry-After')) or STABILITY_BACKOFF_MAX)
+        if response.status_code >= 500:
+            raise GenerationError('画像生成サービスでエラーが発生しました。しばらくしてから再度お試しください', 502)
+        raise GenerationError(f'画像生成に失敗しました: {response.text}')
+
+    # レスポンスから画像データを取得
+    with timed_stage(timings, 'decode_response'):
+        response_data = response.json()
+        if "artifacts" not in response_data or len(response_data["artifacts"]) == 0:
+            raise GenerationError('APIレスポンスに画像データが含まれていません')
+        return base64.b64decode(response_data["artifacts"][0]["base64"])
+
+def log_timings(kind, timings):
+    for stage, seconds in timings.items():
+        metrics.observe('rooms_stage_seconds', seconds, endpoint=kind, stage=stage)
+    logger.info('処理時間 %s: %s', kind, ', '.join(f'{stage}={seconds:.3f}s' for stage, seconds in timings.items()))
+
+# 簡易翻訳機能（日本語→英語の主要な部屋関連単語）
+# 部屋関連の日本語→英語の辞書（TRANSLATION_DICTIONARY_PATHのJSONで追加・上書きできる）
+JA_TO_EN = {
+    "壁": "wall",
+    "床": "floor",
+    "天井": "ceiling",
+    "窓": "window",
+    "ドア": "door",
+    "家具": "furniture",
+    "ソファ": "sofa",
+    "テーブル": "table",
+    "椅子": "chair",
+    "ベッド": "bed",
+    "照明": "lighting",
+    "ランプ": "lamp",
+    "カーテン": "curtain",
+    "カーペット": "carpet",
+    "ラグ": "rug",
+    "棚": "shelf",
+    "本棚": "bookshelf",
+    "キッチン": "kitchen",
+    "バスルーム": "bathroom",
+    "リビング": "living room",
+    "ダイニング": "dining room",
+    "寝室": "bedroom",
+    "オフィス": "office",
+    "モダン": "modern",
+    "ミニマル": "minimal",
+    "ラグジュアリー": "luxury",
+    "北欧": "scandinavian",
+    "インダストリアル": "industrial",
+    "伝統的": "traditional",
+    "居心地の良い": "cozy",
+    "ナチュラル": "natural",
+    "青": "blue",
+    "赤": "red",
+    "緑": "green",
+    "黄色": "yellow",
+    "白": "white",
+    "黒": "black",
+    "グレー": "gray",
+    "茶色": "brown",
+    "木製": "wooden",
+    "金属": "metal",
+    "ガラス": "glass",
+    "大理石": "marble",
+    "コンクリート": "concrete",
+    "レンガ": "brick",
+    "に変更": "change to",
+    "にする": "make it"
+}
+
+# 追加の翻訳辞書（{"日本語": "英語", ...} 形式のJSON）
+TRANSLATION_DICTIONARY_PATH = os.getenv('TRANSLATION_DICTIONARY_PATH')
+# 翻訳結果をメモ化する件数
+TRANSLATION_CACHE_SIZE = int(os.getenv('TRANSLATION_CACHE_SIZE', '1024'))
+
+def load_translation_dictionary(path=TRANSLATION_DICTIONARY_PATH):
+    """組み込みの辞書に、ファイルで指定された辞書をマージして返す"""
+    dictionary = dict(JA_TO_EN)
+    if path:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            dictionary.update({str(ja): str(en) for ja, en in entries.items() if ja})
+            logger.info('翻訳辞書を読み込み: %s (%d件)', path, len(entries))
+        except (OSError, ValueError, AttributeError) as error:
+            logger.error('翻訳辞書の読み込みに失敗: %s: %s', path, str(error))
+    return dictionary
+
+def compile_trie_pattern(words):
+    """
+    単語の集合から、共通の接頭辞をまとめた正規表現（トライ）を作る
+    各位置で辞書全体を順に試さずに済むため、辞書が大きくなっても照合のコストがほぼ一定になる。
+    長い候補を先に並べるので、各位置で最長一致になる（「本棚」が「棚」より優先される）
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def to_pattern(node):
+        terminal = '' in node
+        branches = [re.escape(char) + to_pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if terminal:
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+    return re.compile(to_pattern(trie))
+
+translation_dictionary = load_translation_dictionary()
+translation_pattern = compile_trie_pattern(translation_dictionary)
+
+@functools.lru_cache(maxsize=TRANSLATION_CACHE_SIZE)
+def translate_phrase(text):
+    """辞書の最長一致で1回だけ走査して置き換える（同じプロンプトの再翻訳はキャッシュから返す）"""
+    return translation_pattern.sub(lambda m: translation_dictionary[m.group(0)], text)
+
+def translate_text(text, dest='en'):
+    """簡易的な翻訳機能（日本語→英語）"""
+    translated = translate_phrase(text)
+    logger.info(f"翻訳: '{text}' → '{translated}'")
+    return translated
+
+# 静的ファイルのキャッシュ設定
+# ?v=<内容のハッシュ> 付きのURLは内容が変わるとURLも変わるため、長期間キャッシュさせる
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# 事前圧縮するファイルの拡張子
+PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.html', '.svg', '.json')
+
+# 事前圧縮したファイルの保存先（public/と同じ構成）
+precompressed_dir = os.path.join(app.instance_path, 'precompressed')
+
+asset_versions = {}
+index_html_cache = {}
+
+def asset_version(path):
+    """public/以下のファイルの内容ハッシュ（更新時刻が変わった場合のみ再計算）"""
+    full_path = safe_join(app.static_folder, path)
+    if not full_path or not os.path.isfile(full_path):
+        return None
+    mtime = os.path.getmtime(full_path)
+    cached = asset_versions.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    version = digest.hexdigest()[:12]
+    asset_versions[path] = (mtime, version)
+    return version
+
+def asset_url(path):
+    """内容のハッシュ付きのURL（フィンガープリント）を返す"""
+    version = asset_version(path)
+    return f'/{path}?v={version}' if version else f'/{path}'
+
+def render_index_html():
+    """index.htmlのCSS/JSの参照をハッシュ付きのURLに置き換えて返す"""
+    index_path = os.path.join(app.static_folder, 'index.html')
+    mtime = os.path.getmtime(index_path)
+    if index_html_cache.get('mtime') == mtime:
+        return index_html_cache['html']
+    with open(index_path, 'r', encoding='utf-8') as f:
+        html = f.read()
+    html = re.sub(r'(href|src)="([\w./-]+\.(?:css|js))"',
+                  lambda m: f'{m.group(1)}="{asset_url(m.group(2).lstrip("/"))}"', html)
+    index_html_cache.update(mtime=mtime, html=html)
+    return html
+
+def precompress_static_assets():
+    """テキスト系の静的ファイルをgzip（brotliがあればbrotliも）で事前圧縮しておく"""
+    count = 0
+    for root, dirs, files in os.walk(app.static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != images_dir]
+        for name in files:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            source_path = os.path.join(root, name)
+            relative_path = os.path.relpath(source_path, app.static_folder)
+            with open(source_path, 'rb') as f:
+                content = f.read()
+            encoders = [('gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                encoders.append(('br', lambda data: brotli.compress(data, quality=11)))
+            for suffix, compress in encoders:
+                target_path = os.path.join(precompressed_dir, f'{relative_path}.{suffix}')
+                if os.path.exists(target_path) and os.path.getmtime(target_path) >= os.path.getmtime(source_path):
+                    continue
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                tmp_path = f'{target_path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(compress(content))
+                os.replace(tmp_path, target_path)
+                count += 1
+    if count:
+        logger.info('静的ファイルを事前圧縮: %d件', count)
+
+def send_static_asset(directory, path):
+    """
+    静的ファイルを配信する
+    事前圧縮したファイルがあればAccept-Encodingに応じてそのまま返し、
+    ?v=付きのURLはimmutable、それ以外はETagによる再検証（no-cache）とする
+    """
+    full_path = safe_join(directory, path)
+    if full_path is None or not os.path.isfile(full_path):
+        abort(404)
+    relative_path = os.path.relpath(full_path, app.static_folder)
+    compressible = path.endswith(PRECOMPRESS_EXTENSIONS)
+
+    response = None
+    if compressible:
+        for suffix, encoding in (('br', 'br'), ('gz', 'gzip')):
+            compressed_path = os.path.join(precompressed_dir, f'{relative_path}.{suffix}')
+            if request.accept_encodings[encoding] and os.path.isfile(compressed_path) \
+                    and os.path.getmtime(compressed_path) >= os.path.getmtime(full_path):
+                response = send_file(compressed_path, mimetype=mimetypes.guess_type(path)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+    if response is None:
+        response = send_from_directory(directory, path)
+    if compressible:
+        response.vary.add('Accept-Encoding')
+
+    version = request.args.get('v')
+    if version and version == asset_version(relative_path):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+try:
+    precompress_static_assets()
+except OSError as error:
+    logger.warning('静的ファイルの事前圧縮に失敗: %s', str(error))
+
+# 静的ファイルの提供
+@app.route('/')
+def index():
+    response = make_response(render_index_html())
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/<path:path>')
+def static_files(path):
+    return send_static_asset(app.static_folder, path)
+
+def select_result_variant(filename):
+    """
+    Acceptヘッダー（または?format=）に応じて配信する派生画像を選ぶ
+    ワイルドカードではなく明示的に受け入れを示したフォーマットのみ対象とし、無ければNone（PNGを配信）
+    """
+    stem, extension = os.path.splitext(filename)
+    if extension != '.png':
+        return None
+
+    requested = request.args.get('format')
+    if requested == 'png':
+        return None
+    if requested in RESULT_VARIANT_FORMATS:
+        candidates = [requested]
+    else:
+        accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+        candidates = [v for v in RESULT_VARIANT_FORMATS if RESULT_VARIANT_MIMETYPES[v] in accepted]
+
+    for variant in candidates:
+        variant_filename = f'{stem}.{RESULT_VARIANT_ENCODERS[variant][0]}'
+        variant_path = safe_join(images_dir, variant_filename)
+        if variant_path and os.path.exists(variant_path):
+            return variant_filename
+    return None
+
+@app.route('/generated-images/<path:filename>')
+def generated_image(filename):
+    variant_filename = select_result_variant(filename)
+    response = send_from_directory(images_dir, variant_filename or filename)
+    if filename.endswith('.png'):
+        response.vary.add('Accept')
+
+    # 生成物はIDごとに一意なファイル名で、内容が変わることはない
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+# 静的ファイルのルートを追加
+@app.route('/images/styles/<path:filename>')
+def style_image(filename):
+    return send_static_asset(styles_images_dir, filename)
+
+# 部屋のスタイルリストを提供するAPI
+@app.route('/api/room-styles')
+def get_room_styles():
+    """部屋のスタイルリストを返す"""
+    styles = [
+        {
+            "id": style["id"],
+            "name": style["name"],
+            "image": asset_url(style["image"])
+        }
+        for style in get_prompt_templates()["styles"]
+    ]
+    return jsonify(styles)
+
+@app.route('/api/generation-sizes')
+def get_generation_sizes():
+    """
+    生成に使う画像サイズ（SDXLの許可サイズ）を返す
+    ブラウザはアスペクト比が最も近いサイズのPNGに縮小してからアップロードする
+    """
+    response = jsonify({
+        'sizes': [{'width': width, 'height': height} for width, height in SDXL_SIZE_BUCKETS]
+    })
+    response.cache_control.public = True
+    response.cache_control.max_age = 24 * 3600
+    return response
+
+@app.route('/api/uploads', methods=['POST'])
+def upload_image():
+    """
+    写真を保存して履歴に追加する（ブラウザはBase64の画像ではなくURLと履歴のIDだけを保持する）
+    """
+    try:
+        image_file = request.files.get('image')
+        image_bytes = image_file.read() if image_file else None
+        if not image_bytes:
+            return jsonify({'error': '画像データが必要です'}), 400
+        try:
+            source = read_image_info(image_bytes)
+        except Exception:
+            return jsonify({'error': '画像データが不正です'}), 400
+
+        timings = {}
+        original_filename, original_write = save_original_upload(image_bytes, source, new_artifact_id())
+        rendered = run_image_task(image_pool.render_preview, image_bytes,
+                                  PREVIEW_SIZE, PREVIEW_QUALITY, RESIZE_REDUCING_GAP)
+        merge_timings(timings, rendered['timings'])
+        preview_filename = preview_filename_for(original_filename)
+        preview_write = artifact_writer.submit(artifact_path(preview_filename), rendered['preview'])
+        wait_for_writes([original_write, preview_write], timings)
+
+        result = {
+            'imageUrl': f'/generated-images/{original_filename}',
+            'previewUrl': f'/generated-images/{preview_filename}'
+        }
+        name = os.path.basename(image_file.filename or '')[:200] or None
+        result['historyId'] = record_history(current_client_id(), 'upload', result, name=name)
+        log_timings('upload', timings)
+        return jsonify(result)
+
+    except GenerationError as error:
+        return generation_error_response(error)
+    except Exception as error:
+        logger.error('画像のアップロードエラー: %s', str(error), exc_info=True)
+        return jsonify({'error': f'画像のアップロードに失敗しました: {str(error)}'}), 500
+
+@app.route('/api/history')
+def get_history():
+    """
+    利用者（X-Client-Id）の履歴を新しい順に返す
+    次のページはnextCursorをbeforeに指定して取得する（IDの範囲で絞り込むため、件数が増えても速度が変わらない）
+    """
+    client_id = current_client_id()
+    if client_id is None:
+        return jsonify({'error': 'X-Client-Idヘッダーが必要です'}), 400
+    try:
+        limit = min(max(1, int(request.args.get('limit', HISTORY_PAGE_SIZE))), HISTORY_MAX_PAGE_SIZE)
+        before = int(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        return jsonify({'error': 'limitとbeforeは整数で指定してください'}), 400
+
+    query = 'SELECT * FROM history WHERE client_id = ?'
+    params = [client_id]
+    if before is not None:
+        query += ' AND id < ?'
+        params.append(before)
+    query += ' ORDER BY id DESC LIMIT ?'
+    params.append(limit + 1)
+    with history_connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+
+    items = [history_entry(row) for row in rows[:limit]]
+    response = jsonify({
+        'items': items,
+        'nextCursor': items[-1]['id'] if len(rows) > limit else None
+    })
+    response.cache_control.no_store = True
+    response.vary.add('X-Client-Id')
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus形式のメトリクス（全ワーカーの合算）"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """生成ジョブの進捗と結果を返す"""
+    job = load_job(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    生成ジョブの進捗をServer-Sent Eventsで配信する
+    JOB_EVENTS_TIMEOUT秒で接続を閉じ、EventSourceはretryの間隔で再接続して続きを受け取る
+    """
+    if load_job(job_id) is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+
+    def generate():
+        yield f'retry: {JOB_EVENTS_RETRY_MS}\n\n'
+        last_updated = None
+        deadline = time.time() + JOB_EVENTS_TIMEOUT
+        while time.time() < deadline:
+            job = load_job(job_id)
+            if job is not None and job.get('updatedAt') != last_updated:
+                last_updated = job.get('updatedAt')
+                yield f"event: {job['status']}\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+                if job['status'] in ('succeeded', 'failed'):
+                    return
+            time.sleep(JOB_EVENTS_INTERVAL)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/transform-room-style', methods=['POST'])
+def transform_room_style():
+    try:
+        try:
+            data, image_bytes, _ = read_generation_input()
+        except ValueError:
+            return jsonify({'error': '画像データが不正です'}), 400
+
+        style = data.get('style')
+
+        if not image_bytes:
+            return jsonify({'error': '画像データが必要です'}), 400
+
+        if style is not None and not isinstance(style, str):
+            return jsonify({'error': 'スタイルは文字列で指定してください'}), 400
+
+        if not style:
+            return jsonify({'error': 'スタイルが必要です'}), 400
+
+        seed = parse_seed(data.get('seed'))
+
+        logger.info('部屋のスタイル変更リクエスト受信')
+        logger.info('選択されたスタイル: %s', style)
+
+        # 描画済みのプロンプトもキーに含め、テンプレートを編集したら以前の結果を再利用しない
+        request_key = compute_request_key('transform-room-style', image_bytes, seed=seed, style=style,
+                                          prompt=generate_style_prompt(style))
+        cache_key = None
+        if parse_flag(data.get('cache')):
+            cache_key = compute_cache_key(request_key, seed)
+
+        return dispatch_generation('transform-room-style', run_room_style_transform,
+                                   image_bytes, style, seed, cache_key=cache_key, flight_key=request_key)
+
+    except Exception as error:
+        logger.error('部屋のスタイル変更エラー: %s', str(error), exc_info=True)
+        return jsonify({'error': f'部屋のスタイル変更に失敗しました: {str(error)}'}), 500
+
+def run_room_style_transform(image_bytes, style, seed=None):
+    """
+    アプローチA: 部屋全体のスタイルを変更（ジョブ本体）
+    """
+    timings = {}
+    try:
+        update_job_progress('decoding')
+        style_input = prepare_style_input(image_bytes, timings)
+        return generate_style_variant(style_input, style, seed, timings)
+
+    except GenerationError:
+        raise
+    except Exception as api_error:
+        logger.error('Stability AI APIエラー: %s', str(api_error), exc_info=True)
+        raise GenerationError(f'画像生成に失敗しました: {str(api_error)}')
+
+def prepare_style_input(image_bytes, timings):
+    """
+    スタイル変更の入力を準備する（デコード・リサイズ・エンコードは各1回）
+    一括生成では1回だけ呼び出し、結果を全スタイルで共有する
+    """
+    update_job_progress('preprocessing')
+    init_image, source = preprocess_image(image_bytes, select_target_size, timings)
+
+    # 元の画像を保存
+    original_artifact_id = new_artifact_id()
+    original_filename, original_write = save_original_upload(image_bytes, source, original_artifact_id)
+
+    return {
+        'initImage': init_image,
+        'originalFilename': original_filename,
+        'originalWrite': original_write
+    }
+
+def generate_style_variant(style_input, style, seed, timings, lane='image-to-image'):
+    """準備済みの入力から1つのスタイルの画像を生成して保存する（laneはAPIのレート制限のレーン）"""
+    artifact_id = new_artifact_id()
 
-# 生成された画像を保存するディレクトリ
-images_dir = os.path.join(app.static_folder, 'generated-images')
-os.makedirs(images_dir, exist_ok=True)
+    # Image-to-Imageエンドポイント
+    endpoint = f'{STABILITY_ENGINE_PATH}/image-to-image'
 
-# 画像ディレクトリの設定を追加
-styles_images_dir = os.path.join(app.static_folder, 'images', 'styles')
-os.makedirs(styles_images_dir, exist_ok=True)
+    # プロンプトを生成
+    generation_prompt, negative_prompt = generate_style_prompt(style)
+    logger.info(f'生成プロンプト: {generation_prompt}')
+    logger.info(f'ネガティブプロンプト: {negative_prompt}')
 
-# スタイルごとの詳細な指示を定義
-STYLE_DETAILS = {
-   "simple": {
-    "main": "modern minimalist interior style, uncluttered and streamlined design",
-    "colors": "bright white walls, subtle gray touches, neutral monochrome palette",
-    "materials": "sleek surfaces, pale wood finishes, matte textures",
-    "furniture": "essential furniture only, straight lines, multifunctional design",
-    "lighting": "minimalist pendant lights, large windows, natural daylight",
-    "mood": "peaceful, orderly, refreshing minimal space"
-},
-"scandinavian": {
-    "main": "nordic-inspired scandinavian interior, inviting and balanced",
-    "colors": "crisp white walls, blonde wood, soft grays, gentle pastels",
-    "materials": "oak flooring, cozy textiles, painted wood finishes",
-    "furniture": "light wood furniture, soft fabrics, playful modern shapes",
-    "lighting": "ample daylight, contemporary pendants, warm soft glow",
-    "mood": "bright, tranquil, welcoming nordic comfort"
-},
-"hotel": {
-  "main": "hotel-inspired modern interior, elegant and comfort-focused design",
-  "colors": "neutral tones like beige, white, and taupe, with soft accent colors",
-  "materials": "high-quality fabrics, polished wood, glass, and metal finishes",
-  "furniture": "coordinated furniture sets, upholstered headboard, sleek desk and armchair",
-  "lighting": "layered lighting with warm tones, bedside lamps, sconces, and natural light",
-  "mood": "calm, luxurious, welcoming, like a premium hotel suite"
-},
-"korean": {
-    "main": "contemporary korean interior, sleek and modern asian design",
-    "colors": "creamy whites, muted grays, earthy accents, dark contrasts",
-    "materials": "light-toned woods, textured wall panels, smooth stone",
-    "furniture": "low minimalist furniture, streamlined storage, built-ins",
-    "lighting": "subtle ceiling lights, soft indirect glow",
-    "mood": "fashionable, serene, understated korean refinement"
-},
-"brooklyn": {
-    "main": "industrial brooklyn loft, urban apartment conversion",
-    "colors": "weathered brick red, concrete gray, black metal details",
-    "materials": "exposed brick, steel pipes, reclaimed wood surfaces",
-    "furniture": "industrial style pieces, vintage decor, worn-in leather",
-    "lighting": "caged pendant lights, exposed bulbs, utilitarian fixtures",
-    "mood": "gritty, urban, creative industrial vibe"
-},
-"natural": {
-    "main": "nature-inspired organic interior, biophilic oasis",
-    "colors": "earthy tans, leafy greens, soft wood tones",
-    "materials": "raw wood, natural stone, woven textiles, living plants",
-    "furniture": "nature-shaped wood furniture, handwoven fabrics, eco-focused pieces",
-    "lighting": "floor-to-ceiling windows, sunlit interiors, warm spot lighting",
-    "mood": "calm, earthy, deeply connected to the natural world"
-},
-"japanese_modern": {
-    "main": "contemporary japanese zen interior, modern simplicity",
-    "colors": "gentle whites, honey wood grains, charcoal highlights",
-    "materials": "shoji screens, tatami flooring, authentic woodwork",
-    "furniture": "low tables, minimalist built-ins, hidden storage",
-    "lighting": "lantern-style lamps, subtle indirect light, soft daylight",
-    "mood": "contemplative, balanced, serene japanese minimalism"
-},
-"ethnic_mix": {
-    "main": "eclectic world-inspired ethnic fusion interiors",
-    "colors": "vivid jewel colors, spicy warm hues, natural earthy tones",
-    "materials": "handcrafted textiles, ornate wood carvings, organic fibers",
-    "furniture": "global mix of artisanal furniture, one-of-a-kind objects",
-    "lighting": "ethnic pendant lanterns, soft colored lamps, glowing atmosphere",
-    "mood": "adventurous, multicultural, artistically rich"
-}
+    # multipart/form-dataとして送信するファイル（同時に送信できるようスタイルごとに別のバッファを使う）
+    files = {
+        "init_image": ("image.png", io.BytesIO(style_input['initImage']), "image/png")
     }
 
-# 簡易翻訳機能（日本語→英語の主要な部屋関連単語）
-def translate_text(text, dest='en'):
-    """簡易的な翻訳機能（日本語→英語）"""
-    # 部屋関連の日本語→英語の辞書
-    ja_to_en = {
-        "壁": "wall",
-        "床": "floor",
-        "天井": "ceiling",
-        "窓": "window",
-        "ドア": "door",
-        "家具": "furniture",
-        "ソファ": "sofa",
-        "テーブル": "table",
-        "椅子": "chair",
-        "ベッド": "bed",
-        "照明": "lighting",
-        "ランプ": "lamp",
-        "カーテン": "curtain",
-        "カーペット": "carpet",
-        "ラグ": "rug",
-        "棚": "shelf",
-        "本棚": "bookshelf",
-        "キッチン": "kitchen",
-        "バスルーム": "bathroom",
-        "リビング": "living room",
-        "ダイニング": "dining room",
-        "寝室": "bedroom",
-        "オフィス": "office",
-        "モダン": "modern",
-        "ミニマル": "minimal",
-        "ラグジュアリー": "luxury",
-        "北欧": "scandinavian",
-        "インダストリアル": "industrial",
-        "伝統的": "traditional",
-        "居心地の良い": "cozy",
-        "ナチュラル": "natural",
-        "青": "blue",
-        "赤": "red",
-        "緑": "green",
-        "黄色": "yellow",
-        "白": "white",
-        "黒": "black",
-        "グレー": "gray",
-        "茶色": "brown",
-        "木製": "wooden",
-        "金属": "metal",
-        "ガラス": "glass",
-        "大理石": "marble",
-        "コンクリート": "concrete",
-        "レンガ": "brick",
-        "に変更": "change to",
-        "にする": "make it"
+    # パラメータの設定
+    data = {
+        "text_prompts[0][text]": generation_prompt,
+        "text_prompts[0][weight]": "1.0",
+        "text_prompts[1][text]": negative_prompt,
+        "text_prompts[1][weight]": "-1.2",
+        "image_strength": "0.4",    # 元の画像の影響を少し強める
+        "cfg_scale": "9",          # プロンプトへの忠実度を上げる
+        "samples": "1",
+        "steps": "50",              # APIの制限に合わせる
+        "style_preset": "photographic",
+        "seed": str(seed if seed is not None else random.randint(1, 1000000))
     }
-    
-    # 入力テキストを単語に分割して翻訳
-    translated = text
-    for ja, en in ja_to_en.items():
-        translated = translated.replace(ja, en)
-    
-    logger.info(f"翻訳: '{text}' → '{translated}'")
-    return translated
 
-# 静的ファイルの提供
-@app.route('/')
-def index():
-    return send_from_directory(app.static_folder, 'index.html')
+    # APIリクエスト
+    update_job_progress('generating')
+    result_bytes = request_generation(endpoint, files, data, timings, lane)
 
-@app.route('/<path:path>')
-def static_files(path):
-    return send_from_directory(app.static_folder, path)
+    # 生成された画像を保存
+    update_job_progress('saving')
+    result_filename = artifact_filename('styled', artifact_id)
+    result_path = artifact_path(result_filename)
 
-@app.route('/generated-images/<path:filename>')
-def generated_image(filename):
-    return send_from_directory(images_dir, filename)
+    preview_filename, result_writes = save_result_image(result_bytes, result_filename, timings)
+    wait_for_writes([style_input['originalWrite']] + result_writes, timings)
 
-# 静的ファイルのルートを追加
-@app.route('/images/styles/<path:filename>')
-def style_image(filename):
-    return send_from_directory(styles_images_dir, filename)
+    logger.info('生成された画像を保存: %s', result_path)
+    log_timings('transform-room-style', timings)
 
-# 部屋のスタイルリストを提供するAPI
-@app.route('/api/room-styles')
-def get_room_styles():
-    """部屋のスタイルリストを返す"""
-    styles = [
-        {
-            "id": "simple",
-            "name": "シンプル",
-            "image": "/images/styles/simple.jpg"
-        },
-        {
-            "id": "scandinavian",
-            "name": "北欧風",
-            "image": "/images/styles/scandinavian.jpg"
-        },
-        {
-            "id": "hotel",
-            "name": "ホテルライク",
-            "image": "/images/styles/hotel.jpg"
-        },
-        {
-            "id": "korean",
-            "name": "韓国風",
-            "image": "/images/styles/korean.jpg"
-        },
-        {
-            "id": "brooklyn",
-            "name": "ブルックリンスタイル",
-            "image": "/images/styles/brooklyn.jpg"
-        },
-        {
-            "id": "natural",
-            "name": "ナチュラル",
-            "image": "/images/styles/natural.jpg"
-        },
-        {
-            "id": "japanese_modern",
-            "name": "和モダン",
-            "image": "/images/styles/japanese_modern.jpg"
-        },
-        {
-            "id": "ethnic_mix",
-            "name": "エスニックミックス",
-            "image": "/images/styles/ethnic_mix.jpg"
-        }
-    ]
-    return jsonify(styles)
+    return {
+        'imageUrl': f'/generated-images/{result_filename}',
+        'originalUrl': f'/generated-images/{style_input["originalFilename"]}',
+        'previewUrl': f'/generated-images/{preview_filename}',
+        'message': '部屋のスタイル変更が完了しました',
+        'timings': timings
+    }
 
-@app.route('/api/transform-room-style', methods=['POST'])
-def transform_room_style():
+@app.route('/api/transform-room-styles', methods=['POST'])
+def transform_room_styles():
+    """
+    1枚の写真から複数のスタイルを一括生成する
+    前処理は1回だけ行い、APIの呼び出しはBATCH_CONCURRENCYまで並行して行う。
+    結果は完了した順にNDJSON（1行に1スタイル）でストリーミングする。
+    ワーカーのタイムアウト内に終わるよう、スタイルはBATCH_MAX_STYLES件までとする
+    """
     try:
-        data = request.json
-        image_data = data.get('imageData')
-        style = data.get('style')
-        
-        if not image_data:
+        try:
+            data, image_bytes, _ = read_generation_input()
+        except ValueError:
+            return jsonify({'error': '画像データが不正です'}), 400
+
+        styles = data.get('styles')
+        if isinstance(styles, str):
+            styles = [style.strip() for style in styles.split(',')]
+
+        if not image_bytes:
             return jsonify({'error': '画像データが必要です'}), 400
-        
-        if not style:
+
+        if isinstance(styles, list) and not all(isinstance(style, str) for style in styles):
+            return jsonify({'error': 'スタイルは文字列で指定してください'}), 400
+
+        if not isinstance(styles, list) or not [style for style in styles if style]:
             return jsonify({'error': 'スタイルが必要です'}), 400
-        
-        logger.info('部屋のスタイル変更リクエスト受信')
-        logger.info('選択されたスタイル: %s', style)
-        
-        try:
-            # Base64のヘッダー部分を削除
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            
-            image_bytes = base64.b64decode(image_data)
-            img = Image.open(io.BytesIO(image_bytes))
-            
-            # 元の画像を保存
-            timestamp = int(time.time())
-            original_filename = f'original-{timestamp}.png'
-            original_path = os.path.join(images_dir, original_filename)
-            img.save(original_path, format="PNG", quality=95)
-            
-            logger.info('元の画像を保存: %s', original_path)
-            
-            # アスペクト比を保持しながら、許可されているサイズに変換
-            original_aspect_ratio = img.width / img.height
-            
-            # 許可されているサイズのリスト
-            allowed_sizes = [
-                (1024, 1024),
-                (1152, 896),
-                (1216, 832),
-                (1344, 768),
-                (1536, 640),
-                (640, 1536),
-                (768, 1344),
-                (832, 1216),
-                (896, 1152)
-            ]
-            
-            # 最適なサイズを選択
-            def get_aspect_ratio_difference(size):
-                return abs((size[0] / size[1]) - original_aspect_ratio)
-            
-            target_size = min(allowed_sizes, key=get_aspect_ratio_difference)
-            logger.info(f'選択したターゲットサイズ: {target_size}')
-            
-            # 画像をリサイズ
-            img = img.resize(target_size, Image.LANCZOS)
-            logger.info(f'画像をリサイズ: {img.size}')
-            
-            # 処理した画像をバイトストリームに変換
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            
-            # Stability AI APIの認証ヘッダー
-            headers = {
-                "Authorization": f"Bearer {STABILITY_API_KEY}",
-                "Accept": "application/json"
-            }
-            
-            # Image-to-Imageエンドポイント
-            endpoint = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/image-to-image"
-            
-            # プロンプトを生成
-            generation_prompt, negative_prompt = generate_style_prompt(style)
-            logger.info(f'生成プロンプト: {generation_prompt}')
-            logger.info(f'ネガティブプロンプト: {negative_prompt}')
-            
-            # multipart/form-dataとして送信するファイル
-            files = {
-                "init_image": ("image.png", img_byte_arr, "image/png")
-            }
-            
-            # パラメータの設定
-            data = {
-                "text_prompts[0][text]": generation_prompt,
-                "text_prompts[0][weight]": "1.0",
-                "text_prompts[1][text]": negative_prompt,
-                "text_prompts[1][weight]": "-1.2",
-                "image_strength": "0.4",    # 元の画像の影響を少し強める
-                "cfg_scale": "9",          # プロンプトへの忠実度を上げる
-                "samples": "1",
-                "steps": "50",              # APIの制限に合わせる
-                "style_preset": "photographic",
-                "seed": str(random.randint(1, 1000000))
-            }
-            
-            # APIリクエスト
-            response = requests.post(endpoint, headers=headers, files=files, data=data)
-            
-            if response.status_code != 200:
-                logger.error(f"Stability AI APIエラー: {response.text}")
-                return jsonify({'error': f'画像生成に失敗しました: {response.text}'}), 500
-            
-            # レスポンスから画像データを取得
-            response_data = response.json()
-            if "artifacts" not in response_data or len(response_data["artifacts"]) == 0:
-                return jsonify({'error': 'APIレスポンスに画像データが含まれていません'}), 500
-            
-            image_base64 = response_data["artifacts"][0]["base64"]
-            image_bytes = base64.b64decode(image_base64)
-            
-            # 生成された画像を保存
-            result_filename = f'styled-{timestamp}.png'
-            result_path = os.path.join(images_dir, result_filename)
-            
-            with open(result_path, 'wb') as f:
-                f.write(image_bytes)
-            
-            logger.info('生成された画像を保存: %s', result_path)
-            
-            # レスポンスを返す
-            return jsonify({
-                'imageUrl': f'/generated-images/{result_filename}',
-                'originalUrl': f'/generated-images/{original_filename}',
-                'message': '部屋のスタイル変更が完了しました'
-            })
-            
-        except Exception as api_error:
-            logger.error('Stability AI APIエラー: %s', str(api_error), exc_info=True)
-            return jsonify({'error': f'画像生成に失敗しました: {str(api_error)}'}), 500
-            
+
+        # 重複を除き、指定された順序を保つ
+        styles = list(dict.fromkeys(style for style in styles if style))
+        known_styles = get_prompt_templates()['style_prompts']
+        unknown_styles = [style for style in styles if style not in known_styles]
+        if unknown_styles:
+            return jsonify({'error': f'不明なスタイルです: {", ".join(map(str, unknown_styles))}'}), 400
+        if len(styles) > BATCH_MAX_STYLES:
+            return jsonify({'error': f'一度に生成できるスタイルは{BATCH_MAX_STYLES}件までです'}), 400
+
+        seed = parse_seed(data.get('seed'))
+        use_cache = parse_flag(data.get('cache'))
+        client_id = current_client_id()
+
+        logger.info('複数スタイルの一括生成リクエスト受信: %s', ', '.join(styles))
+
+        # キャッシュ済みのスタイルはすぐに返し、残りだけを生成する
+        cached_results = []
+        pending_styles = []
+        for style in styles:
+            # 単体のスタイル変更と同じキーを使い、キャッシュと処理中の結果を共有する
+            request_key = compute_request_key('transform-room-style', image_bytes, seed=seed, style=style,
+                                              prompt=generate_style_prompt(style))
+            cache_key = None
+            if use_cache:
+                cache_key = compute_cache_key(request_key, seed)
+            cached = lookup_cached_result(cache_key) if cache_key else None
+            if cache_key:
+                metrics.inc('rooms_result_cache_requests_total', endpoint='transform-room-style',
+                            result='hit' if cached else 'miss')
+            if cached is not None:
+                history_id = record_history(client_id, 'transform-room-style', cached)
+                cached_results.append(dict(cached, style=style, historyId=history_id))
+            else:
+                pending_styles.append((style, cache_key, request_key))
+
+        timings = {}
+        style_input = None
+        if pending_styles:
+            try:
+                upstream_limiter.admit(UPSTREAM_LANES['transform-room-styles'])
+            except GenerationError as error:
+                return generation_error_response(error)
+            try:
+                style_input = prepare_style_input(image_bytes, timings)
+            except Exception as img_error:
+                logger.error("画像処理エラー: %s", str(img_error))
+                return jsonify({'error': f'画像処理に失敗しました: {str(img_error)}'}), 500
+            log_timings('transform-room-styles', timings)
+
+        def generate_one(style, cache_key, request_key):
+            variant_timings = {}
+            func = generate_style_variant
+            if cache_key:
+                func = with_result_cache(cache_key, func)
+            func = with_single_flight(request_key, func)
+            func = with_history(client_id, 'transform-room-style', func)
+            func = with_generation_metrics('transform-room-style', func)
+            return func(style_input, style, seed, variant_timings, UPSTREAM_LANES['transform-room-styles'])
+
+        futures = {batch_executor.submit(generate_one, style, cache_key, request_key): style
+                   for style, cache_key, request_key in pending_styles}
+
+        def stream():
+            try:
+                for result in cached_results:
+                    yield json.dumps(result, ensure_ascii=False) + '\n'
+                for future in as_completed(futures):
+                    style = futures[future]
+                    try:
+                        result = dict(future.result(), style=style)
+                    except GenerationError as error:
+                        result = {'style': style, 'error': error.message, 'status': error.status_code}
+                        if error.retry_after is not None:
+                            result['retryAfter'] = max(1, math.ceil(error.retry_after))
+                    except Exception as error:
+                        logger.error('スタイル %s の生成エラー: %s', style, str(error), exc_info=True)
+                        result = {'style': style, 'error': f'画像生成に失敗しました: {str(error)}', 'status': 500}
+                    yield json.dumps(result, ensure_ascii=False) + '\n'
+            finally:
+                # クライアントが切断した場合、まだ始まっていない生成は取り消す
+                for future in futures:
+                    future.cancel()
+
+        return Response(stream_with_context(stream()), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     except Exception as error:
-        logger.error('部屋のスタイル変更エラー: %s', str(error), exc_info=True)
-        return jsonify({'error': f'部屋のスタイル変更に失敗しました: {str(error)}'}), 500
+        logger.error('複数スタイルの一括生成エラー: %s', str(error), exc_info=True)
+        return jsonify({'error': f'複数スタイルの一括生成に失敗しました: {str(error)}'}), 500
 
 @app.route('/api/transform-room-area', methods=['POST'])
 def transform_room_area():
@@ -372,468 +2454,477 @@ def transform_room_area():
     アプローチB: 部屋の特定の領域を変更
     """
     try:
-        data = request.json
-        image_data = data.get('imageData')
-        mask_data = data.get('maskData')
+        try:
+            data, image_bytes, mask_bytes = read_generation_input()
+        except ValueError:
+            return jsonify({'error': '画像データが不正です'}), 400
+
         prompt = data.get('prompt')
-        
-        if not image_data:
+
+        if not image_bytes:
             return jsonify({'error': '画像データが必要です'}), 400
-        
-        if not mask_data:
+
+        if not mask_bytes:
             return jsonify({'error': 'マスクデータが必要です'}), 400
-        
+
+        if prompt is not None and not isinstance(prompt, str):
+            return jsonify({'error': 'プロンプトは文字列で指定してください'}), 400
+
         if not prompt:
             return jsonify({'error': 'プロンプトが必要です'}), 400
-        
+
+        seed = parse_seed(data.get('seed'))
+
         logger.info('部屋の領域変更リクエスト受信')
         logger.info('プロンプト: %s', prompt)
-        
+
         # プロンプトを英語に翻訳
         translated_prompt = translate_text(prompt)
         logger.info('翻訳されたプロンプト: %s', translated_prompt)
-        
-        # Base64データからPIL Imageに変換
-        try:
-            # Base64のヘッダー部分を削除
-            base64_image = image_data.split(',')[1] if ',' in image_data else image_data
-            image_bytes = base64.b64decode(base64_image)
-            
-            base64_mask = mask_data.split(',')[1] if ',' in mask_data else mask_data
-            mask_bytes = base64.b64decode(base64_mask)
-            
-            # 画像を保存
-            timestamp = int(time.time())
-            original_filename = f'original-{timestamp}.png'
-            original_path = os.path.join(images_dir, original_filename)
-            
-            with open(original_path, 'wb') as f:
-                f.write(image_bytes)
-            
-            logger.info('元の画像を保存: %s', original_path)
-            local_original_url = f'/generated-images/{original_filename}'
-            
-            # マスク画像を保存
-            mask_filename = f'mask-{timestamp}.png'
-            mask_path = os.path.join(images_dir, mask_filename)
-            
-            with open(mask_path, 'wb') as f:
-                f.write(mask_bytes)
-            
-            logger.info('マスク画像を保存: %s', mask_path)
-            
-            # 画像を前処理
-            try:
-                # PILを使用して画像を開く前にデバッグ情報を出力
-                logger.info('画像バイト数: %d', len(image_bytes))
-                logger.info('マスクバイト数: %d', len(mask_bytes))
-                
-                # 画像フォーマットを明示的に指定してオープン
-                img = Image.open(io.BytesIO(image_bytes))
-                img = img.convert("RGB")
-                
-                # マスク画像も同様に処理
-                try:
-                    mask_img = Image.open(io.BytesIO(mask_bytes))
-                    mask_img = mask_img.convert("RGB")
-                except Exception as mask_error:
-                    logger.error("マスク画像処理エラー: %s", str(mask_error))
-                    
-                    # マスク画像が読み込めない場合、単純な黒い画像を作成
-                    mask_img = Image.new("RGB", img.size, (0, 0, 0))
-                    # 中央に白い円を描画（サンプルマスク）
-                    from PIL import ImageDraw
-                    draw = ImageDraw.Draw(mask_img)
-                    center_x, center_y = img.width // 2, img.height // 2
-                    radius = min(img.width, img.height) // 4
-                    draw.ellipse((center_x - radius, center_y - radius, 
-                                  center_x + radius, center_y + radius), fill=(255, 255, 255))
-                
-                # 画像のサイズを取得
-                width, height = img.size
-                
-                # 正方形に変換（APIが正方形の画像を期待する場合）
-                square_size = max(width, height)
-                square_img = Image.new("RGB", (square_size, square_size), (255, 255, 255))  # 白背景
-                square_mask = Image.new("L", (square_size, square_size), 0)  # 黒（マスクなし）
-                
-                # 元の画像を中央に配置
-                paste_x = (square_size - width) // 2
-                paste_y = (square_size - height) // 2
-                square_img.paste(img, (paste_x, paste_y))
-                square_mask.paste(mask_img, (paste_x, paste_y))
-                
-                # 処理用に1024x1024にリサイズ
-                api_img = square_img.resize((1024, 1024), Image.LANCZOS)
-                api_mask = square_mask.resize((1024, 1024), Image.LANCZOS)
-                
-                # 処理した画像を保存
-                processed_filename = f'processed-{timestamp}.png'
-                processed_path = os.path.join(images_dir, processed_filename)
-                api_img.save(processed_path, format="PNG", quality=95)
-                
-                processed_mask_filename = f'processed-mask-{timestamp}.png'
-                processed_mask_path = os.path.join(images_dir, processed_mask_filename)
-                api_mask.save(processed_mask_path, format="PNG", quality=95)
-                
-                logger.info('前処理した画像を保存: %s', processed_path)
-                logger.info('前処理したマスクを保存: %s', processed_mask_path)
-                
-            except Exception as img_error:
-                logger.error("画像処理エラー: %s", str(img_error))
-                return jsonify({'error': f'画像処理に失敗しました: {str(img_error)}'}), 500
-            
-            try:
-                # Stability AI APIの認証ヘッダー
-                headers = {
-                    "Authorization": f"Bearer {STABILITY_API_KEY}",
-                    "Accept": "application/json"
-                }
-                
-                # Inpaintingエンドポイント
-                endpoint = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/image-to-image/masking"
-                
-                # プロンプトを強化
-                generation_prompt = f"""
-                Change ONLY the masked area to: {translated_prompt}
-                
-                The masked area should be completely transformed according to the prompt.
-                Keep everything else EXACTLY the same. Maintain the same perspective, lighting, and overall style.
-                Photorealistic, professional interior photography, detailed textures, natural lighting, 8K quality
-                """
-                
-                negative_prompt = "deformed, distorted, disfigured, poorly drawn, bad anatomy, wrong proportions, blurry, bad hands, cropped, worst quality, low quality, jpeg artifacts, watermark, unnatural lighting, unrealistic, artificial, fake looking, cartoon, anime, illustration, painting, drawing, art, canvas texture, smooth texture, grainy, low-res, pixelated, oversaturated"
-                
-                # multipart/form-dataとして送信
-                files = {
-                    "init_image": open(processed_path, "rb"),
-                    "mask_image": open(processed_mask_path, "rb")
-                }
-                
-                # パラメータの設定
-                data = {
-                    "text_prompts[0][text]": generation_prompt,
-                    "text_prompts[0][weight]": "1.0",
-                    "text_prompts[1][text]": negative_prompt,
-                    "text_prompts[1][weight]": "-1.0",
-                    "mask_source": "MASK_IMAGE_WHITE",  # 白い部分がマスク（変更する部分）
-                    "cfg_scale": "10",        # プロンプトへの忠実度を上げる
-                    "samples": "1",
-                    "steps": "50",            # ステップ数を増やす
-                    "style_preset": "photographic",  # 写真風のスタイル
-                    "seed": str(random.randint(1, 1000000))  # ランダムシード
-                }
-                
-                # APIリクエスト
-                response = requests.post(endpoint, headers=headers, files=files, data=data)
-                
-                if response.status_code != 200:
-                    logger.error(f"Stability AI APIエラー: {response.text}")
-                    return jsonify({'error': f'画像生成に失敗しました: {response.text}'}), 500
-                
-                # レスポンスから画像データを取得
-                response_data = response.json()
-                if "artifacts" not in response_data or len(response_data["artifacts"]) == 0:
-                    return jsonify({'error': 'APIレスポンスに画像データが含まれていません'}), 500
-                
-                image_base64 = response_data["artifacts"][0]["base64"]
-                image_bytes = base64.b64decode(image_base64)
-                
-                # 生成された画像を元のサイズに戻す処理
-                generated_img = Image.open(io.BytesIO(image_bytes))
-                
-                # 正方形から元のアスペクト比に戻す
-                generated_square = generated_img.resize((square_size, square_size), Image.LANCZOS)
-                
-                # 元のサイズの画像を切り出す
-                final_img = generated_square.crop((paste_x, paste_y, paste_x + width, paste_y + height))
-                
-                # 最終画像を保存
-                result_filename = f'masked-{timestamp}.png'
-                result_path = os.path.join(images_dir, result_filename)
-                
-                # BytesIOを使用してメモリ内で処理
-                final_bytes = io.BytesIO()
-                final_img.save(final_bytes, format="PNG", quality=95)
-                final_bytes.seek(0)
-                
-                with open(result_path, 'wb') as f:
-                    f.write(final_bytes.read())
-                
-                logger.info('生成された画像を保存: %s', result_path)
-                
-                # レスポンスを返す
-                local_image_url = f'/generated-images/{result_filename}'
-                return jsonify({
-                    'imageUrl': local_image_url,
-                    'originalUrl': local_original_url,
-                    'message': '部屋の領域変更が完了しました'
-                })
-                
-            except Exception as api_error:
-                logger.error('Stability AI APIエラー: %s', str(api_error), exc_info=True)
-                return jsonify({'error': f'画像生成に失敗しました: {str(api_error)}'}), 500
-        
-        except Exception as error:
-            logger.error('部屋の領域変更エラー: %s', str(error), exc_info=True)
-            return jsonify({'error': f'部屋の領域変更に失敗しました: {str(error)}'}), 500
-    
+
+        request_key = compute_request_key('transform-room-area', image_bytes, mask_bytes,
+                                          seed=seed, prompt=translated_prompt)
+        cache_key = None
+        if parse_flag(data.get('cache')):
+            cache_key = compute_cache_key(request_key, seed)
+
+        return dispatch_generation('transform-room-area', run_room_area_transform,
+                                   image_bytes, mask_bytes, translated_prompt, seed,
+                                   cache_key=cache_key, flight_key=request_key)
+
     except Exception as error:
         logger.error('部屋の領域変更エラー: %s', str(error), exc_info=True)
         return jsonify({'error': f'部屋の領域変更に失敗しました: {str(error)}'}), 500
 
-@app.route('/api/customize-room', methods=['POST'])
-def customize_room():
+def run_room_area_transform(image_bytes, mask_bytes, translated_prompt, seed=None):
+    """
+    アプローチB: 部屋の特定の領域を変更（ジョブ本体）
+    """
+    timings = {}
     try:
-        data = request.json
-        image_data = data.get('imageData')
-        prompt = data.get('prompt')
-        
-        if not image_data:
-            return jsonify({'error': '画像データが必要です'}), 400
-        
-        if not prompt or not prompt.strip():
-            return jsonify({'error': 'プロンプトが必要です'}), 400
-        
-        logger.info('部屋のカスタマイズリクエスト受信')
-        logger.info('プロンプト: %s', prompt)
-        
-        # プロンプトを英語に翻訳
-        translated_prompt = translate_text(prompt)
-        logger.info('翻訳されたプロンプト: %s', translated_prompt)
-        
-        # プロンプトを解析して具体的な変更指示を生成
-        change_request = parse_room_change_request(prompt)
-        specific_prompt = generate_specific_prompt(change_request)
-        logger.info('生成された具体的なプロンプト: %s', specific_prompt)
-        
-        # Base64データを取得
-        base64_data = image_data.split(',')[1] if ',' in image_data else image_data
-        image_bytes = base64.b64decode(base64_data)
-        
-        # 画像を保存
-        timestamp = int(time.time())
-        original_filename = f'original-{timestamp}.png'
-        original_path = os.path.join(images_dir, original_filename)
-        
-        with open(original_path, 'wb') as f:
-            f.write(image_bytes)
-        
-        logger.info('元の画像を保存: %s', original_path)
-        local_original_url = f'/generated-images/{original_filename}'
-        
-        # 画像を前処理（リサイズと最適化）
+        update_job_progress('decoding')
+        artifact_id = new_artifact_id()
+
+        # 画像を前処理
         try:
-            img = Image.open(io.BytesIO(image_bytes))
-            img = img.convert("RGB")
-            
-            # アスペクト比を保持しながら、許可されているサイズに変換
-            original_aspect_ratio = img.width / img.height
-            
-            # 許可されているサイズのリスト
-            allowed_sizes = [
-                (1024, 1024),
-                (1152, 896),
-                (1216, 832),
-                (1344, 768),
-                (1536, 640),
-                (640, 1536),
-                (768, 1344),
-                (832, 1216),
-                (896, 1152)
-            ]
-            
-            # 最適なサイズを選択
-            def get_aspect_ratio_difference(size):
-                return abs((size[0] / size[1]) - original_aspect_ratio)
-            
-            target_size = min(allowed_sizes, key=get_aspect_ratio_difference)
-            logger.info(f'選択したターゲットサイズ: {target_size}')
-            
-            # 画像をリサイズ
-            img = img.resize(target_size, Image.LANCZOS)
-            logger.info(f'画像をリサイズ: {img.size}')
-            
-            processed_filename = f'processed-{timestamp}.png'
-            processed_path = os.path.join(images_dir, processed_filename)
-            img.save(processed_path, format="PNG", quality=95)
-            logger.info('前処理した画像を保存: %s', processed_path)
+            update_job_progress('preprocessing')
+
+            logger.info('画像バイト数: %d', len(image_bytes))
+            logger.info('マスクバイト数: %d', len(mask_bytes))
+
+            source = read_image_info(image_bytes)
+            width, height = source['size']
+
+            # マスクを二値化・膨張・ぼかし、空のマスクや読み込めないマスクはAPIを呼び出す前に拒否
+            try:
+                analyzed = run_image_task(image_pool.analyze_mask, mask_bytes, source['size'],
+                                          MASK_THRESHOLD, MASK_DILATE_PX, MASK_FEATHER_PX)
+            except Exception as mask_error:
+                logger.warning('マスク画像を読み込めません: %s', str(mask_error))
+                raise GenerationError('マスク画像が不正です', 400)
+            merge_timings(timings, analyzed['timings'])
+            logger.info('マスクの塗られた割合: %.2f%%', analyzed['coverage'] * 100)
+            # MASK_MIN_COVERAGEが0でも、何も塗られていない（範囲が無い）マスクは拒否する
+            if analyzed['coverage'] == 0 or analyzed['coverage'] < MASK_MIN_COVERAGE:
+                raise GenerationError('マスクが空です。変更したい部分を塗ってください', 400)
+
+            # マスクの周囲だけを切り出す（マスクが小さい場合）
+            crop_box = None
+            if AREA_ROI_ENABLED:
+                crop_box = roi_crop_box(source['size'], analyzed['bbox'])
+            if crop_box is None:
+                crop_box = (0, 0, width, height)
+
+            # アスペクト比が最も近い許可サイズに収まるサイズで1回だけデコード・縮小し、余白を追加
+            crop_size = (crop_box[2] - crop_box[0], crop_box[3] - crop_box[1])
+            api_size, content_size, (paste_x, paste_y) = bucket_layout(crop_size)
+            logger.info('切り出し範囲: %s、選択したターゲットサイズ: %s', crop_box, api_size)
+
+            prepared = run_image_task(image_pool.prepare_masked_image, image_bytes, analyzed['mask'],
+                                      analyzed['size'], crop_box, api_size, content_size, (paste_x, paste_y),
+                                      RESIZE_REDUCING_GAP)
+            merge_timings(timings, prepared['timings'])
+
+            init_image = io.BytesIO(prepared['image'])
+            mask_image = io.BytesIO(prepared['mask'])
+
+            # 処理した画像を保存（デバッグ用）
+            save_debug_artifact(artifact_filename('processed', artifact_id), prepared['image'])
+            save_debug_artifact(artifact_filename('processed-mask', artifact_id), prepared['mask'])
+
+        except GenerationError:
+            raise
         except Exception as img_error:
             logger.error("画像処理エラー: %s", str(img_error))
-            return jsonify({'error': f'画像処理に失敗しました: {str(img_error)}'}), 500
-        
+            raise GenerationError(f'画像処理に失敗しました: {str(img_error)}')
+
+        # 元の画像を保存
+        original_filename, original_write = save_original_upload(image_bytes, source, artifact_id)
+        local_original_url = f'/generated-images/{original_filename}'
+
+        # マスク画像を保存（レスポンスでは返さないため完了を待たない）
+        mask_filename = artifact_filename('mask', artifact_id)
+        mask_path = artifact_path(mask_filename)
+        artifact_writer.submit(mask_path, mask_bytes)
+
+        logger.info('マスク画像を保存: %s', mask_path)
+
         try:
-            # Stability AI APIの認証ヘッダー
-            headers = {
-                "Authorization": f"Bearer {STABILITY_API_KEY}",
-                "Accept": "application/json"
-            }
-            
-            # 最新のStability AI APIエンドポイント
-            endpoint = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/image-to-image"
-            
-            # プロンプトを作成（より強力な指示）
+            # Inpaintingエンドポイント
+            endpoint = f'{STABILITY_ENGINE_PATH}/image-to-image/masking'
+
+            # プロンプトを強化
             generation_prompt = f"""
-            THIS IS AN IMAGE-TO-IMAGE TASK.
-            
-            SPECIFIC INSTRUCTION: {specific_prompt}
-            
-            DO NOT change the room layout, perspective, or camera angle.
-            DO NOT add or remove furniture unless explicitly requested.
-            ONLY modify the exact elements mentioned in the instruction.
-            
-            Photorealistic, professional interior photography, detailed textures, natural lighting
+            Change ONLY the masked area to: {translated_prompt}
+
+            The masked area should be completely transformed according to the prompt.
+            Keep everything else EXACTLY the same. Maintain the same perspective, lighting, and overall style.
+            Photorealistic, professional interior photography, detailed textures, natural lighting, 8K quality
             """
-            
-            negative_prompt = "deformed, distorted, disfigured, poorly drawn, bad anatomy, wrong proportions, blurry, bad hands, cropped, worst quality, low quality, jpeg artifacts, watermark, unnatural lighting, unrealistic, artificial, fake looking, cartoon, anime, illustration, painting, drawing, art, canvas texture, smooth texture, grainy, low-res, pixelated, oversaturated, different layout, different furniture, different room, different perspective"
-            
+
+            negative_prompt = "deformed, distorted, disfigured, poorly drawn, bad anatomy, wrong proportions, blurry, bad hands, cropped, worst quality, low quality, jpeg artifacts, watermark, unnatural lighting, unrealistic, artificial, fake looking, cartoon, anime, illustration, painting, drawing, art, canvas texture, smooth texture, grainy, low-res, pixelated, oversaturated"
+
             # multipart/form-dataとして送信
             files = {
-                "init_image": open(processed_path, "rb")
+                "init_image": ("image.png", init_image, "image/png"),
+                "mask_image": ("mask.png", mask_image, "image/png")
             }
-            
-            # 重要なパラメータの調整
+
+            # パラメータの設定
             data = {
                 "text_prompts[0][text]": generation_prompt,
                 "text_prompts[0][weight]": "1.0",
                 "text_prompts[1][text]": negative_prompt,
                 "text_prompts[1][weight]": "-1.0",
-                "image_strength": "0.5",  # 元の画像の影響を35%に設定（変更をより反映）
-                "cfg_scale": "10",        # プロンプトへの忠実度を最大限に
+                "mask_source": "MASK_IMAGE_WHITE",  # 白い部分がマスク（変更する部分）
+                "cfg_scale": "10",        # プロンプトへの忠実度を上げる
                 "samples": "1",
-                "steps": "50",            # ステップ数を増やして品質向上
+                "steps": "50",            # ステップ数を増やす
                 "style_preset": "photographic",  # 写真風のスタイル
-                "seed": str(random.randint(1, 1000000))  # ランダムシード
+                "seed": str(seed if seed is not None else random.randint(1, 1000000))  # 未指定時はランダムシード
             }
-            
+
             # APIリクエスト
-            response = requests.post(endpoint, headers=headers, files=files, data=data)
-            
-            if response.status_code != 200:
-                logger.error(f"Stability AI APIエラー: {response.text}")
-                return jsonify({'error': f'画像生成に失敗しました: {response.text}'}), 500
-            
-            # レスポンスから画像データを取得
-            response_data = response.json()
-            if "artifacts" not in response_data or len(response_data["artifacts"]) == 0:
-                return jsonify({'error': 'APIレスポンスに画像データが含まれていません'}), 500
-            
-            image_base64 = response_data["artifacts"][0]["base64"]
-            image_bytes = base64.b64decode(image_base64)
-            
-            # 画像を保存
-            result_filename = f'edited-{timestamp}.png'
-            result_path = os.path.join(images_dir, result_filename)
-            
-            with open(result_path, 'wb') as f:
-                f.write(image_bytes)
-            
+            update_job_progress('generating')
+            result_bytes = request_generation(endpoint, files, data, timings, UPSTREAM_LANES['transform-room-area'])
+
+            update_job_progress('saving')
+
+            # 生成された画像から余白を除いて元のサイズに戻し、マスクの部分だけを元の写真に合成して、プレビューも作成
+            restored = run_image_task(image_pool.restore_result, result_bytes, api_size,
+                                      (paste_x, paste_y, paste_x + content_size[0], paste_y + content_size[1]),
+                                      crop_box, image_bytes, analyzed['alpha'], analyzed['size'],
+                                      PREVIEW_SIZE, PREVIEW_QUALITY, RESIZE_REDUCING_GAP)
+            merge_timings(timings, restored['timings'])
+
+            # 最終画像を保存
+            result_filename = artifact_filename('masked', artifact_id)
+            result_path = artifact_path(result_filename)
+
+            preview_filename, result_writes = save_result_image(restored['image'], result_filename,
+                                                                timings, preview_bytes=restored['preview'])
+            wait_for_writes([original_write] + result_writes, timings)
+
             logger.info('生成された画像を保存: %s', result_path)
-            
-            # レスポンスを返す
+            log_timings('transform-room-area', timings)
+
             local_image_url = f'/generated-images/{result_filename}'
-            return jsonify({
+            return {
                 'imageUrl': local_image_url,
                 'originalUrl': local_original_url,
-                'message': '部屋のカスタマイズが完了しました'
-            })
-            
+                'previewUrl': f'/generated-images/{preview_filename}',
+                'message': '部屋の領域変更が完了しました',
+                'timings': timings
+            }
+
+        except GenerationError:
+            raise
         except Exception as api_error:
             logger.error('Stability AI APIエラー: %s', str(api_error), exc_info=True)
-            return jsonify({'error': f'画像生成に失敗しました: {str(api_error)}'}), 500
-    
+            raise GenerationError(f'画像生成に失敗しました: {str(api_error)}')
+
+    except GenerationError:
+        raise
+    except Exception as error:
+        logger.error('部屋の領域変更エラー: %s', str(error), exc_info=True)
+        raise GenerationError(f'部屋の領域変更に失敗しました: {str(error)}')
+
+@app.route('/api/customize-room', methods=['POST'])
+def customize_room():
+    try:
+        try:
+            data, image_bytes, _ = read_generation_input()
+        except ValueError:
+            return jsonify({'error': '画像データが不正です'}), 400
+
+        prompt = data.get('prompt')
+
+        if not image_bytes:
+            return jsonify({'error': '画像データが必要です'}), 400
+
+        if prompt is not None and not isinstance(prompt, str):
+            return jsonify({'error': 'プロンプトは文字列で指定してください'}), 400
+
+        if not prompt or not prompt.strip():
+            return jsonify({'error': 'プロンプトが必要です'}), 400
+
+        logger.info('部屋のカスタマイズリクエスト受信')
+        logger.info('プロンプト: %s', prompt)
+
+        # プロンプトを英語に翻訳
+        translated_prompt = translate_text(prompt)
+        logger.info('翻訳されたプロンプト: %s', translated_prompt)
+
+        # プロンプトを解析して具体的な変更指示を生成
+        change_request = parse_room_change_request(prompt)
+        specific_prompt = generate_specific_prompt(change_request)
+        logger.info('生成された具体的なプロンプト: %s', specific_prompt)
+
+        seed = parse_seed(data.get('seed'))
+
+        request_key = compute_request_key('customize-room', image_bytes, seed=seed, prompt=specific_prompt)
+        cache_key = None
+        if parse_flag(data.get('cache')):
+            cache_key = compute_cache_key(request_key, seed)
+
+        return dispatch_generation('customize-room', run_room_customization,
+                                   image_bytes, specific_prompt, seed, cache_key=cache_key, flight_key=request_key)
+
     except Exception as error:
         logger.error('部屋のカスタマイズエラー: %s', str(error), exc_info=True)
         return jsonify({'error': f'部屋のカスタマイズに失敗しました: {str(error)}'}), 500
 
+def run_room_customization(image_bytes, specific_prompt, seed=None):
+    """
+    部屋のカスタマイズ（ジョブ本体）
+    """
+    timings = {}
+    update_job_progress('decoding')
+    artifact_id = new_artifact_id()
+
+    # 画像を前処理（リサイズと最適化）
+    try:
+        update_job_progress('preprocessing')
+        init_png, source = preprocess_image(image_bytes, select_target_size, timings)
+        init_image = io.BytesIO(init_png)
+
+        save_debug_artifact(artifact_filename('processed', artifact_id), init_png)
+    except Exception as img_error:
+        logger.error("画像処理エラー: %s", str(img_error))
+        raise GenerationError(f'画像処理に失敗しました: {str(img_error)}')
+
+    # 元の画像を保存
+    original_filename, original_write = save_original_upload(image_bytes, source, artifact_id)
+    local_original_url = f'/generated-images/{original_filename}'
+
+    try:
+        # 最新のStability AI APIエンドポイント
+        endpoint = f'{STABILITY_ENGINE_PATH}/image-to-image'
+
+        # プロンプトを作成（より強力な指示）
+        generation_prompt = f"""
+        THIS IS AN IMAGE-TO-IMAGE TASK.
+
+        SPECIFIC INSTRUCTION: {specific_prompt}
+
+        DO NOT change the room layout, perspective, or camera angle.
+        DO NOT add or remove furniture unless explicitly requested.
+        ONLY modify the exact elements mentioned in the instruction.
+
+        Photorealistic, professional interior photography, detailed textures, natural lighting
+        """
+
+        negative_prompt = "deformed, distorted, disfigured, poorly drawn, bad anatomy, wrong proportions, blurry, bad hands, cropped, worst quality, low quality, jpeg artifacts, watermark, unnatural lighting, unrealistic, artificial, fake looking, cartoon, anime, illustration, painting, drawing, art, canvas texture, smooth texture, grainy, low-res, pixelated, oversaturated, different layout, different furniture, different room, different perspective"
+
+        # multipart/form-dataとして送信
+        files = {
+            "init_image": ("image.png", init_image, "image/png")
+        }
+
+        # 重要なパラメータの調整
+        data = {
+            "text_prompts[0][text]": generation_prompt,
+            "text_prompts[0][weight]": "1.0",
+            "text_prompts[1][text]": negative_prompt,
+            "text_prompts[1][weight]": "-1.0",
+            "image_strength": "0.5",  # 元の画像の影響を35%に設定（変更をより反映）
+            "cfg_scale": "10",        # プロンプトへの忠実度を最大限に
+            "samples": "1",
+            "steps": "50",            # ステップ数を増やして品質向上
+            "style_preset": "photographic",  # 写真風のスタイル
+            "seed": str(seed if seed is not None else random.randint(1, 1000000))  # 未指定時はランダムシード
+        }
+
+        # APIリクエスト
+        update_job_progress('generating')
+        result_bytes = request_generation(endpoint, files, data, timings, UPSTREAM_LANES['customize-room'])
+
+        # 画像を保存
+        update_job_progress('saving')
+        result_filename = artifact_filename('edited', artifact_id)
+        result_path = artifact_path(result_filename)
+
+        preview_filename, result_writes = save_result_image(result_bytes, result_filename, timings)
+        wait_for_writes([original_write] + result_writes, timings)
+
+        logger.info('生成された画像を保存: %s', result_path)
+        log_timings('customize-room', timings)
+
+        local_image_url = f'/generated-images/{result_filename}'
+        return {
+            'imageUrl': local_image_url,
+            'originalUrl': local_original_url,
+            'previewUrl': f'/generated-images/{preview_filename}',
+            'message': '部屋のカスタマイズが完了しました',
+            'timings': timings
+        }
+
+    except GenerationError:
+        raise
+    except Exception as api_error:
+        logger.error('Stability AI APIエラー: %s', str(api_error), exc_info=True)
+        raise GenerationError(f'画像生成に失敗しました: {str(api_error)}')
+
+# カスタマイズ指示の解析用キーワード（英語の値はgenerate_specific_promptで使う名前）
+ROOM_PART_KEYWORDS = {
+    "floor": ("床", "フローリング", "フロア", "floor"),
+    "wall": ("壁", "壁紙", "クロス", "wall"),
+    "ceiling": ("天井", "ceiling"),
+    "furniture": ("家具", "ソファ", "テーブル", "椅子", "イス", "ベッド", "棚", "furniture"),
+    "curtains": ("カーテン", "curtain"),
+    "lighting": ("照明", "ライト", "ランプ", "lighting"),
+}
+ROOM_COLOR_KEYWORDS = {
+    "white": ("白", "ホワイト", "white"),
+    "black": ("黒", "ブラック", "black"),
+    "blue": ("青", "ブルー", "blue"),
+    "light blue": ("水色", "空色", "ライトブルー"),
+    "navy": ("紺", "ネイビー", "navy"),
+    "red": ("赤", "レッド", "red"),
+    "pink": ("ピンク", "桃色", "pink"),
+    "orange": ("オレンジ", "橙", "orange"),
+    "yellow": ("黄色", "黄", "イエロー", "yellow"),
+    "green": ("緑", "グリーン", "green"),
+    "purple": ("紫", "パープル", "purple"),
+    "gray": ("グレー", "灰色", "gray", "grey"),
+    "brown": ("茶色", "茶", "ブラウン", "brown"),
+    "beige": ("ベージュ", "beige"),
+    "warm": ("暖色", "電球色", "温かみのある", "warm"),
+    "cool": ("寒色", "昼白色", "cool"),
+}
+ROOM_MATERIAL_KEYWORDS = {
+    "wood": ("木製", "木目", "木", "ウッド", "無垢", "wood"),
+    "marble": ("大理石", "マーブル", "marble"),
+    "stone": ("石", "ストーン", "stone"),
+    "concrete": ("コンクリート", "コンクリ", "concrete"),
+    "brick": ("レンガ", "煉瓦", "brick"),
+    "tile": ("タイル", "tile"),
+    "metal": ("金属", "メタル", "metal"),
+    "glass": ("ガラス", "glass"),
+    "fabric": ("布", "ファブリック", "fabric"),
+    "leather": ("革", "レザー", "leather"),
+    "tatami": ("畳", "tatami"),
+}
+# 解析結果をキャッシュする件数（正規化したプロンプトごと）
+CHANGE_REQUEST_CACHE_SIZE = int(os.getenv('CHANGE_REQUEST_CACHE_SIZE', '1024'))
+
+def compile_keyword_table(table):
+    """{値: (キーワード, ...)} から、キーワード→値の辞書と最長一致の正規表現を作る"""
+    lookup = {keyword: value for value, keywords in table.items() for keyword in keywords}
+    return lookup, compile_trie_pattern(lookup)
+
+# 変更後の値を示す後続の語（「黒にして」「黒へ」「黒色に」「黒くして」「木製に」）
+# 「白い壁を黒にして」の「白い」のような今の状態を表す修飾語と区別するために使う
+CHANGE_TARGET_SUFFIX = re.compile(r'\s*(?:色|系|製)?\s*(?:に|へ|く)')
+
+change_request_matchers = {
+    "part": compile_keyword_table(ROOM_PART_KEYWORDS),
+    "color": compile_keyword_table(ROOM_COLOR_KEYWORDS),
+    "material": compile_keyword_table(ROOM_MATERIAL_KEYWORDS),
+}
+
+def normalize_prompt(prompt):
+    """全角・半角や大文字・小文字、空白の違いを吸収する"""
+    return ' '.join(unicodedata.normalize('NFKC', prompt).lower().split())
+
+def select_change_target(lookup, matches, text):
+    """
+    色・素材のうち変更後の値を選ぶ
+    「〜に」「〜へ」などが続くものを優先し、無ければ最後に出てきたものを使う
+    """
+    if not matches:
+        return None
+    for match in matches:
+        if CHANGE_TARGET_SUFFIX.match(text, match.end()):
+            return lookup[match.group(0)]
+    return lookup[matches[-1].group(0)]
+
+@functools.lru_cache(maxsize=CHANGE_REQUEST_CACHE_SIZE)
+def parse_normalized_change_request(normalized_prompt):
+    found = {field: list(pattern.finditer(normalized_prompt))
+             for field, (_, pattern) in change_request_matchers.items()}
+
+    # 色・素材の語の一部（「ライトブルー」の「ライト」など）は部位として扱わない
+    spans = [match.span() for field in ('color', 'material') for match in found[field]]
+    parts = [match for match in found['part']
+             if not any(start < match.end() and match.start() < end for start, end in spans)]
+
+    # 部位は最初に出てきたもの（「壁を」のように変更の対象が先に来る）
+    part_lookup = change_request_matchers['part'][0]
+    return (
+        ('part', part_lookup[parts[0].group(0)] if parts else None),
+        ('color', select_change_target(change_request_matchers['color'][0], found['color'], normalized_prompt)),
+        ('material', select_change_target(change_request_matchers['material'][0], found['material'],
+                                          normalized_prompt)),
+    )
+
+def parse_room_change_request(prompt):
+    """
+    カスタマイズの指示から変更する部位・色・素材を取り出す
+    例: 「床を白い大理石にして」→ {"part": "floor", "color": "white", "material": "marble"}
+        「白い壁を黒にして」→ {"part": "wall", "color": "black", "material": None}
+    """
+    return dict(parse_normalized_change_request(normalize_prompt(prompt)))
+
 def generate_specific_prompt(change_request):
     """
     解析された変更リクエストから具体的なプロンプトを生成
     """
+    templates = get_prompt_templates()
+    specific_prompts = templates["specific_prompts"]
     if not change_request:
-        return "Make the room look better while keeping the same layout and furniture."
-    
-    part = change_request.get("part")
+        return specific_prompts["default"]
+
+    part = templates["parts"].get(change_request.get("part"))
     color = change_request.get("color")
-    
-    if not part and not color:
-        return "Make the room look better while keeping the same layout and furniture."
-    
-    # より強力なプロンプトを生成
-    prompt_parts = []
-    
+    material = change_request.get("material")
+
     if part and color:
-        if part == "floor":
-            return f"Change ONLY the floor to {color} color. The floor should be {color}. Keep everything else exactly the same."
-        elif part == "wall":
-            return f"Change ONLY the walls to {color} color. The walls should be {color}. Keep everything else exactly the same."
-        elif part == "ceiling":
-            return f"Change ONLY the ceiling to {color} color. The ceiling should be {color}. Keep everything else exactly the same."
-        elif part == "furniture":
-            return f"Change ONLY the furniture to {color} color. The furniture should be {color}. Keep everything else exactly the same."
-        elif part == "curtains":
-            return f"Change ONLY the curtains to {color} color. The curtains should be {color}. Keep everything else exactly the same."
-        elif part == "lighting":
-            return f"Change ONLY the lighting to {color} tone. The lighting should be {color}. Keep everything else exactly the same."
+        prompt = specific_prompts["part_color"].format(color=color, **part)
     elif part:
-        if part == "floor":
-            return f"Change ONLY the floor. Keep everything else exactly the same."
-        elif part == "wall":
-            return f"Change ONLY the walls. Keep everything else exactly the same."
-        elif part == "ceiling":
-            return f"Change ONLY the ceiling. Keep everything else exactly the same."
-        elif part == "furniture":
-            return f"Change ONLY the furniture. Keep everything else exactly the same."
-        elif part == "curtains":
-            return f"Change ONLY the curtains. Keep everything else exactly the same."
-        elif part == "lighting":
-            return f"Change ONLY the lighting. Keep everything else exactly the same."
+        prompt = specific_prompts["part"].format(**part)
     elif color:
-        return f"Change the color scheme to {color}. The room should have {color} tones."
-    
-    return "Make the room look better while keeping the same layout and furniture."
+        prompt = specific_prompts["color"].format(color=color)
+    elif material:
+        prompt = None
+    else:
+        return specific_prompts["default"]
+
+    if material:
+        # 部位の指定が無い場合は部屋全体の素材として指示する
+        if part:
+            material_prompt = specific_prompts["material"].format(material=material, **part)
+        else:
+            material_prompt = specific_prompts["room_material"].format(material=material)
+        prompt = f'{prompt} {material_prompt}' if prompt else material_prompt
+    return prompt
 
 # プロンプト生成部分を修正
 def generate_style_prompt(style):
-    style_info = STYLE_DETAILS.get(style, STYLE_DETAILS["simple"])
-    
-    main_prompt = f"""
-    Transform this interior space into a {style_info['main']}.
-    
-    Style requirements:
-    - Colors: {style_info['colors']}
-    - Materials: {style_info['materials']}
-    - Furniture: {style_info['furniture']}
-    - Lighting: {style_info['lighting']}
-    - Atmosphere: {style_info['mood']}
-    
-    Critical requirements:
-    - Maintain the exact room layout and dimensions
-    - Keep all window and door positions unchanged
-    - Preserve the room's basic structure
-    - Create photorealistic interior photography quality
-    - Ensure perfect perspective and spatial coherence
-    - Use appropriate lighting and shadows
-    - Generate in ultra-high-definition 8K quality
-    - Create realistic materials and textures
-    
-    This must be a photorealistic interior design visualization, not an artistic interpretation.
-    ((highly detailed)), ((ultra realistic)), ((photorealistic)), ((interior design)), ((professional photography))
-    """
-
-    negative_prompt = """
-    ((deformed)), ((distorted)), ((disfigured)), ((poorly drawn)), ((bad anatomy)), ((wrong proportions)),
-    ((blurry)), ((pixelated)), ((grainy)), ((low quality)), ((jpeg artifacts)), ((compression artifacts)),
-    ((watermark)), ((signature)), ((text)), ((logo)),
-    ((unrealistic lighting)), ((bad shadows)), ((harsh lighting)), ((overexposed)), ((underexposed)),
-    ((cartoon)), ((anime)), ((illustration)), ((painting)), ((3d render)), ((cgi)), ((artificial)),
-    ((oversaturated)), ((unrealistic colors)), ((color bleeding)),
-    ((out of frame)), ((cropped)), ((cut off)),
-    ((wrong perspective)), ((distorted space)), ((curved lines)), ((warped surfaces)),
-    ((duplicate)), ((multiple)), ((repeating elements))
-    """
-
-    return main_prompt, negative_prompt
+    """スタイルのプロンプトとネガティブプロンプト（起動時・再読み込み時に描画済み）"""
+    templates = get_prompt_templates()
+    style_prompts = templates["style_prompts"]
+    return style_prompts.get(style, style_prompts[templates["default_style"]])
 
 if __name__ == '__main__':
     # Renderのポート設定を取得（デフォルトは5000）
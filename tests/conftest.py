@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# server.pyは読み込み時に環境変数を参照するため、importより前に設定する
+os.environ.setdefault('STABILITY_API_KEY', 'test')
+os.environ['ARTIFACT_GC_INTERVAL'] = '0'
+os.environ['HISTORY_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='rooms-test-'), 'history.sqlite3')
+
+import server  # noqa: E402
+
+
+class Clock:
+    """server.timeの代わりに使う時計（sleepで時刻だけを進める）"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """server.timeを止まった時計に差し替える"""
+    clock = Clock()
+    monkeypatch.setattr(server, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """生成物・キャッシュ・履歴DBの保存先を一時ディレクトリに切り替える"""
+    paths = {
+        'images_dir': tmp_path / 'generated-images',
+        'cache_dir': tmp_path / 'result-cache',
+        'jobs_dir': tmp_path / 'jobs',
+        'inflight_dir': tmp_path / 'inflight',
+    }
+    for name, path in paths.items():
+        path.mkdir()
+        monkeypatch.setattr(server, name, str(path))
+    monkeypatch.setattr(server, 'gc_lock_path', str(tmp_path / 'gc.lock'))
+    monkeypatch.setattr(server, 'HISTORY_DB_PATH', str(tmp_path / 'history.sqlite3'))
+    server.init_history_db()
+    return tmp_path
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
@@ -0,0 +1,28 @@
+import io
+
+import pytest
+from PIL import Image
+
+import server
+
+
+def png_bytes(mode, size, color):
+    buffer = io.BytesIO()
+    Image.new(mode, size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('min_coverage', [0.0, server.MASK_MIN_COVERAGE])
+@pytest.mark.parametrize('mask', [png_bytes('L', (64, 48), 0), png_bytes('RGBA', (64, 48), (255, 255, 255, 0))],
+                         ids=['black', 'transparent'])
+def test_empty_mask_is_rejected_before_upstream(storage, monkeypatch, min_coverage, mask):
+    monkeypatch.setattr(server, 'MASK_MIN_COVERAGE', min_coverage)
+    posted = []
+    monkeypatch.setattr(server.stability_client, 'post', lambda *args, **kwargs: posted.append(args))
+
+    with pytest.raises(server.GenerationError) as excinfo:
+        server.run_room_area_transform(png_bytes('RGB', (64, 48), 'white'), mask, 'white walls')
+
+    assert excinfo.value.status_code == 400
+    assert excinfo.value.message == 'マスクが空です。変更したい部分を塗ってください'
+    assert posted == []
@@ -0,0 +1,44 @@
+import io
+import json
+
+from PIL import Image
+
+import server
+
+
+def image_bytes():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def post_styles(client, styles):
+    data = {'styles': ','.join(styles), 'seed': '1', 'cache': '0', 'image': (io.BytesIO(image_bytes()), 'image')}
+    return client.post('/api/transform-room-styles', data=data)
+
+
+def test_batch_over_style_limit_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(server, 'BATCH_MAX_STYLES', 2)
+    generated = []
+    monkeypatch.setattr(server, 'generate_style_variant', lambda *args: generated.append(args))
+
+    response = post_styles(client, list(server.get_prompt_templates()['style_prompts'])[:3])
+
+    assert response.status_code == 400
+    assert '2件まで' in response.json['error']
+    assert generated == []
+
+
+def test_duplicate_styles_count_once_toward_limit(storage, client, monkeypatch):
+    monkeypatch.setattr(server, 'BATCH_MAX_STYLES', 2)
+
+    def generate(style_input, style, seed, timings, lane):
+        return {'imageUrl': f'/generated-images/{style}.png'}
+    monkeypatch.setattr(server, 'generate_style_variant', generate)
+    styles = list(server.get_prompt_templates()['style_prompts'])[:2]
+
+    response = post_styles(client, styles + styles)
+
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert sorted(line['style'] for line in lines) == sorted(styles)
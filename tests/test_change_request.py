@@ -0,0 +1,46 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize('prompt, expected', [
+    ('白い壁を黒にして', {'part': 'wall', 'color': 'black', 'material': None}),
+    ('黒いソファを白へ', {'part': 'furniture', 'color': 'white', 'material': None}),
+    ('赤いカーテンを青色にしたい', {'part': 'curtains', 'color': 'blue', 'material': None}),
+    ('壁を白くして', {'part': 'wall', 'color': 'white', 'material': None}),
+    ('床を白い大理石にして', {'part': 'floor', 'color': 'white', 'material': 'marble'}),
+    ('木の床を大理石にして', {'part': 'floor', 'color': None, 'material': 'marble'}),
+    # 色の語の一部（ライトブルーのライト）は部位（照明）として扱わない
+    ('ライトブルーのカーテンにして', {'part': 'curtains', 'color': 'light blue', 'material': None}),
+    ('カーテンをライトブルーにして', {'part': 'curtains', 'color': 'light blue', 'material': None}),
+    ('照明を暖色にして', {'part': 'lighting', 'color': 'warm', 'material': None}),
+    # 「〜に」が無い場合は最後に出てきた色を使う
+    ('white walls, black', {'part': 'wall', 'color': 'black', 'material': None}),
+])
+def test_change_target_prefers_color_and_material_after_particle(prompt, expected):
+    assert server.parse_room_change_request(prompt) == expected
+
+
+def test_target_color_is_used_in_prompt():
+    prompt = server.generate_specific_prompt(server.parse_room_change_request('白い壁を黒にして'))
+
+    assert 'walls to black' in prompt
+    assert 'white' not in prompt
+
+
+@pytest.mark.parametrize('prompt', ['大理石にして', '全体を木目調にして'])
+def test_material_without_part_is_kept(prompt):
+    change_request = server.parse_room_change_request(prompt)
+    assert change_request['part'] is None
+
+    specific_prompt = server.generate_specific_prompt(change_request)
+
+    assert change_request['material'] in specific_prompt
+    assert specific_prompt != server.get_prompt_templates()['specific_prompts']['default']
+
+
+def test_material_without_part_keeps_color():
+    specific_prompt = server.generate_specific_prompt(server.parse_room_change_request('白い大理石にして'))
+
+    assert 'white' in specific_prompt
+    assert 'marble' in specific_prompt
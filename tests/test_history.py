@@ -0,0 +1,66 @@
+import os
+import time
+
+import server
+
+CLIENT_HEADERS = {'X-Client-Id': 'test-client-0001'}
+
+
+def write_artifact(filename, data=b'image', age=0):
+    """generated-images/にファイルを作り、URLを返す（ageで更新時刻を過去にずらす）"""
+    path = server.artifact_path(filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if age:
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+    return f'/generated-images/{filename}'
+
+
+def make_result(artifact_id, original_url, age=0):
+    return {
+        'imageUrl': write_artifact(server.artifact_filename('styled', artifact_id), age=age),
+        'previewUrl': write_artifact(server.artifact_filename('styled', artifact_id, 'preview.webp'), age=age),
+        'originalUrl': original_url
+    }
+
+
+def history_urls(client):
+    response = client.get('/api/history', headers=CLIENT_HEADERS)
+    assert response.status_code == 200
+    return [item['imageUrl'] for item in response.json['items']]
+
+
+def test_cache_eviction_keeps_images_referenced_by_history(storage, client, monkeypatch):
+    # 一括生成と同じく、2つの結果が元画像を共有する
+    original_url = write_artifact(server.artifact_filename('original', 'shared', 'jpg'))
+    first = make_result('first', original_url)
+    second = make_result('second', original_url)
+    for cache_key, result in (('a' * 64, first), ('b' * 64, second)):
+        server.store_cached_result(cache_key, result)
+        server.record_history(CLIENT_HEADERS['X-Client-Id'], 'transform-room-style', result)
+
+    monkeypatch.setattr(server, 'RESULT_CACHE_MAX_BYTES', 0)
+    server.evict_result_cache()
+
+    # キャッシュの索引は削除されるが、履歴が参照する画像は残る
+    assert os.listdir(server.cache_dir) == []
+    assert server.lookup_cached_result('a' * 64) is None
+    assert history_urls(client) == [second['imageUrl'], first['imageUrl']]
+    for result in (first, second):
+        for url in result.values():
+            assert client.get(url).status_code == 200
+
+
+def test_garbage_collection_removes_history_of_deleted_images(storage, client):
+    original_url = write_artifact(server.artifact_filename('original', 'old', 'jpg'), age=server.ARTIFACT_MAX_AGE + 60)
+    old = make_result('old', original_url, age=server.ARTIFACT_MAX_AGE + 60)
+    new = make_result('new', write_artifact(server.artifact_filename('original', 'new', 'jpg')))
+    for result in (old, new):
+        server.record_history(CLIENT_HEADERS['X-Client-Id'], 'transform-room-style', result)
+
+    server.collect_garbage()
+
+    assert history_urls(client) == [new['imageUrl']]
+    assert client.get(old['imageUrl']).status_code == 404
+    assert client.get(new['imageUrl']).status_code == 200
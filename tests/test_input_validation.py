@@ -0,0 +1,42 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+
+def image_data_url():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.mark.parametrize('endpoint', ['/api/transform-room-style', '/api/transform-room-area',
+                                      '/api/customize-room', '/api/transform-room-styles'])
+@pytest.mark.parametrize('body', [{'imageData': 123}, {'imageData': ['a']}, {'maskData': {}}, ['not', 'an', 'object']])
+def test_non_string_image_data_is_rejected(client, endpoint, body):
+    response = client.post(endpoint, json=body)
+
+    assert response.status_code == 400
+    assert response.json['error'] == '画像データが不正です'
+
+
+@pytest.mark.parametrize('endpoint, field', [
+    ('/api/customize-room', 'prompt'),
+    ('/api/transform-room-area', 'prompt'),
+    ('/api/transform-room-style', 'style'),
+])
+@pytest.mark.parametrize('value', [123, ['壁を白く'], {'text': '壁を白く'}])
+def test_non_string_parameters_are_rejected(client, endpoint, field, value):
+    image = image_data_url()
+    response = client.post(endpoint, json={'imageData': image, 'maskData': image, field: value})
+
+    assert response.status_code == 400
+    assert '文字列' in response.json['error']
+
+
+def test_non_string_styles_are_rejected(client):
+    response = client.post('/api/transform-room-styles', json={'imageData': image_data_url(), 'styles': ['simple', 1]})
+
+    assert response.status_code == 400
+    assert '文字列' in response.json['error']
@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+import time
+
+import server
+
+
+def finished_pid():
+    """終了済みのプロセスのpid"""
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def save_running_job(pid):
+    job = {
+        'jobId': 'f' * 32,
+        'kind': 'transform-room-style',
+        'status': 'running',
+        'progress': {'stage': 'generating', 'percent': 40},
+        'createdAt': time.time(),
+        'pid': pid
+    }
+    server.save_job(job)
+    return job
+
+
+def test_job_of_exited_worker_is_marked_failed(storage, client):
+    job = save_running_job(finished_pid())
+
+    response = client.get(f"/api/jobs/{job['jobId']}")
+
+    assert response.json['status'] == 'failed'
+    assert response.json['statusCode'] == 503
+    assert server.load_job(job['jobId'])['status'] == 'failed'
+
+
+def test_job_of_running_worker_stays_running(storage, client):
+    job = save_running_job(os.getpid())
+
+    assert client.get(f"/api/jobs/{job['jobId']}").json['status'] == 'running'
+
+
+def test_job_events_stream_closes_before_worker_timeout(storage, client, monkeypatch):
+    monkeypatch.setattr(server, 'JOB_EVENTS_TIMEOUT', 0.2)
+    monkeypatch.setattr(server, 'JOB_EVENTS_INTERVAL', 0.05)
+    job = save_running_job(os.getpid())
+
+    body = client.get(f"/api/jobs/{job['jobId']}/events").get_data(as_text=True)
+
+    assert body.startswith(f'retry: {server.JOB_EVENTS_RETRY_MS}\n\n')
+    assert body.count('event: running') == 1
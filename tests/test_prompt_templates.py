@@ -0,0 +1,83 @@
+import io
+import json
+import os
+import shutil
+
+import pytest
+from PIL import Image
+
+import server
+
+
+@pytest.fixture
+def templates_path(tmp_path, monkeypatch):
+    """テンプレートファイルを一時ディレクトリにコピーし、その内容を読み込んだ状態にする"""
+    path = tmp_path / 'prompt_templates.json'
+    shutil.copy(server.PROMPT_TEMPLATES_PATH, path)
+    monkeypatch.setattr(server, 'PROMPT_TEMPLATES_PATH', str(path))
+    monkeypatch.setattr(server, 'prompt_templates_state', {'templates': None, 'mtime': None, 'checked_at': 0.0})
+    server.get_prompt_templates()
+    return path
+
+
+def image_bytes():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def edit_templates(path, edit):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    edit(data)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    # 更新時刻を確実に変え、次の呼び出しで再読み込みさせる
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    server.prompt_templates_state['checked_at'] = 0.0
+
+
+@pytest.mark.parametrize('edit', [
+    lambda data: data['specific_prompts'].update(part_color='Change the {noun} to {colour}.'),
+    lambda data: data['specific_prompts'].update(room_material='Use {materials}.'),
+    lambda data: data['parts']['wall'].pop('tone'),
+    lambda data: data['parts'].update(wall='walls'),
+])
+def test_reload_with_unrenderable_specific_prompt_keeps_previous_templates(templates_path, edit):
+    previous = server.get_prompt_templates()
+
+    edit_templates(templates_path, edit)
+
+    assert server.get_prompt_templates() is previous
+    change_request = server.parse_room_change_request('壁を黒にして')
+    assert 'black' in server.generate_specific_prompt(change_request)
+
+
+def test_reload_with_valid_specific_prompt_is_applied(templates_path):
+    edit_templates(templates_path, lambda data: data['specific_prompts'].update(
+        part_color='Paint the {noun} {color} ({tone}).'))
+
+    change_request = server.parse_room_change_request('壁を黒にして')
+    assert server.generate_specific_prompt(change_request) == 'Paint the walls black (color).'
+
+
+def test_editing_style_prompt_changes_cache_key(templates_path, client, monkeypatch, storage):
+    keys = []
+
+    def capture(kind, func, *args, cache_key=None, flight_key=None):
+        keys.append((cache_key, flight_key))
+        return server.jsonify({})
+    monkeypatch.setattr(server, 'dispatch_generation', capture)
+
+    def post():
+        data = {'style': 'simple', 'seed': '1', 'image': (io.BytesIO(image_bytes()), 'image')}
+        assert client.post('/api/transform-room-style', data=data).status_code == 200
+
+    post()
+    post()
+    edit_templates(templates_path, lambda data: data['style_prompt'].append('Add more plants.'))
+    post()
+
+    assert keys[0] == keys[1]
+    assert keys[2][0] != keys[0][0] and keys[2][1] != keys[0][1]
@@ -0,0 +1,131 @@
+import pytest
+import requests
+
+import server
+
+
+class FakeResponse:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    """順番に結果（レスポンスまたは例外）を返すセッション"""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.timeouts = []
+
+    def post(self, url, files=None, data=None, timeout=None):
+        self.timeouts.append(timeout)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def make_client(tmp_path, outcomes, limiter=None, **options):
+    settings = dict(pool_size=1, connect_timeout=5, read_timeout=90, total_timeout=100, max_retries=3,
+                    backoff_base=1.0, backoff_max=20, breaker_threshold=5, breaker_cooldown=30)
+    settings.update(options)
+    if limiter is None:
+        limiter = server.UpstreamRateLimiter(str(tmp_path / 'upstream-rate.json'), rate=0, burst=0,
+                                             shares={}, max_wait=0)
+    client = server.StabilityClient('http://stub', 'test', rate_limiter=limiter, **settings)
+    client.session = FakeSession(outcomes)
+    return client
+
+
+@pytest.mark.parametrize('error', [requests.ConnectionError('refused'), requests.ConnectTimeout('connect')])
+def test_connection_errors_are_retried(tmp_path, clock, error):
+    client = make_client(tmp_path, [error, FakeResponse(200)])
+
+    assert client.post('/path').status_code == 200
+    assert len(client.session.timeouts) == 2
+
+
+def test_read_timeout_is_not_retried(tmp_path, clock):
+    client = make_client(tmp_path, [requests.ReadTimeout('read'), FakeResponse(200)])
+
+    with pytest.raises(requests.ReadTimeout):
+        client.post('/path')
+    assert len(client.session.timeouts) == 1
+    assert client._consecutive_failures == 1
+
+
+def test_retryable_status_is_retried_after_retry_after(tmp_path, clock):
+    first = FakeResponse(503, retry_after=3)
+    client = make_client(tmp_path, [first, FakeResponse(200)])
+
+    assert client.post('/path').status_code == 200
+    assert first.closed
+    assert clock.sleeps == [3]
+
+
+def test_last_retryable_response_is_returned(tmp_path, clock):
+    client = make_client(tmp_path, [FakeResponse(502, retry_after=1)] * 3, max_retries=2)
+
+    assert client.post('/path').status_code == 502
+    assert len(client.session.timeouts) == 3
+
+
+def test_retry_past_deadline_is_skipped(tmp_path, clock):
+    client = make_client(tmp_path, [FakeResponse(503, retry_after=10), FakeResponse(200)], total_timeout=12)
+
+    assert client.post('/path').status_code == 503
+    assert clock.sleeps == []
+
+
+def test_read_timeout_is_clamped_to_deadline(tmp_path, clock):
+    client = make_client(tmp_path, [FakeResponse(503, retry_after=20), FakeResponse(200)])
+
+    assert client.post('/path').status_code == 200
+    assert client.session.timeouts == [(5, 90), (5, 80)]
+
+
+def test_breaker_opens_after_threshold_and_closes_after_cooldown(tmp_path, clock):
+    outcomes = [requests.ConnectionError('refused'), requests.ConnectionError('refused'), FakeResponse(200)]
+    client = make_client(tmp_path, outcomes, max_retries=0, breaker_threshold=2, breaker_cooldown=30)
+
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            client.post('/path')
+    with pytest.raises(server.GenerationError) as excinfo:
+        client.post('/path')
+    assert excinfo.value.status_code == 503
+    assert len(client.session.timeouts) == 2
+
+    clock.now += 30
+    assert client.post('/path').status_code == 200
+    assert client._consecutive_failures == 0
+
+
+def test_breaker_stops_retries_once_open(tmp_path, clock):
+    outcomes = [requests.ConnectionError('refused')] * 2 + [FakeResponse(200)]
+    client = make_client(tmp_path, outcomes, breaker_threshold=2)
+
+    with pytest.raises(server.GenerationError):
+        client.post('/path')
+    assert len(client.session.timeouts) == 2
+
+
+def test_rate_limited_response_pauses_all_lanes(tmp_path, clock):
+    limiter = server.UpstreamRateLimiter(str(tmp_path / 'upstream-rate.json'), rate=2, burst=1,
+                                         shares={'image-to-image': 1, 'masking': 1}, max_wait=5)
+    client = make_client(tmp_path, [FakeResponse(429, retry_after=8), FakeResponse(200)], limiter=limiter)
+
+    assert client.post('/path', lane='image-to-image').status_code == 200
+    # 再試行はRetry-Afterの分だけ待ってから送信する
+    assert clock.sleeps == [8]
+
+    # 他のレーンの新しいリクエストも、待ち時間が上限を超えるため受け付けない
+    clock.now -= 8
+    with pytest.raises(server.GenerationError) as excinfo:
+        limiter.admit('masking')
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.retry_after == pytest.approx(3)
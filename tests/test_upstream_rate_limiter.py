@@ -0,0 +1,61 @@
+import pytest
+
+import server
+
+
+def make_limiter(tmp_path, rate=1, burst=3, max_wait=2):
+    return server.UpstreamRateLimiter(str(tmp_path / 'upstream-rate.json'), rate=rate, burst=burst,
+                                      shares={'image-to-image': 1}, max_wait=max_wait)
+
+
+def test_burst_is_admitted_then_spaced_then_rejected(tmp_path, clock):
+    limiter = make_limiter(tmp_path)
+
+    waits = [limiter.reserve('image-to-image') for _ in range(5)]
+    with pytest.raises(server.GenerationError) as excinfo:
+        limiter.reserve('image-to-image')
+
+    # burst（3秒分）の3件は待たずに送れ、その後は1秒間隔になる
+    assert waits == [0, 0, 0, 1, 2]
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.retry_after == pytest.approx(1)
+
+
+def test_rejected_request_does_not_take_a_slot(tmp_path, clock):
+    limiter = make_limiter(tmp_path, burst=1, max_wait=0)
+    limiter.reserve('image-to-image')
+
+    for _ in range(3):
+        with pytest.raises(server.GenerationError):
+            limiter.reserve('image-to-image')
+        with pytest.raises(server.GenerationError):
+            limiter.admit('image-to-image')
+
+    clock.now += 1
+    assert limiter.reserve('image-to-image') == 0
+
+
+def test_retries_are_reserved_without_admission(tmp_path, clock):
+    limiter = make_limiter(tmp_path, burst=1, max_wait=0)
+    limiter.reserve('image-to-image')
+
+    assert limiter.reserve('image-to-image', admit=False) == 1
+    assert limiter.reserve('image-to-image', admit=False) == 2
+
+
+def test_penalize_delays_next_reservation(tmp_path, clock):
+    limiter = make_limiter(tmp_path, max_wait=10)
+
+    limiter.penalize(5)
+
+    # 再開後はburstを使わず、1秒間隔で送る
+    assert limiter.reserve('image-to-image') == 5
+    assert limiter.reserve('image-to-image') == 6
+
+
+def test_disabled_limiter_never_waits(tmp_path, clock):
+    limiter = make_limiter(tmp_path, rate=0)
+
+    limiter.penalize(30)
+
+    assert [limiter.reserve('image-to-image') for _ in range(10)] == [0] * 10